@@ -0,0 +1,342 @@
+"""
+Compact binary encoding of group snapshots for bandwidth-constrained links.
+
+Instead of one text message per value, all values of a group are published as
+one binary frame to <MQTT_TOPIC>/<serial_no>/<group>/compact. The parameters of
+the frame are described by a schema, which is published as retained JSON message
+to <MQTT_TOPIC>/<serial_no>/<group>/schema:
+
+    {"version": 1, "id": <schema id>, "group": "now-base", "fields": [field, ...]}
+
+    field: [param, scale]                        number or text
+           [param, scale, {code: label, ...}]    enum, sent as code
+           [param, scale, {bit: label, ...}, "bits"]   bit field, sent as mask of the set bits
+
+Frame layout (little endian):
+    uint8     format version
+    uint32    schema id (CRC32 of the fields), frames of an unknown schema are rejected
+    uint32    time of data acquisition (unix time in s)
+    bitmap    ceil(len(fields) / 8) bytes, bit i set if field i is present
+    values    the present fields in schema order
+
+Every value starts with a varint, whose 2 low bits are its tag:
+    0   integer: the rest of the varint is the zigzag encoded value * scale
+    1   float: 4 bytes float32 follow
+    2   string: the rest of the varint is the length of the UTF-8 bytes, which follow
+    3   bool: the rest of the varint is 0 or 1
+
+Subscribers decode the frames with CompactDecoder:
+
+    decoder = CompactDecoder()
+
+    def on_message(client, userdata, message):
+        if (result := decoder.handle(topic=message.topic, payload=message.payload)) is not None:
+            group, timestamp, values = result
+
+(c) 2024 by SukramJ
+"""
+
+from __future__ import annotations
+
+from collections.abc import Iterable, Mapping
+import json
+import logging
+import math
+import struct
+from typing import Any, Final
+import zlib
+
+from mtec2mqtt.const import UTF8, RegisterType
+from mtec2mqtt.register_map import RegisterDefinition
+
+_LOGGER: Final = logging.getLogger(__name__)
+
+COMPACT_FORMAT_VERSION: Final = 1
+COMPACT_TOPIC: Final = "compact"
+COMPACT_SCHEMA_TOPIC: Final = "schema"
+
+_HEADER: Final = struct.Struct("<BII")
+_FLOAT: Final = struct.Struct("<f")
+_TAG_INT: Final = 0
+_TAG_FLOAT: Final = 1
+_TAG_STR: Final = 2
+_TAG_BOOL: Final = 3
+# Integers beyond this are sent as float
+_MAX_INT: Final = 1 << 53
+# Published values of bit fields without set bits, and of unknown enum codes
+_BITS_OK: Final = "OK"
+_UNKNOWN: Final = "Unknown"
+# Max deviation of a scaled float from an integer, e.g. 192.2 * 10 = 1921.9999999999998
+_INT_TOLERANCE: Final = 1e-6
+
+
+class CompactField:
+    """Parameter of a frame."""
+
+    __slots__ = ("bits", "codes", "labels", "param", "scale")
+
+    def __init__(
+        self, param: str, scale: int, labels: Mapping[int, str] | None = None, bits: bool = False
+    ) -> None:
+        """
+        Init the field.
+
+        Values of fields with labels are sent as code: the code of an enum, or the mask of
+        the set bits of a bit field (bits).
+        """
+        self.param: Final = param
+        self.scale: Final = max(int(scale), 1)
+        self.labels: Final = dict(labels) if labels else None
+        self.bits: Final = bits and self.labels is not None
+        self.codes: Final = {label: code for code, label in (labels or {}).items()}
+
+    def as_json(self) -> list[Any]:
+        """Return the field of the schema message."""
+        if self.labels is None:
+            return [self.param, self.scale]
+        labels = {str(code): label for code, label in self.labels.items()}
+        return [self.param, self.scale, labels, *(["bits"] if self.bits else [])]
+
+    def encode(self, value: Any) -> bytes:
+        """Return the tagged value."""
+        if (
+            self.labels is not None
+            and isinstance(value, str)
+            and (code := self._get_code(value=value)) is not None
+        ):
+            return _encode_varint(value=(_zigzag(code) << 2) | _TAG_INT)
+        return _encode_value(value=value, scale=self.scale)
+
+    def decode(self, frame: bytes, pos: int) -> tuple[Any, int]:
+        """Return the value at pos and the position after it."""
+        if (labels := self.labels) is None:
+            return _decode_value(frame=frame, pos=pos, scale=self.scale)
+        value, pos = _decode_value(frame=frame, pos=pos, scale=1)
+        if not isinstance(value, int) or isinstance(value, bool):
+            return value, pos
+        if self.bits:
+            return ", ".join(
+                [label for bit, label in labels.items() if value & (1 << bit)]
+            ) or _BITS_OK, pos
+        return labels.get(value, _UNKNOWN), pos
+
+    def _get_code(self, value: str) -> int | None:
+        """Return the code of a label, or None if it has no code."""
+        if not self.bits:
+            return self.codes.get(value)
+        if value == _BITS_OK:
+            return 0
+        mask = 0
+        for label in value.split(", "):
+            if (bit := self.codes.get(label)) is None:
+                return None
+            mask |= 1 << bit
+        return mask
+
+
+class CompactSchema:
+    """Parameters of the frames of a group."""
+
+    __slots__ = ("fields", "group", "index", "schema_id")
+
+    def __init__(self, group: str, fields: Iterable[CompactField]) -> None:
+        """Init the schema with the fields in frame order."""
+        self.group: Final = group
+        self.fields: Final = tuple(fields)
+        self.index: Final = {field.param: idx for idx, field in enumerate(self.fields)}
+        self.schema_id: Final = zlib.crc32(
+            json.dumps([field.as_json() for field in self.fields], separators=(",", ":")).encode(
+                UTF8
+            )
+        )
+
+    @classmethod
+    def from_definitions(
+        cls, group: str, definitions: Iterable[RegisterDefinition]
+    ) -> CompactSchema:
+        """Return the schema of the published registers of a group."""
+        return cls(
+            group=group,
+            fields=[
+                CompactField(
+                    param=item.mqtt,
+                    scale=item.scale,
+                    labels=item.value_items if item.device_class == "enum" else None,
+                    bits=item.type == RegisterType.BIT,
+                )
+                for item in definitions
+                if item.mqtt
+            ],
+        )
+
+    @classmethod
+    def from_json(cls, payload: bytes | str) -> CompactSchema:
+        """Return the schema of a schema message."""
+        data = json.loads(payload)
+        if (version := data.get("version")) != COMPACT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported compact format version: {version}")
+        schema = cls(
+            group=data["group"],
+            fields=[
+                CompactField(
+                    param=field[0],
+                    scale=field[1],
+                    labels={int(code): label for code, label in field[2].items()}
+                    if len(field) > 2  # noqa: PLR2004
+                    else None,
+                    bits="bits" in field[3:],
+                )
+                for field in data["fields"]
+            ],
+        )
+        if schema.schema_id != data["id"]:
+            raise ValueError(f"Schema id mismatch: {data['id']} != {schema.schema_id}")
+        return schema
+
+    def to_json(self) -> str:
+        """Return the schema message."""
+        return json.dumps(
+            {
+                "version": COMPACT_FORMAT_VERSION,
+                "id": self.schema_id,
+                "group": self.group,
+                "fields": [field.as_json() for field in self.fields],
+            },
+            separators=(",", ":"),
+        )
+
+    def encode(self, values: Mapping[str, Any], timestamp: float) -> bytes:
+        """Return the frame of values. Parameters, which aren't part of the schema, are skipped."""
+        fields = self.fields
+        index = self.index
+        bitmap = bytearray((len(fields) + 7) // 8)
+        encoded: dict[int, bytes] = {}
+        for param, value in values.items():
+            if (idx := index.get(param)) is None or value is None:
+                continue
+            encoded[idx] = fields[idx].encode(value=value)
+            bitmap[idx >> 3] |= 1 << (idx & 7)
+        return b"".join(
+            (
+                _HEADER.pack(COMPACT_FORMAT_VERSION, self.schema_id, int(timestamp)),
+                bitmap,
+                *(encoded[idx] for idx in sorted(encoded)),
+            )
+        )
+
+    def decode(self, frame: bytes) -> tuple[float, dict[str, Any]]:
+        """Return the timestamp and the values of a frame. Raises ValueError if it is invalid."""
+        try:
+            return self._decode(frame=frame)
+        except (IndexError, struct.error, UnicodeDecodeError) as ex:
+            raise ValueError(f"Invalid compact frame: {ex}") from ex
+
+    def _decode(self, frame: bytes) -> tuple[float, dict[str, Any]]:
+        """Return the timestamp and the values of a frame."""
+        version, schema_id, timestamp = _HEADER.unpack_from(frame)
+        if version != COMPACT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported compact format version: {version}")
+        if schema_id != self.schema_id:
+            raise ValueError(f"Frame of unknown schema {schema_id}, expected {self.schema_id}")
+        fields = self.fields
+        pos = _HEADER.size
+        bitmap = frame[pos : pos + (len(fields) + 7) // 8]
+        pos += len(bitmap)
+        values: dict[str, Any] = {}
+        for idx, field in enumerate(fields):
+            if not bitmap[idx >> 3] & (1 << (idx & 7)):
+                continue
+            values[field.param], pos = field.decode(frame=frame, pos=pos)
+        if pos != len(frame):
+            raise ValueError(f"Invalid compact frame: {len(frame) - pos} bytes left")
+        return float(timestamp), values
+
+
+class CompactDecoder:
+    """Decodes the compact frames of all groups with their schema messages."""
+
+    def __init__(self) -> None:
+        """Init the decoder without schemas."""
+        # schema by topic base of the group, e.g. MTEC/<serial_no>/now-base
+        self._schemas: Final[dict[str, CompactSchema]] = {}
+
+    def handle(self, topic: str, payload: bytes) -> tuple[str, float, dict[str, Any]] | None:
+        """
+        Handle a message of a schema or frame topic.
+
+        Return group, timestamp and values of a frame, or None for schema messages and frames
+        without a known schema.
+        """
+        base, _, kind = topic.rpartition("/")
+        if kind == COMPACT_SCHEMA_TOPIC:
+            self._schemas[base] = CompactSchema.from_json(payload=payload)
+            return None
+        if kind != COMPACT_TOPIC:
+            return None
+        if (schema := self._schemas.get(base)) is None:
+            _LOGGER.debug("No schema for compact frame of %s yet", topic)
+            return None
+        timestamp, values = schema.decode(frame=payload)
+        return schema.group, timestamp, values
+
+
+def _encode_value(value: Any, scale: int) -> bytes:
+    """Return a tagged value."""
+    if isinstance(value, bool):
+        return _encode_varint(value=(int(value) << 2) | _TAG_BOOL)
+    if isinstance(value, (int, float)):
+        scaled = value * scale
+        if isinstance(scaled, int) or (
+            math.isfinite(scaled)
+            and abs(scaled) < _MAX_INT
+            and abs(scaled - round(scaled)) < _INT_TOLERANCE
+        ):
+            return _encode_varint(value=(_zigzag(round(scaled)) << 2) | _TAG_INT)
+        return _encode_varint(value=_TAG_FLOAT) + _FLOAT.pack(value)
+    data = str(value).encode(UTF8)
+    return _encode_varint(value=(len(data) << 2) | _TAG_STR) + data
+
+
+def _decode_value(frame: bytes, pos: int, scale: int) -> tuple[Any, int]:
+    """Return a tagged value and the position after it."""
+    head, pos = _decode_varint(frame=frame, pos=pos)
+    tag = head & 3
+    rest = head >> 2
+    if tag == _TAG_INT:
+        number = (rest >> 1) if not rest & 1 else -((rest + 1) >> 1)
+        return (number / scale if scale > 1 else number), pos
+    if tag == _TAG_FLOAT:
+        return _FLOAT.unpack_from(frame, pos)[0], pos + _FLOAT.size
+    if tag == _TAG_STR:
+        if pos + rest > len(frame):
+            raise ValueError("Truncated string")
+        return frame[pos : pos + rest].decode(UTF8), pos + rest
+    return bool(rest), pos
+
+
+def _zigzag(value: int) -> int:
+    """Return the zigzag encoding of a signed integer."""
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+
+def _encode_varint(value: int) -> bytes:
+    """Return an unsigned LEB128 varint."""
+    data = bytearray()
+    while value > 0x7F:  # noqa: PLR2004
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def _decode_varint(frame: bytes, pos: int) -> tuple[int, int]:
+    """Return an unsigned LEB128 varint and the position after it."""
+    value = 0
+    shift = 0
+    while True:
+        byte = frame[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
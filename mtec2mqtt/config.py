@@ -9,10 +9,12 @@ from __future__ import annotations
 
 import logging
 import os
+import re
 import socket
 import sys
 from typing import Any, Final, cast
 
+import voluptuous as vol
 import yaml
 
 from mtec2mqtt.const import (
@@ -23,15 +25,18 @@ from mtec2mqtt.const import (
     ENV_APPDATA,
     ENV_XDG_CONFIG_HOME,
     FILE_REGISTERS,
-    MANDATORY_PARAMETERS,
-    OPTIONAL_PARAMETERS,
     UTF8,
     Config,
-    Register,
 )
+from mtec2mqtt.register_map import RegisterMap, build_register_map
 
 _LOGGER: Final = logging.getLogger(__name__)
 
+# Top level key of a config line, which may be commented out, and its trailing comment
+_CONFIG_LINE: Final = re.compile(
+    r"^(?P<commented>#\s?)?(?P<key>[A-Za-z_][\w-]*)\s*:(?P<value>.*?)(?P<comment>\s+#.*)?$"
+)
+
 
 # Create new config file
 def create_config_file() -> bool:
@@ -86,9 +91,8 @@ def create_config_file() -> bool:
     return True
 
 
-def init_config() -> dict[str, Any]:
-    """Read configuration from YAML file."""
-    # Look in different locations for config.yaml file
+def _get_config_files() -> list[str]:
+    """Return the locations of the config.yaml file in the order they are searched."""
     conf_files: list[str] = [os.path.join(os.getcwd(), CONFIG_FILE)]
     # Usually something like ~/.config/mtec2mqtt/config.yaml resp. 'C:\\Users\\xxxx\\AppData\\Roaming'
     if cfg_path := os.environ.get(ENV_XDG_CONFIG_HOME) or os.environ.get(ENV_APPDATA):
@@ -97,9 +101,14 @@ def init_config() -> dict[str, Any]:
         conf_files.append(
             os.path.join(os.path.expanduser("~"), CONFIG_ROOT, CONFIG_PATH, CONFIG_FILE)
         )
+    return conf_files
+
 
+def init_config() -> dict[str, Any]:
+    """Read configuration from YAML file."""
+    # Look in different locations for config.yaml file
     config: dict[str, Any] = {}
-    for fname_conf in conf_files:
+    for fname_conf in _get_config_files():
         try:
             with open(file=fname_conf, encoding=UTF8) as f_conf:
                 config = cast(dict[str, Any], yaml.safe_load(f_conf))
@@ -113,7 +122,46 @@ def init_config() -> dict[str, Any]:
     return config
 
 
-def init_register_map() -> tuple[dict[str, dict[str, Any]], list[str]]:
+def update_config_file(values: dict[str, Any]) -> bool:
+    """
+    Set top level values in the config.yaml file in use.
+
+    Existing (also commented) top level lines of a key are replaced, keeping their trailing
+    comment, other keys are appended. Comments and the order of all other lines are kept.
+    """
+    if not (fname_conf := next((f for f in _get_config_files() if os.path.isfile(f)), None)):
+        _LOGGER.error("Couldn't find config YAML file")
+        return False
+    try:
+        with open(file=fname_conf, encoding=UTF8) as file:
+            lines = file.read().splitlines()
+        pending = dict(values)
+        # replace active lines first, then commented ones
+        for commented in (False, True):
+            for idx, line in enumerate(lines):
+                if (
+                    (match := _CONFIG_LINE.match(line)) is None
+                    or bool(match["commented"]) != commented
+                    or (key := match["key"]) not in pending
+                ):
+                    continue
+                lines[idx] = f"{key}: {_to_yaml(pending.pop(key))}{match['comment'] or ''}"
+        lines.extend(f"{key}: {_to_yaml(value)}" for key, value in pending.items())
+        with open(file=fname_conf, mode="w", encoding=UTF8) as file:
+            file.write("\n".join(lines) + "\n")
+    except OSError as err:
+        _LOGGER.error("Couldn't update config YAML file %s: %s", fname_conf, str(err))
+        return False
+    _LOGGER.info("Updated config YAML file %s: %s", fname_conf, values)
+    return True
+
+
+def _to_yaml(value: Any) -> str:
+    """Return a value as YAML flow style."""
+    return yaml.safe_dump(value, default_flow_style=True).splitlines()[0]
+
+
+def init_register_map() -> RegisterMap:
     """Read inverter registers and their mapping from YAML file."""
     BASE_DIR = os.path.dirname(__file__)  # Base installation directory
     try:
@@ -128,34 +176,11 @@ def init_register_map() -> tuple[dict[str, dict[str, Any]], list[str]]:
         sys.exit(1)
 
     # Syntax checks
-    reg_map: dict[str, dict[str, Any]] = {}
-
-    reg_groups: list[str] = []
-
-    error = False
-    for key, val in r_map.items():
-        # Check for mandatory parameters
-        for p in MANDATORY_PARAMETERS:
-            if not val.get(p):
-                _LOGGER.warning(
-                    "Skipping invalid register config: %s. Missing mandatory parameter: %s.",
-                    key,
-                    p,
-                )
-                error = True
-                break
-
-        if not error:  # All mandatory parameters found
-            item = val.copy()
-            # Check optional parameters and add defaults, if not found
-            for param, default in OPTIONAL_PARAMETERS.items():
-                if param not in item:
-                    item[param] = default
-            reg_map[key] = item  # Append to reg_map
-
-            if (group := item[Register.GROUP]) and group not in reg_groups:
-                reg_groups.append(group)  # Append to group list
-    return reg_map, reg_groups
+    try:
+        return build_register_map(r_map=r_map)
+    except vol.Invalid as err:
+        _LOGGER.fatal("Invalid registers YAML file %s: %s", fname_regs, str(err))
+        sys.exit(1)
 
 
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(filename)s: %(message)s")
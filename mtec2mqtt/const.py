@@ -2,7 +2,7 @@
 
 from __future__ import annotations
 
-from enum import StrEnum
+from enum import IntEnum, StrEnum
 from typing import Final
 
 CLIENT_ID: Final = "M-TEC-MQTT"
@@ -22,27 +22,65 @@ FILE_REGISTERS: Final = "registers.yaml"
 class Config(StrEnum):
     """enum with config qualifiers."""
 
+    CSV_DIR = "CSV_DIR"
+    CSV_FLUSH_INTERVAL = "CSV_FLUSH_INTERVAL"
+    CSV_KEEP_DAYS = "CSV_KEEP_DAYS"
     DEBUG = "DEBUG"
+    FAST_LANE_INTERVAL = "FAST_LANE_INTERVAL"
+    FAST_LANE_REGISTERS = "FAST_LANE_REGISTERS"
     HASS_BASE_TOPIC = "HASS_BASE_TOPIC"
     HASS_BIRTH_GRACETIME = "HASS_BIRTH_GRACETIME"
+    HASS_DISCOVERY_BATCH = "HASS_DISCOVERY_BATCH"
+    HASS_DISCOVERY_RATE = "HASS_DISCOVERY_RATE"
+    HASS_DEVICE_DISCOVERY = "HASS_DEVICE_DISCOVERY"
     HASS_ENABLE = "HASS_ENABLE"
+    HTTP_API_HOST = "HTTP_API_HOST"
+    HTTP_API_PORT = "HTTP_API_PORT"
+    INFLUX_FILE = "INFLUX_FILE"
+    INFLUX_FLUSH_INTERVAL = "INFLUX_FLUSH_INTERVAL"
+    INFLUX_MEASUREMENT = "INFLUX_MEASUREMENT"
+    INFLUX_TOKEN = "INFLUX_TOKEN"
+    INFLUX_URL = "INFLUX_URL"
+    MODBUS_ADAPTIVE_TIMEOUT = "MODBUS_ADAPTIVE_TIMEOUT"
+    MODBUS_CLUSTER_GAP = "MODBUS_CLUSTER_GAP"
+    MODBUS_CYCLE_BUDGET = "MODBUS_CYCLE_BUDGET"
     MODBUS_FRAMER = "MODBUS_FRAMER"
     MODBUS_IP = "MODBUS_IP"
+    MODBUS_MAX_CLUSTER_SIZE = "MODBUS_MAX_CLUSTER_SIZE"
+    MODBUS_PIPELINE_DEPTH = "MODBUS_PIPELINE_DEPTH"
     MODBUS_PORT = "MODBUS_PORT"
+    MODBUS_PROXY_HOST = "MODBUS_PROXY_HOST"
+    MODBUS_PROXY_MAX_AGE = "MODBUS_PROXY_MAX_AGE"
+    MODBUS_PROXY_PORT = "MODBUS_PROXY_PORT"
     MODBUS_RETRIES = "MODBUS_RETRIES"
     MODBUS_SLAVE = "MODBUS_SLAVE"
     MODBUS_TIMEOUT = "MODBUS_TIMEOUT"
+    MODBUS_TIMEOUT_MIN = "MODBUS_TIMEOUT_MIN"
     MQTT_FLOAT_FORMAT = "MQTT_FLOAT_FORMAT"
     MQTT_LOGIN = "MQTT_LOGIN"
+    MQTT_MESSAGE_EXPIRY = "MQTT_MESSAGE_EXPIRY"
+    MQTT_PAYLOAD_FORMAT = "MQTT_PAYLOAD_FORMAT"
     MQTT_PASSWORD = "MQTT_PASSWORD"
     MQTT_PORT = "MQTT_PORT"
+    MQTT_PROTOCOL = "MQTT_PROTOCOL"
+    MQTT_QUEUE_HARD_LIMIT = "MQTT_QUEUE_HARD_LIMIT"
+    MQTT_QUEUE_SOFT_LIMIT = "MQTT_QUEUE_SOFT_LIMIT"
+    MQTT_REPLAY_RATE = "MQTT_REPLAY_RATE"
     MQTT_SERVER = "MQTT_SERVER"
+    MQTT_SPOOL_DIR = "MQTT_SPOOL_DIR"
+    MQTT_SPOOL_HIGH_WATER = "MQTT_SPOOL_HIGH_WATER"
+    MQTT_SPOOL_LATEST_ONLY = "MQTT_SPOOL_LATEST_ONLY"
+    MQTT_SPOOL_MAX_SIZE = "MQTT_SPOOL_MAX_SIZE"
+    MQTT_SPOOL_RATE = "MQTT_SPOOL_RATE"
     MQTT_TOPIC = "MQTT_TOPIC"
     REFRESH_CONFIG = "REFRESH_CONFIG"
     REFRESH_DAY = "REFRESH_DAY"
     REFRESH_NOW = "REFRESH_NOW"
     REFRESH_STATIC = "REFRESH_STATIC"
     REFRESH_TOTAL = "REFRESH_TOTAL"
+    REFRESH_UNCHANGED = "REFRESH_UNCHANGED"
+    SCHEDULER_WEIGHTS = "SCHEDULER_WEIGHTS"
+    SHARED_MEMORY_NAME = "SHARED_MEMORY_NAME"
 
 
 REFRESH_DEFAULTS: Final = {
@@ -51,13 +89,83 @@ REFRESH_DEFAULTS: Final = {
     Config.REFRESH_NOW: 10,
     Config.REFRESH_STATIC: 3600,
     Config.REFRESH_TOTAL: 300,
+    Config.REFRESH_UNCHANGED: 300,
 }
 
+DEFAULT_FAST_LANE_INTERVAL: Final = 2
+DEFAULT_HTTP_API_HOST: Final = "127.0.0.1"
+DEFAULT_MODBUS_PROXY_HOST: Final = "127.0.0.1"
+# Max age (s) of cached words, which are served by the modbus proxy
+DEFAULT_MODBUS_PROXY_MAX_AGE: Final = 10
+
+# Max number of registers of a modbus read
+DEFAULT_MAX_CLUSTER_SIZE: Final = 125
+
+# Lower bound of the adaptive modbus timeout (s), the configured MODBUS_TIMEOUT is the upper bound
+DEFAULT_MODBUS_TIMEOUT_MIN: Final = 0.3
+
+# Estimated read time of a cluster (s), until it has been measured
+DEFAULT_CLUSTER_LATENCY: Final = 0.1
+
+# Output sinks besides MQTT: flush intervals (s) of the batched writers
+DEFAULT_CSV_FLUSH_INTERVAL: Final = 60
+DEFAULT_INFLUX_FLUSH_INTERVAL: Final = 10
+DEFAULT_INFLUX_MEASUREMENT: Final = "mtec"
+# Max number of group updates buffered by a sink, while it can't write
+DEFAULT_SINK_MAX_BUFFER: Final = 10000
+
+HASS_DISCOVERY_DEFAULTS: Final = {
+    Config.HASS_DISCOVERY_BATCH: 10,
+    Config.HASS_DISCOVERY_RATE: 20,
+}
+
+MQTT_PROTOCOL_V311: Final = "3.1.1"
+MQTT_PROTOCOL_V5: Final = "5"
+MQTT_DEFAULT_MESSAGE_EXPIRY: Final = 60
+MQTT_USER_PROPERTY_TIMESTAMP: Final = "ts"
+# Messages waiting to be sent, above which now-* updates are coalesced (soft)
+# and config and static updates are delayed (hard)
+DEFAULT_MQTT_QUEUE_SOFT_LIMIT: Final = 100
+DEFAULT_MQTT_QUEUE_HARD_LIMIT: Final = 300
+# Max. size of the MQTT spool (MB)
+DEFAULT_MQTT_SPOOL_MAX_SIZE: Final = 100
+# Messages handed to paho but not yet sent, above which messages are spooled
+DEFAULT_MQTT_SPOOL_HIGH_WATER: Final = 500
+# Replayed messages per second
+DEFAULT_MQTT_SPOOL_RATE: Final = 100
+# Messages per second, when the cached state is published again (HA birth, refresh command)
+DEFAULT_MQTT_REPLAY_RATE: Final = 50
+# Command topic below <MQTT_TOPIC>/<serial_no>, which publishes the cached state again
+MQTT_REFRESH_COMMAND: Final = "refresh"
+
+
+class MqttPayloadFormat(StrEnum):
+    """Format of the published values."""
+
+    # Compact binary frame per group and text message per value
+    BOTH = "both"
+    # Compact binary frame per group, see compact.py
+    COMPACT = "compact"
+    # Text message per value
+    TEXT = "text"
+
+
+class PublishPriority(IntEnum):
+    """Priority of MQTT messages, if the broker can't keep up."""
+
+    # Always sent, e.g. command acknowledgements and now-base
+    CRITICAL = 0
+    # Coalesced under pressure: only the latest message of a topic is sent
+    NORMAL = 1
+    # Delayed under high pressure, e.g. config and static republishing
+    LOW = 2
+
 
 class HA(StrEnum):
     """Enum with HA qualifiers."""
 
     COMMAND_TOPIC = "command_topic"
+    COMPONENTS = "components"
     DEVICE = "device"
     DEVICE_CLASS = "device_class"
     ENABLED_BY_DEFAULT = "enabled_by_default"
@@ -68,22 +176,55 @@ class HA(StrEnum):
     MODEL_ID = "model_id"
     NAME = "name"
     OPTIONS = "options"
+    ORIGIN = "origin"
     PAYLOAD_OFF = "payload_off"
     PAYLOAD_ON = "payload_on"
     PAYLOAD_PRESS = "payload_press"
+    PLATFORM = "platform"
     SERIAL_NUMBER = "serial_number"
     STATE_CLASS = "state_class"
     STATE_TOPIC = "state_topic"
+    SUPPORT_URL = "support_url"
     UNIQUE_ID = "unique_id"
     SW_VERSION = "sw_version"
+    TOPIC_BASE = "~"
     UNIT_OF_MEASUREMENT = "unit_of_measurement"
     VALUE_TEMPLATE = "value_template"
 
 
+# Abbreviations supported by HA MQTT discovery. Used for the device based discovery.
+HA_ABBREVIATIONS: Final[dict[str, str]] = {
+    HA.COMMAND_TOPIC: "cmd_t",
+    HA.COMPONENTS: "cmps",
+    HA.DEVICE: "dev",
+    HA.DEVICE_CLASS: "dev_cla",
+    HA.ENABLED_BY_DEFAULT: "en",
+    HA.IDENTIFIERS: "ids",
+    HA.MANUFACTURER: "mf",
+    HA.MODEL: "mdl",
+    HA.MODEL_ID: "mdl_id",
+    HA.OPTIONS: "ops",
+    HA.ORIGIN: "o",
+    HA.PAYLOAD_OFF: "pl_off",
+    HA.PAYLOAD_ON: "pl_on",
+    HA.PAYLOAD_PRESS: "pl_prs",
+    HA.PLATFORM: "p",
+    HA.SERIAL_NUMBER: "sn",
+    HA.STATE_CLASS: "stat_cla",
+    HA.STATE_TOPIC: "stat_t",
+    HA.SUPPORT_URL: "url",
+    HA.SW_VERSION: "sw",
+    HA.UNIQUE_ID: "uniq_id",
+    HA.UNIT_OF_MEASUREMENT: "unit_of_meas",
+    HA.VALUE_TEMPLATE: "val_tpl",
+}
+
+
 class HAPlatform(StrEnum):
     """Enum with HA platform."""
 
     BINARY_SENSOR = "binary_sensor"
+    BUTTON = "button"
     NUMBER = "number"
     SELECT = "select"
     SENSOR = "sensor"
@@ -103,6 +244,8 @@ class Register(StrEnum):
     NAME = "name"
     PAYLOAD_OFF = "hass_payload_off"
     PAYLOAD_ON = "hass_payload_on"
+    PRECISION = "precision"
+    REFRESH = "refresh"
     SCALE = "scale"
     SERIAL_NO = "serial_no"
     STATE_CLASS = "hass_state_class"
@@ -114,6 +257,19 @@ class Register(StrEnum):
     WRITABLE = "writable"
 
 
+class RegisterType(StrEnum):
+    """Enum with Register data types."""
+
+    BIT = "BIT"
+    BYTE = "BYTE"
+    DAT = "DAT"
+    I16 = "I16"
+    I32 = "I32"
+    STR = "STR"
+    U16 = "U16"
+    U32 = "U32"
+
+
 class RegisterGroup(StrEnum):
     """Enum with Register group qualifiers."""
 
@@ -129,6 +285,37 @@ class RegisterGroup(StrEnum):
     STATIC = "static"
 
 
+NOW_GROUP_PREFIX: Final = "now-"
+
+# Weights of the register groups, when the modbus time budget is exceeded
+SCHEDULER_WEIGHTS_DEFAULT: Final = {
+    RegisterGroup.BASE: 10,
+    RegisterGroup.GRID: 3,
+    RegisterGroup.INVERTER: 3,
+    RegisterGroup.BACKUP: 3,
+    RegisterGroup.BATTERY: 3,
+    RegisterGroup.PV: 3,
+    RegisterGroup.CONFIG: 2,
+    RegisterGroup.DAY: 2,
+    RegisterGroup.TOTAL: 1,
+    RegisterGroup.STATIC: 1,
+}
+
+# Priority of the MQTT messages of the register groups, other groups are NORMAL
+PUBLISH_PRIORITIES: Final = {
+    RegisterGroup.BASE: PublishPriority.CRITICAL,
+    RegisterGroup.CONFIG: PublishPriority.LOW,
+    RegisterGroup.STATIC: PublishPriority.LOW,
+}
+
+# Groups, of which only the latest values are spooled during MQTT outages
+MQTT_SPOOL_LATEST_ONLY_DEFAULT: Final = (
+    RegisterGroup.CONFIG,
+    RegisterGroup.DAY,
+    RegisterGroup.TOTAL,
+    RegisterGroup.STATIC,
+)
+
 SECONDARY_REGISTER_GROUPS: Final = {
     0: RegisterGroup.GRID,
     1: RegisterGroup.INVERTER,
@@ -137,18 +324,6 @@ SECONDARY_REGISTER_GROUPS: Final = {
     4: RegisterGroup.PV,
 }
 
-MANDATORY_PARAMETERS: Final = [Register.NAME]
-
-OPTIONAL_PARAMETERS: Final = {
-    Register.LENGTH: None,
-    Register.TYPE: None,
-    Register.UNIT: "",
-    Register.SCALE: 1,
-    Register.WRITABLE: False,
-    Register.MQTT: None,
-    Register.GROUP: None,
-}
-
 EQUIPMENT: Final = {
     30: {
         0: "4.0K-25A-3P",
@@ -0,0 +1,83 @@
+"""
+Formatting of native register values.
+
+Register values are kept in native types: BIT registers as int bit fields, BYTE
+registers as tuples of bytes and DAT registers as datetime. They are only turned
+into their string representation at the publish edge.
+
+(c) 2024 by SukramJ
+"""
+
+from __future__ import annotations
+
+from collections.abc import Callable, Mapping
+from datetime import datetime
+from typing import Any, Final
+
+from mtec2mqtt.const import RegisterType
+from mtec2mqtt.register_map import RegisterDefinition
+
+BIT_TABLE_TYPE = tuple[tuple[int, str], ...]
+
+_DATE_FORMAT: Final = "%y-%m-%d %H:%M:%S"
+
+
+def decode_date(value: tuple[int, ...]) -> datetime | tuple[int, ...]:
+    """Return a datetime from the 6 bytes of a DAT register. Invalid dates are kept as bytes."""
+    year, month, day, hour, minute, second = value
+    if year < 100:
+        try:
+            return datetime(2000 + year, month, day, hour, minute, second)
+        except ValueError:
+            pass
+    return value
+
+
+def format_bits(value: int, length: int) -> str:
+    """Return a bit field as groups of 16 bits per register."""
+    return " ".join(
+        f"{(value >> (16 * (length - 1 - idx))) & 0xFFFF:016b}" for idx in range(length)
+    )
+
+
+def format_bytes(value: tuple[int, ...]) -> str:
+    """Return bytes as decimal pairs. The two halves of longer values are separated by two spaces."""
+    parts = [f"{byte:02d}" for byte in value]
+    if len(parts) >= 4:
+        half = len(parts) // 2
+        return f"{' '.join(parts[:half])}  {' '.join(parts[half:])}"
+    return " ".join(parts)
+
+
+def format_date(value: datetime | tuple[int, ...]) -> str:
+    """Return the string representation of a DAT value."""
+    if isinstance(value, datetime):
+        return value.strftime(_DATE_FORMAT)
+    return "{:02d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format(*value)
+
+
+def get_type_formatter(definition: RegisterDefinition) -> Callable[[Any], Any] | None:
+    """Return the formatter of a register type, or None if the value is used as is."""
+    if definition.type == RegisterType.BIT:
+        length = definition.length
+        return lambda value: format_bits(value=value, length=length)
+    if definition.type == RegisterType.BYTE:
+        return format_bytes
+    if definition.type == RegisterType.DAT:
+        return format_date
+    return None
+
+
+def build_bit_table(value_items: Mapping[int, str], length: int) -> BIT_TABLE_TYPE:
+    """
+    Precompute the bit masks and labels of a bit field.
+
+    The keys of value_items are bit indexes. Bits beyond the register length can't be set
+    and are dropped.
+    """
+    return tuple((1 << idx, label) for idx, label in value_items.items() if idx < 16 * length)
+
+
+def decode_bits(value: int, table: BIT_TABLE_TYPE) -> str:
+    """Return the labels of all set bits, or OK if none is set."""
+    return ", ".join([label for mask, label in table if value & mask]) or "OK"
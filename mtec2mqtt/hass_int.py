@@ -6,21 +6,46 @@ number/select/switch entities, and optional custom automations. It uses the
 register map to determine which entities should be exposed and subscribes to
 command topics for controllable entities.
 
+Discovery is sent incrementally: a content hash of every published config is
+kept, unchanged configs are skipped (unless a full resend is forced after a
+Home Assistant restart or a reconnect to the broker), the remaining messages are
+paced in batches by a token bucket, and entities which disappeared are removed.
+At startup, the hashes are seeded from the configs retained by the broker, so
+entities of a previous run are removed as well.
+
 (c) 2024 by Christian Rödel
 (c) 2024 by SukramJ
 """
 
 from __future__ import annotations
 
+import hashlib
 import json
 import logging
+import threading
+import time
 from typing import Any, Final
 
-from mtec2mqtt import mqtt_client
-from mtec2mqtt.const import HA, MTEC_PREFIX, MTEC_TOPIC_ROOT, HAPlatform, Register
+from mtec2mqtt import __version__, mqtt_client
+from mtec2mqtt.const import (
+    HA,
+    HA_ABBREVIATIONS,
+    HASS_DISCOVERY_DEFAULTS,
+    MTEC_PREFIX,
+    MTEC_TOPIC_ROOT,
+    Config,
+    HAPlatform,
+)
+from mtec2mqtt.rate_limit import TokenBucket
+from mtec2mqtt.register_map import RegisterDefinition, RegisterMap
 
 _LOGGER: Final = logging.getLogger(__name__)
 
+# The retained configs are complete, if no further one arrived within this time (s)
+_RETAINED_CONFIG_IDLE: Final = 1.0
+_RETAINED_CONFIG_MAX_WAIT: Final = 10.0
+_CONFIG_SUFFIX: Final = "/config"
+
 
 class HassIntegration:
     """HA integration."""
@@ -31,13 +56,37 @@ class HassIntegration:
         # ("Set general mode", "MTEC_load_battery_btn", "load_battery_from_grid"),
     ]
 
-    def __init__(self, hass_base_topic: str, register_map: dict[str, dict[str, Any]]) -> None:
+    def __init__(
+        self,
+        hass_base_topic: str,
+        register_map: RegisterMap,
+        discovery_rate: float = HASS_DISCOVERY_DEFAULTS[Config.HASS_DISCOVERY_RATE],
+        discovery_batch: int = HASS_DISCOVERY_DEFAULTS[Config.HASS_DISCOVERY_BATCH],
+        device_discovery: bool = False,
+    ) -> None:
         """Init hass integration."""
         self._hass_base_topic: Final = hass_base_topic
         self._register_map: Final = register_map
+        self._device_discovery: Final = device_discovery
+        self._discovery_batch: Final = max(int(discovery_batch), 1)
+        self._discovery_bucket: Final = TokenBucket(
+            rate=discovery_rate, burst=self._discovery_batch
+        )
+        # Content hash of every config published so far. Keyed by config topic.
+        self._published_hashes: Final[dict[str, str]] = {}
+        # Set, when a retained config arrived while they are loaded at startup
+        self._retained_config_event: Final = threading.Event()
+        self._loading_retained_configs = False
+        self._subscribed_command_topics: Final[set[str]] = set()
+        self._discovery_lock: Final = threading.Lock()
         self._mqtt: mqtt_client.MqttClient = None  # type: ignore[assignment]
         self._serial_no: str | None = None
         self._is_initialized = False
+        # Store: (platform, data_item_without_device, command_topic_or_none)
+        self._entities: Final[list[tuple[HAPlatform, dict[str, Any], str | None]]] = []
+        self._command_topics: Final[list[str]] = []
+        # Platform of every component sent with the device based discovery. Keyed by component id.
+        self._device_components: Final[dict[str, str]] = {}
         # Store: (config_topic, serialized_payload, command_topic_or_none)
         self._devices_array: Final[list[tuple[str, str, str | None]]] = []
         self._device_info: dict[str, Any] = {}
@@ -66,60 +115,160 @@ class HassIntegration:
             HA.SERIAL_NUMBER: serial_no,
             HA.SW_VERSION: firmware_version,
         }
-        self._devices_array.clear()
+        self._entities.clear()
+        self._command_topics.clear()
         self._build_devices_array()
         self._build_automation_array()
+        self._load_retained_configs()
+        self._build_discovery_messages()
         self.send_discovery_info()
         self._is_initialized = True
 
-    def send_discovery_info(self) -> None:
-        """Send discovery info."""
-        _LOGGER.info("Sending home assistant discovery info")
-        publish = self._mqtt.publish
-        subscribe = self._mqtt.subscribe_to_topic
-        for topic, payload_str, command_topic in self._devices_array:
-            publish(topic=topic, payload=payload_str, retain=True)
-            if command_topic:
-                subscribe(topic=command_topic)
+    def send_discovery_info(self, force: bool = False) -> None:
+        """
+        Send discovery info.
+
+        Only configs whose content changed since they were last published are sent,
+        unless force is set (e.g. after a restart of Home Assistant). Configs of
+        entities which are no longer part of the devices array are removed.
+        """
+        with self._discovery_lock:
+            published = self._published_hashes
+
+            for command_topic in self._command_topics:
+                if command_topic not in self._subscribed_command_topics:
+                    self._mqtt.subscribe_to_topic(topic=command_topic)
+                    self._subscribed_command_topics.add(command_topic)
+
+            pending: list[tuple[str, str]] = []
+            current_topics: set[str] = set()
+            for topic, payload_str, _ in self._devices_array:
+                current_topics.add(topic)
+                if force or published.get(topic) != _hash_payload(payload=payload_str):
+                    pending.append((topic, payload_str))
+
+            # An empty retained payload removes the entity from home assistant. Removals are sent
+            # first, so entities moved between per entity and device discovery keep their unique id.
+            pending[:0] = [(topic, "") for topic in sorted(published.keys() - current_topics)]
+
+            _LOGGER.info(
+                "Sending home assistant discovery info (%i of %i configs, %i entities, forced=%s)",
+                len(pending),
+                len(self._devices_array),
+                len(self._entities),
+                force,
+            )
+            # Messages, which weren't accepted by the MQTT client, are sent with the next discovery
+            for topic, payload_str in self._publish_paced(messages=pending):
+                if payload_str:
+                    published[topic] = _hash_payload(payload=payload_str)
+                else:
+                    published.pop(topic, None)
 
     def send_unregister_info(self) -> None:
         """Send unregister info."""
         _LOGGER.info("Sending info to unregister from home assistant")
-        for topic, _, _ in self._devices_array:
-            self._mqtt.publish(topic=topic, payload="")
+        with self._discovery_lock:
+            for topic, _ in self._publish_paced(
+                messages=[(topic, "") for topic, _, _ in self._devices_array]
+            ):
+                self._published_hashes.pop(topic, None)
+
+    def is_config_topic(self, topic: str) -> bool:
+        """Return True if topic is a discovery config topic."""
+        return topic.startswith(f"{self._hass_base_topic}/") and topic.endswith(_CONFIG_SUFFIX)
+
+    def handle_config_message(self, topic: str, payload: str, retained: bool) -> None:
+        """Record a retained config of this device, while the retained configs are loaded."""
+        if not (self._loading_retained_configs and retained and payload):
+            return
+        if not self._is_own_config_topic(topic=topic):
+            return
+        self._published_hashes[topic] = _hash_payload(payload=payload)
+        if self._device_discovery and topic == self._get_device_topic():
+            self._load_device_components(payload=payload)
+        self._retained_config_event.set()
+
+    def _load_device_components(self, payload: str) -> None:
+        """Load the components of a retained device message, so removed ones can be removed."""
+        try:
+            components = json.loads(payload)[HA_ABBREVIATIONS[HA.COMPONENTS]]
+            self._device_components.update(
+                (key, component[HA_ABBREVIATIONS[HA.PLATFORM]])
+                for key, component in components.items()
+                if len(component) > 1
+            )
+        except (AttributeError, KeyError, TypeError, ValueError) as ex:
+            _LOGGER.debug("Ignoring invalid retained device discovery message: %s", ex)
+
+    def _is_own_config_topic(self, topic: str) -> bool:
+        """Return True if topic is a config topic, which is published by this integration."""
+        parts = topic[len(self._hass_base_topic) + 1 : -len(_CONFIG_SUFFIX)].split("/")
+        if len(parts) != 2:  # noqa: PLR2004
+            return False
+        platform, object_id = parts
+        if platform == "device":
+            return object_id == f"{MTEC_PREFIX}{self._serial_no}"
+        return object_id.startswith(MTEC_PREFIX)
+
+    def _load_retained_configs(self) -> None:
+        """
+        Load the hashes of the configs, which are retained by the broker.
+
+        So configs of a previous run, which are unchanged, aren't sent again, and configs
+        of entities, which disappeared since, are removed.
+        """
+        topic_filter = f"{self._hass_base_topic}/+/+{_CONFIG_SUFFIX}"
+        event = self._retained_config_event
+        event.clear()
+        self._loading_retained_configs = True
+        self._mqtt.subscribe_to_topic(topic=topic_filter)
+        # The broker sends the retained messages right after the subscription
+        deadline = time.monotonic() + _RETAINED_CONFIG_MAX_WAIT
+        while time.monotonic() < deadline:
+            if not event.wait(timeout=_RETAINED_CONFIG_IDLE) and self._mqtt.is_connected:
+                break
+            event.clear()
+        self._loading_retained_configs = False
+        self._mqtt.unsubscribe_from_topic(topic=topic_filter)
+        _LOGGER.debug("Found %i retained discovery configs", len(self._published_hashes))
+
+    def _publish_paced(self, messages: list[tuple[str, str]]) -> list[tuple[str, str]]:
+        """Publish retained messages in batches paced by the token bucket. Return the accepted ones."""
+        publish = self._mqtt.publish
+        batch_size = self._discovery_batch
+        accepted: list[tuple[str, str]] = []
+        for start in range(0, len(messages), batch_size):
+            batch = messages[start : start + batch_size]
+            self._discovery_bucket.acquire(tokens=len(batch))
+            accepted.extend(
+                (topic, payload_str)
+                for topic, payload_str in batch
+                if publish(topic=topic, payload=payload_str, retain=True)
+            )
+        return accepted
 
     def _build_automation_array(self) -> None:
         # Buttons
         for name, unique_id, payload_press in self.buttons:
             command_topic = f"{MTEC_TOPIC_ROOT}/{self._serial_no}/automations/command"
-            data_item = {
+            data_item: dict[str, Any] = {
                 HA.COMMAND_TOPIC: command_topic,
-                HA.DEVICE: self._device_info,
                 HA.NAME: name,
                 HA.PAYLOAD_PRESS: payload_press,
                 HA.UNIQUE_ID: unique_id,
             }
-            topic = f"{self._hass_base_topic}/button/{unique_id}/config"
-            self._devices_array.append((topic, json.dumps(data_item), command_topic))
+            self._append_entity(
+                platform=HAPlatform.BUTTON, data_item=data_item, command_topic=command_topic
+            )
 
     def _build_devices_array(self) -> None:
         """Build discovery data for devices."""
         # Keys that indicate HA exposure when present in register config
-        hass_keys = (
-            Register.COMPONENT_TYPE,
-            Register.DEVICE_CLASS,
-            Register.PAYLOAD_OFF,
-            Register.PAYLOAD_ON,
-            Register.STATE_CLASS,
-            Register.VALUE_ITEMS,
-            Register.VALUE_TEMPLATE,
-        )
-        for item in self._register_map.values():
+        for item in self._register_map.definitions:
             # Do registration if there is at least one specific hass_* config entry
-            do_hass_registration = any(k in item for k in hass_keys)
-
-            if item[Register.GROUP] and do_hass_registration:
-                component_type = item.get(Register.COMPONENT_TYPE, HAPlatform.SENSOR)
+            if item.group and item.has_hass_config:
+                component_type = item.component_type or HAPlatform.SENSOR
                 if component_type == HAPlatform.SENSOR:
                     self._append_sensor(item)
                 elif component_type == HAPlatform.BINARY_SENSOR:
@@ -134,69 +283,135 @@ class HassIntegration:
                     self._append_switch(item)
                     self._append_binary_sensor(item)
 
-    def _append_sensor(self, item: dict[str, Any]) -> None:
-        name = item[Register.NAME]
-        group = item[Register.GROUP]
-        mqtt = item[Register.MQTT]
-        unit = item[Register.UNIT]
+    def _build_discovery_messages(self) -> None:
+        """Serialize the collected entities into discovery messages."""
+        self._devices_array.clear()
+        if self._device_discovery:
+            self._devices_array.append(self._build_device_message())
+            return
+        for platform, data_item, command_topic in self._entities:
+            payload = {HA.DEVICE: self._device_info, **data_item}
+            topic = f"{self._hass_base_topic}/{platform}/{data_item[HA.UNIQUE_ID]}/config"
+            self._devices_array.append((topic, json.dumps(payload), command_topic))
+
+    def _build_device_message(self) -> tuple[str, str, str | None]:
+        """
+        Build a single device based discovery message.
+
+        All entities are sent as components of one device with abbreviated keys
+        and topics relative to the `~` topic base.
+        """
+        topic_base = f"{MTEC_TOPIC_ROOT}/{self._serial_no}"
+        topic_prefix = f"{topic_base}/"
+        components: dict[str, dict[str, Any]] = {}
+        for platform, data_item, _ in self._entities:
+            component: dict[str, Any] = {HA_ABBREVIATIONS[HA.PLATFORM]: platform}
+            for key, value in data_item.items():
+                # Skip values which equal the HA defaults
+                if (key == HA.ENABLED_BY_DEFAULT and value is True) or value in ("", None):
+                    continue
+                if key in (HA.COMMAND_TOPIC, HA.STATE_TOPIC) and value.startswith(topic_prefix):
+                    value = f"{HA.TOPIC_BASE}/{value[len(topic_prefix) :]}"
+                component[HA_ABBREVIATIONS.get(key, key)] = value
+            components[f"{data_item[HA.UNIQUE_ID]}_{platform}"] = component
+
+        # Components which disappeared are removed by sending only their platform
+        for key, removed_platform in self._device_components.items():
+            if key not in components:
+                components[key] = {HA_ABBREVIATIONS[HA.PLATFORM]: removed_platform}
+        self._device_components.clear()
+        self._device_components.update(
+            (key, component[HA_ABBREVIATIONS[HA.PLATFORM]])
+            for key, component in components.items()
+            if len(component) > 1
+        )
+
+        payload = {
+            HA_ABBREVIATIONS[HA.DEVICE]: {
+                HA_ABBREVIATIONS.get(key, key): value for key, value in self._device_info.items()
+            },
+            HA_ABBREVIATIONS[HA.ORIGIN]: {
+                HA.NAME: "mtec2mqtt",
+                HA_ABBREVIATIONS[HA.SW_VERSION]: __version__,
+                HA_ABBREVIATIONS[HA.SUPPORT_URL]: "https://github.com/sukramj/mtec2mqtt",
+            },
+            HA.TOPIC_BASE: topic_base,
+            HA_ABBREVIATIONS[HA.COMPONENTS]: components,
+        }
+        # The device message carries all command topics. They are subscribed separately.
+        return self._get_device_topic(), json.dumps(payload, separators=(",", ":")), None
+
+    def _get_device_topic(self) -> str:
+        """Return the topic of the device based discovery message."""
+        return f"{self._hass_base_topic}/device/{MTEC_PREFIX}{self._serial_no}{_CONFIG_SUFFIX}"
+
+    def _append_entity(
+        self, platform: HAPlatform, data_item: dict[str, Any], command_topic: str | None
+    ) -> None:
+        self._entities.append((platform, data_item, command_topic))
+        if command_topic:
+            self._command_topics.append(command_topic)
+
+    def _append_sensor(self, item: RegisterDefinition) -> None:
+        name = item.name
+        group = item.group
+        mqtt = item.mqtt
+        unit = item.unit
         unique_id = f"{MTEC_PREFIX}{mqtt}"
         state_topic = f"{MTEC_TOPIC_ROOT}/{self._serial_no}/{group}/{mqtt}/state"
 
-        data_item = {
-            HA.DEVICE: self._device_info,
+        data_item: dict[str, Any] = {
             HA.ENABLED_BY_DEFAULT: True,
             HA.NAME: name,
             HA.STATE_TOPIC: state_topic,
             HA.UNIQUE_ID: unique_id,
             HA.UNIT_OF_MEASUREMENT: unit,
         }
-        if hass_device_class := item.get(Register.DEVICE_CLASS):
+        if hass_device_class := item.device_class:
             data_item[HA.DEVICE_CLASS] = hass_device_class
-        if hass_value_template := item.get(Register.VALUE_TEMPLATE):
+        if hass_value_template := item.value_template:
             data_item[HA.VALUE_TEMPLATE] = hass_value_template
-        if hass_state_class := item.get(Register.STATE_CLASS):
+        if hass_state_class := item.state_class:
             data_item[HA.STATE_CLASS] = hass_state_class
 
-        topic = f"{self._hass_base_topic}/{HAPlatform.SENSOR}/{unique_id}/config"
-        self._devices_array.append((topic, json.dumps(data_item), None))
+        self._append_entity(platform=HAPlatform.SENSOR, data_item=data_item, command_topic=None)
 
-    def _append_binary_sensor(self, item: dict[str, Any]) -> None:
-        name = item[Register.NAME]
-        group = item[Register.GROUP]
-        mqtt = item[Register.MQTT]
+    def _append_binary_sensor(self, item: RegisterDefinition) -> None:
+        name = item.name
+        group = item.group
+        mqtt = item.mqtt
         unique_id = f"{MTEC_PREFIX}{mqtt}"
         state_topic = f"{MTEC_TOPIC_ROOT}/{self._serial_no}/{group}/{mqtt}/state"
 
-        data_item = {
-            HA.DEVICE: self._device_info,
+        data_item: dict[str, Any] = {
             HA.ENABLED_BY_DEFAULT: True,
             HA.NAME: name,
             HA.STATE_TOPIC: state_topic,
             HA.UNIQUE_ID: unique_id,
         }
 
-        if hass_device_class := item.get(Register.DEVICE_CLASS):
+        if hass_device_class := item.device_class:
             data_item[HA.DEVICE_CLASS] = hass_device_class
-        if hass_payload_on := item.get(Register.PAYLOAD_ON):
+        if hass_payload_on := item.payload_on:
             data_item[HA.PAYLOAD_ON] = hass_payload_on
-        if hass_payload_off := item.get(Register.PAYLOAD_OFF):
+        if hass_payload_off := item.payload_off:
             data_item[HA.PAYLOAD_OFF] = hass_payload_off
 
-        topic = f"{self._hass_base_topic}/{HAPlatform.BINARY_SENSOR}/{unique_id}/config"
-        self._devices_array.append((topic, json.dumps(data_item), None))
+        self._append_entity(
+            platform=HAPlatform.BINARY_SENSOR, data_item=data_item, command_topic=None
+        )
 
-    def _append_number(self, item: dict[str, Any]) -> None:
-        group = item[Register.GROUP]
-        mqtt = item[Register.MQTT]
-        name = item[Register.NAME]
-        unit = item[Register.UNIT]
+    def _append_number(self, item: RegisterDefinition) -> None:
+        group = item.group
+        mqtt = item.mqtt
+        name = item.name
+        unit = item.unit
         unique_id = f"{MTEC_PREFIX}{mqtt}"
         mtec_topic = f"{MTEC_TOPIC_ROOT}/{self._serial_no}/{group}/{mqtt}"
         command_topic = f"{mtec_topic}/set"
         state_topic = f"{mtec_topic}/state"
-        data_item = {
+        data_item: dict[str, Any] = {
             HA.COMMAND_TOPIC: command_topic,
-            HA.DEVICE: self._device_info,
             HA.ENABLED_BY_DEFAULT: False,
             HA.MODE: "box",
             HA.NAME: name,
@@ -205,57 +420,63 @@ class HassIntegration:
             HA.UNIT_OF_MEASUREMENT: unit,
         }
 
-        if hass_device_class := item.get(Register.DEVICE_CLASS):
+        if hass_device_class := item.device_class:
             data_item[HA.DEVICE_CLASS] = hass_device_class
 
-        topic = f"{self._hass_base_topic}/{HAPlatform.NUMBER}/{unique_id}/config"
-        self._devices_array.append((topic, json.dumps(data_item), command_topic))
+        self._append_entity(
+            platform=HAPlatform.NUMBER, data_item=data_item, command_topic=command_topic
+        )
 
-    def _append_select(self, item: dict[str, Any]) -> None:
-        options = item[Register.VALUE_ITEMS]
-        group = item[Register.GROUP]
-        mqtt = item[Register.MQTT]
-        name = item[Register.NAME]
+    def _append_select(self, item: RegisterDefinition) -> None:
+        options = item.value_items
+        group = item.group
+        mqtt = item.mqtt
+        name = item.name
         unique_id = f"{MTEC_PREFIX}{mqtt}"
         mtec_topic = f"{MTEC_TOPIC_ROOT}/{self._serial_no}/{group}/{mqtt}"
         command_topic = f"{mtec_topic}/set"
         state_topic = f"{mtec_topic}/state"
-        data_item = {
+        data_item: dict[str, Any] = {
             HA.COMMAND_TOPIC: command_topic,
-            HA.DEVICE: self._device_info,
             HA.ENABLED_BY_DEFAULT: False,
             HA.NAME: name,
-            HA.OPTIONS: list(options.values()),
+            HA.OPTIONS: list(options.values()) if options else [],
             HA.STATE_TOPIC: state_topic,
             HA.UNIQUE_ID: unique_id,
         }
 
-        topic = f"{self._hass_base_topic}/{HAPlatform.SELECT}/{unique_id}/config"
-        self._devices_array.append((topic, json.dumps(data_item), command_topic))
+        self._append_entity(
+            platform=HAPlatform.SELECT, data_item=data_item, command_topic=command_topic
+        )
 
-    def _append_switch(self, item: dict[str, Any]) -> None:
-        group = item[Register.GROUP]
-        mqtt = item[Register.MQTT]
-        name = item[Register.NAME]
+    def _append_switch(self, item: RegisterDefinition) -> None:
+        group = item.group
+        mqtt = item.mqtt
+        name = item.name
         unique_id = f"{MTEC_PREFIX}{mqtt}"
         mtec_topic = f"{MTEC_TOPIC_ROOT}/{self._serial_no}/{group}/{mqtt}"
         command_topic = f"{mtec_topic}/set"
         state_topic = f"{mtec_topic}/state"
-        data_item = {
+        data_item: dict[str, Any] = {
             HA.COMMAND_TOPIC: command_topic,
-            HA.DEVICE: self._device_info,
             HA.ENABLED_BY_DEFAULT: False,
             HA.NAME: name,
             HA.STATE_TOPIC: state_topic,
             HA.UNIQUE_ID: unique_id,
         }
 
-        if hass_device_class := item.get(Register.DEVICE_CLASS):
+        if hass_device_class := item.device_class:
             data_item[HA.DEVICE_CLASS] = hass_device_class
-        if hass_payload_on := item.get(Register.PAYLOAD_ON):
+        if hass_payload_on := item.payload_on:
             data_item[HA.PAYLOAD_ON] = hass_payload_on
-        if hass_payload_off := item.get(Register.PAYLOAD_OFF):
+        if hass_payload_off := item.payload_off:
             data_item[HA.PAYLOAD_OFF] = hass_payload_off
 
-        topic = f"{self._hass_base_topic}/{HAPlatform.SWITCH}/{unique_id}/config"
-        self._devices_array.append((topic, json.dumps(data_item), command_topic))
+        self._append_entity(
+            platform=HAPlatform.SWITCH, data_item=data_item, command_topic=command_topic
+        )
+
+
+def _hash_payload(payload: str) -> str:
+    """Return a content hash of a discovery payload."""
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
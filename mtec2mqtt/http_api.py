@@ -0,0 +1,226 @@
+"""
+Local HTTP API.
+
+Serves the latest values of every register group from memory, so local tools
+don't need a MQTT client and don't cause any extra Modbus traffic.
+
+- GET /api/groups                  list of groups with their last update
+- GET /api/groups/<group>          values of a group
+- GET /api/registers/<mqtt name>   value of a single register
+- GET /api/events                  Server-Sent-Events stream of changed values
+- GET /api/plan                    plan of the last poll cycle
+
+Documents are serialized once per update and served with an ETag.
+
+(c) 2024 by SukramJ
+"""
+
+from __future__ import annotations
+
+from collections import deque
+from collections.abc import Callable
+from datetime import datetime
+import hashlib
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import threading
+from typing import Any, Final
+
+_LOGGER: Final = logging.getLogger(__name__)
+
+_API_PREFIX: Final = "/api/"
+_CONTENT_TYPE_JSON: Final = "application/json"
+_CONTENT_TYPE_SSE: Final = "text/event-stream"
+# Number of events kept for slow SSE readers
+_EVENT_BUFFER: Final = 256
+_SSE_KEEPALIVE: Final = 15.0
+
+
+class _Document:
+    """A serialized JSON document with its ETag."""
+
+    __slots__ = ("body", "etag")
+
+    def __init__(self, data: Any) -> None:
+        """Serialize the document."""
+        self.body: Final = json.dumps(data, separators=(",", ":"), default=str).encode()
+        self.etag: Final = f'"{hashlib.blake2b(self.body, digest_size=8).hexdigest()}"'
+
+
+class HttpApi:
+    """Embedded HTTP server for the latest register values."""
+
+    def __init__(
+        self, host: str, port: int, get_plan: Callable[[], dict[str, Any]] | None = None
+    ) -> None:
+        """Init the HTTP API."""
+        self._host: Final = host
+        self._port: Final = port
+        self._get_plan: Final = get_plan
+        self._lock: Final = threading.Lock()
+        self._groups: dict[str, _Document] = {}
+        self._group_index = _Document(data={})
+        self._group_timestamps: Final[dict[str, str]] = {}
+        self._registers: Final[dict[str, _Document]] = {}
+        # SSE events as (sequence number, serialized event)
+        self._events: Final[deque[tuple[int, bytes]]] = deque(maxlen=_EVENT_BUFFER)
+        self._event_seq = 0
+        self._event_cond: Final = threading.Condition(self._lock)
+        self._server: ThreadingHTTPServer | None = None
+        self._running = False
+
+    def start(self) -> None:
+        """Start the HTTP server in a background thread."""
+        api = self
+
+        class _Handler(_RequestHandler):
+            http_api = api
+
+        try:
+            self._server = ThreadingHTTPServer((self._host, self._port), _Handler)
+        except OSError as ex:
+            _LOGGER.error("Couldn't start HTTP API on %s:%i: %s", self._host, self._port, ex)
+            return
+        self._server.daemon_threads = True
+        self._running = True
+        threading.Thread(
+            target=self._server.serve_forever, name="mtec2mqtt-http", daemon=True
+        ).start()
+        _LOGGER.info("HTTP API listening on %s:%i", self._host, self._port)
+
+    def stop(self) -> None:
+        """Stop the HTTP server."""
+        with self._lock:
+            self._running = False
+            self._event_cond.notify_all()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def running(self) -> bool:
+        """Return True if the server is running."""
+        return self._running
+
+    def update_group(
+        self,
+        group: str,
+        timestamp: float,
+        values: dict[str, dict[str, Any]],
+        changed: list[str],
+    ) -> None:
+        """Store the values of a group. Called by the coordinator after every update."""
+        ts = datetime.fromtimestamp(timestamp).isoformat(timespec="seconds")
+        group_doc = _Document(data={"group": group, "timestamp": ts, "values": values})
+        register_docs = {
+            name: _Document(data={"group": group, **value}) for name, value in values.items()
+        }
+        event = None
+        if changed:
+            data = json.dumps(
+                {
+                    "group": group,
+                    "timestamp": ts,
+                    "values": {name: values[name] for name in changed if name in values},
+                },
+                separators=(",", ":"),
+                default=str,
+            )
+            event = f"event: {group}\ndata: {data}\n\n".encode()
+        with self._lock:
+            self._groups[group] = group_doc
+            self._group_timestamps[group] = ts
+            self._group_index = _Document(data=dict(self._group_timestamps))
+            self._registers.update(register_docs)
+            if event is not None:
+                self._event_seq += 1
+                self._events.append((self._event_seq, event))
+                self._event_cond.notify_all()
+
+    def get_document(self, path: str) -> _Document | None:
+        """Return the document of an API path."""
+        kind, _, name = path.removeprefix(_API_PREFIX).partition("/")
+        with self._lock:
+            if kind == "groups":
+                return self._groups.get(name) if name else self._group_index
+            if kind == "registers":
+                return self._registers.get(name)
+        if kind == "plan" and self._get_plan is not None:
+            return _Document(data=self._get_plan())
+        return None
+
+    def wait_for_events(self, after: int, timeout: float) -> tuple[int, list[bytes]]:
+        """Wait for events newer than after. Return the last sequence number and the events."""
+        with self._event_cond:
+            if self._running and self._event_seq <= after:
+                self._event_cond.wait(timeout=timeout)
+            events = [event for seq, event in self._events if seq > after]
+            return self._event_seq, events
+
+    @property
+    def event_seq(self) -> int:
+        """Return the sequence number of the last event."""
+        with self._lock:
+            return self._event_seq
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """Request handler of the HTTP API."""
+
+    http_api: HttpApi
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:  # noqa: N802
+        """Handle GET requests."""
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path == f"{_API_PREFIX}events":
+            self._send_events()
+            return
+        if (
+            not path.startswith(_API_PREFIX)
+            or (document := self.http_api.get_document(path=path)) is None
+        ):
+            self._send(status=HTTPStatus.NOT_FOUND, body=b'{"error":"not found"}')
+            return
+        if self.headers.get("If-None-Match") == document.etag:
+            self._send(status=HTTPStatus.NOT_MODIFIED, body=b"", etag=document.etag)
+            return
+        self._send(status=HTTPStatus.OK, body=document.body, etag=document.etag)
+
+    def _send(self, status: HTTPStatus, body: bytes, etag: str | None = None) -> None:
+        """Send a JSON response."""
+        self.send_response(status)
+        self.send_header("Content-Type", _CONTENT_TYPE_JSON)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def _send_events(self) -> None:
+        """Stream changed values as Server-Sent-Events."""
+        api = self.http_api
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", _CONTENT_TYPE_SSE)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        seq = api.event_seq
+        try:
+            while api.running:
+                seq, events = api.wait_for_events(after=seq, timeout=_SSE_KEEPALIVE)
+                self.wfile.write(b"".join(events) if events else b": keepalive\n\n")
+                self.wfile.flush()
+        except OSError:
+            # client disconnected
+            return
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        """Log requests at debug level."""
+        _LOGGER.debug("%s - %s", self.address_string(), format % args)
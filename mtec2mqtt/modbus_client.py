@@ -7,7 +7,11 @@ Modbus API for M-TEC Energybutler.
 
 from __future__ import annotations
 
+from array import array
 import logging
+import struct
+import threading
+import time
 from typing import Any, Final, cast
 
 from pymodbus.client import ModbusTcpClient
@@ -15,10 +19,162 @@ from pymodbus.exceptions import ModbusException
 from pymodbus.framer import FramerType
 from pymodbus.pdu.register_message import ReadHoldingRegistersResponse
 
-from mtec2mqtt.const import DEFAULT_FRAMER, Config, Register, RegisterGroup
+from mtec2mqtt.const import (
+    DEFAULT_CLUSTER_LATENCY,
+    DEFAULT_FRAMER,
+    DEFAULT_MAX_CLUSTER_SIZE,
+    DEFAULT_MODBUS_TIMEOUT_MIN,
+    Config,
+    RegisterGroup,
+    RegisterType,
+)
+from mtec2mqtt.formatting import decode_date
+from mtec2mqtt.register_map import RegisterDefinition, RegisterMap
+from mtec2mqtt.snapshot import SlotTable, Snapshot
 
 _LOGGER: Final = logging.getLogger(__name__)
 
+# Smoothing factor of the measured cluster latencies
+_LATENCY_ALPHA: Final = 0.25
+# Size of the modbus address space
+_ADDRESS_SPACE: Final = 0x10000
+# Gains of the smoothed round trip time and its variation (RFC 6298)
+_RTT_ALPHA: Final = 0.125
+_RTT_BETA: Final = 0.25
+# Weight of the variation in the timeout
+_RTT_K: Final = 4
+# Modbus TCP frames of pipelined reads
+_FRAMER_SOCKET: Final = "socket"
+_MBAP_HEADER: Final = struct.Struct(">HHHB")
+_READ_REQUEST: Final = struct.Struct(">BHH")
+_FC_READ_HOLDING_REGISTERS: Final = 0x03
+_EXCEPTION_FLAG: Final = 0x80
+# Pipelining falls back to sequential reads, if it is not faster by this factor after some reads
+_PIPELINE_MIN_SPEEDUP: Final = 1.25
+_PIPELINE_PROBE_READS: Final = 5
+# Pipelined reads in a row without all responses, after which pipelining is disabled
+_PIPELINE_MAX_FAILURES: Final = 3
+
+
+class RegisterCluster:
+    """A range of registers, which is read with a single modbus request. It may include small gaps."""
+
+    __slots__ = ("items", "length", "offsets", "slots", "start")
+
+    def __init__(self, start: int) -> None:
+        """Init an empty cluster."""
+        self.start: Final = start
+        self.length = 0
+        self.items: Final[list[RegisterDefinition]] = []
+        # offset of every item in the words of the cluster
+        self.offsets: Final[list[int]] = []
+        self.slots: Final[list[int]] = []
+
+    def append(self, item: RegisterDefinition) -> None:
+        """Extend the cluster by a register, including the gap before it."""
+        offset = (item.address or 0) - self.start
+        self.length = offset + item.length
+        self.items.append(item)
+        self.offsets.append(offset)
+        self.slots.append(item.slot)
+
+
+class WordCache:
+    """
+    Raw words of the modbus address space with the time they were read.
+
+    Every successful read updates the cache, so the latest words of all polled
+    registers can be served without another modbus request.
+    """
+
+    __slots__ = ("_timestamps", "_words")
+
+    def __init__(self) -> None:
+        """Init an empty cache."""
+        self._words: Final = array("H", bytes(2 * _ADDRESS_SPACE))
+        # 0.0 marks words which have never been read
+        self._timestamps: Final = array("d", bytes(8 * _ADDRESS_SPACE))
+
+    def update(self, address: int, words: list[int], timestamp: float) -> None:
+        """Store words read at address."""
+        end = address + len(words)
+        self._words[address:end] = array("H", words)
+        self._timestamps[address:end] = array("d", [timestamp]) * len(words)
+
+    def invalidate(self, address: int, count: int) -> None:
+        """Drop count words starting at address, e.g. after a write."""
+        self._timestamps[address : address + count] = array("d", bytes(8 * count))
+
+    def get(self, address: int, count: int, max_age: float) -> list[int] | None:
+        """Return count words starting at address, or None if any of them is older than max_age."""
+        if address < 0 or count <= 0 or address + count > _ADDRESS_SPACE:
+            return None
+        if min(self._timestamps[address : address + count]) < time.time() - max_age:
+            return None
+        return self._words[address : address + count].tolist()
+
+
+class RttEstimator:
+    """
+    Round trip time estimate per read size, which derives the timeout of a request.
+
+    The smoothed round trip time and its variation are tracked like the retransmission
+    timeout of TCP (RFC 6298), separately for every power of two of the read size, as
+    large reads take longer. The timeout is clamped to [min_timeout, max_timeout].
+    Sizes without samples use the max_timeout. After a timeout, the timeout of the size
+    is doubled until the next successful read.
+    """
+
+    __slots__ = ("_backoff", "_max_timeout", "_min_timeout", "_rttvar", "_srtt")
+
+    def __init__(self, min_timeout: float, max_timeout: float) -> None:
+        """Init an estimator without samples."""
+        self._min_timeout: Final = min(min_timeout, max_timeout)
+        self._max_timeout: Final = max_timeout
+        self._srtt: Final[dict[int, float]] = {}
+        self._rttvar: Final[dict[int, float]] = {}
+        self._backoff: Final[dict[int, int]] = {}
+
+    def timeout(self, count: int) -> float:
+        """Return the timeout (s) of a read of count registers."""
+        bucket = count.bit_length()
+        if (srtt := self._srtt.get(bucket)) is None:
+            return self._max_timeout
+        rto = (srtt + _RTT_K * self._rttvar[bucket]) * self._backoff.get(bucket, 1)
+        return min(max(rto, self._min_timeout), self._max_timeout)
+
+    def update(self, count: int, rtt: float) -> None:
+        """Add the round trip time (s) of a successful read of count registers."""
+        bucket = count.bit_length()
+        self._backoff.pop(bucket, None)
+        if (srtt := self._srtt.get(bucket)) is None:
+            self._srtt[bucket] = rtt
+            self._rttvar[bucket] = rtt / 2
+            return
+        self._rttvar[bucket] += _RTT_BETA * (abs(srtt - rtt) - self._rttvar[bucket])
+        self._srtt[bucket] = srtt + _RTT_ALPHA * (rtt - srtt)
+
+    def backoff(self, count: int) -> None:
+        """Double the timeout of reads of count registers, after a read timed out."""
+        bucket = count.bit_length()
+        if bucket in self._srtt and self.timeout(count=count) < self._max_timeout:
+            self._backoff[bucket] = 2 * self._backoff.get(bucket, 1)
+
+    def as_dict(self) -> dict[int, dict[str, float]]:
+        """Return the estimates in ms by the smallest read size of every bucket."""
+        return {
+            1 << (bucket - 1): {
+                "srtt": round(1000 * srtt, 1),
+                "rttvar": round(1000 * self._rttvar[bucket], 1),
+                "timeout": round(1000 * self.timeout(count=1 << (bucket - 1)), 1),
+            }
+            for bucket, srtt in sorted(self._srtt.items())
+        }
+
+
+class PipelineError(Exception):
+    """The gateway mixed up pipelined requests."""
+
 
 class MTECModbusClient:
     """Modbus API for MTEC Energy Butler."""
@@ -26,25 +182,28 @@ class MTECModbusClient:
     def __init__(
         self,
         config: dict[str, Any],
-        register_map: dict[str, dict[str, Any]],
-        register_groups: list[str],
+        register_map: RegisterMap,
     ) -> None:
         """Init the modbus client."""
         self._error_count = 0
         self._register_map: Final = register_map
-        self._register_groups: Final = register_groups
+        # Static metadata of all register slots, shared by all snapshots
+        self._slot_table: Final = SlotTable(register_map=register_map)
         self._modbus_client: ModbusTcpClient = None  # type: ignore[assignment]
         # Cache for computed register clusters. Keyed by a normalized tuple of numeric register addresses.
-        self._cluster_cache: Final[dict[tuple[int, ...], list[dict[str, Any]]]] = {}
-        # Precompute frequently used lookups to reduce per-call overhead
+        self._cluster_cache: Final[dict[tuple[int, ...], list[RegisterCluster]]] = {}
+        # Clusters of frequently polled register lists, never evicted
+        self._pinned_clusters: Final[dict[tuple[int, ...], list[RegisterCluster]]] = {}
+        # Smoothed read latency (s) per cluster, keyed by (start, length)
+        self._cluster_latencies: Final[dict[tuple[int, int], float]] = {}
+        # Latest raw words of all reads for the modbus proxy, only allocated if it is enabled
+        self._word_cache: Final = WordCache() if config.get(Config.MODBUS_PROXY_PORT) else None
+        # Serializes the access to the upstream connection, which is shared with the modbus proxy
+        self._lock: Final = threading.Lock()
         # Numeric registers (as strings) used when reading "all" registers
-        self._all_numeric_registers: Final[list[str]] = [r for r in register_map if r.isnumeric()]
-        # Mapping from MQTT name to numeric register string for quick writes
-        self._mqtt_name_to_register: Final[dict[str, str]] = {
-            cast(str, item.get(Register.MQTT)): reg
-            for reg, item in register_map.items()
-            if reg.isnumeric() and item.get(Register.MQTT)
-        }
+        self._all_numeric_registers: Final[list[str]] = [
+            d.register for d in register_map.definitions if not d.is_pseudo
+        ]
 
         self._modbus_framer: Final[str] = config.get(Config.MODBUS_FRAMER, DEFAULT_FRAMER)
         self._modbus_host: Final[str] = config[Config.MODBUS_IP]
@@ -52,6 +211,31 @@ class MTECModbusClient:
         self._modbus_retries: Final[int] = config[Config.MODBUS_RETRIES]
         self._modbus_slave: Final[int] = config[Config.MODBUS_SLAVE]
         self._modbus_timeout: Final[int] = config[Config.MODBUS_TIMEOUT]
+        # Max registers per read, and max unused registers between two registers of a cluster
+        self._max_cluster_size: Final[int] = min(
+            config.get(Config.MODBUS_MAX_CLUSTER_SIZE, DEFAULT_MAX_CLUSTER_SIZE),
+            DEFAULT_MAX_CLUSTER_SIZE,
+        )
+        self._cluster_gap: Final[int] = config.get(Config.MODBUS_CLUSTER_GAP, 0)
+        # Timeouts of reads, derived from the measured round trip times
+        self._rtt: Final = (
+            RttEstimator(
+                min_timeout=config.get(Config.MODBUS_TIMEOUT_MIN, DEFAULT_MODBUS_TIMEOUT_MIN),
+                max_timeout=self._modbus_timeout,
+            )
+            if config.get(Config.MODBUS_ADAPTIVE_TIMEOUT, True)
+            else None
+        )
+        # Max read requests in flight, 1 disables pipelining
+        self._pipeline_depth: int = max(1, config.get(Config.MODBUS_PIPELINE_DEPTH, 1))
+        if self._pipeline_depth > 1 and self._modbus_framer != _FRAMER_SOCKET:
+            _LOGGER.warning("Pipelining requires MODBUS_FRAMER socket, reading sequentially")
+            self._pipeline_depth = 1
+        self._pipeline_tid = 0
+        self._pipeline_reads = 0
+        self._pipeline_failures = 0
+        # Smoothed speedup of pipelined reads compared to sequential reads
+        self._pipeline_speedup = 0.0
         _LOGGER.debug("Modbus client initialized")
 
     def __del__(self) -> None:
@@ -64,15 +248,35 @@ class MTECModbusClient:
         return self._error_count
 
     @property
-    def register_groups(self) -> list[str]:
+    def pipeline_depth(self) -> int:
+        """Return the max read requests in flight, 1 if reads are sequential."""
+        return self._pipeline_depth
+
+    @property
+    def register_groups(self) -> tuple[RegisterGroup, ...]:
         """Return the register groups."""
-        return self._register_groups
+        return self._register_map.groups
 
     @property
-    def register_map(self) -> dict[str, dict[str, Any]]:
+    def register_map(self) -> RegisterMap:
         """Return the register map."""
         return self._register_map
 
+    @property
+    def slot_table(self) -> SlotTable:
+        """Return the slot table."""
+        return self._slot_table
+
+    @property
+    def rtt_estimator(self) -> RttEstimator | None:
+        """Return the round trip time estimator, None if adaptive timeouts are disabled."""
+        return self._rtt
+
+    @property
+    def word_cache(self) -> WordCache | None:
+        """Return the cache of the latest raw words, None if the modbus proxy is disabled."""
+        return self._word_cache
+
     def connect(self) -> bool:
         """Connect to modbus server."""
         self._error_count = 0
@@ -82,15 +286,16 @@ class MTECModbusClient:
             self._modbus_port,
             self._modbus_framer,
         )
-        self._modbus_client = ModbusTcpClient(
-            host=self._modbus_host,
-            port=self._modbus_port,
-            framer=FramerType(self._modbus_framer),
-            timeout=self._modbus_timeout,
-            retries=self._modbus_retries,
-        )
-
-        if self._modbus_client.connect():  # type: ignore[no-untyped-call]
+        with self._lock:
+            self._modbus_client = ModbusTcpClient(
+                host=self._modbus_host,
+                port=self._modbus_port,
+                framer=FramerType(self._modbus_framer),
+                timeout=self._modbus_timeout,
+                retries=self._modbus_retries,
+            )
+            connected = self._modbus_client.connect()  # type: ignore[no-untyped-call]
+        if connected:
             _LOGGER.debug(
                 "Successfully connected to server %s:%i", self._modbus_host, self._modbus_port
             )
@@ -100,17 +305,15 @@ class MTECModbusClient:
 
     def disconnect(self) -> None:
         """Disconnect from Modbus server."""
-        if self._modbus_client and self._modbus_client.is_socket_open():
+        with self._lock:
+            if not self._modbus_client or not self._modbus_client.is_socket_open():
+                return
             self._modbus_client.close()  # type: ignore[no-untyped-call]
-            _LOGGER.debug("Successfully disconnected from server")
+        _LOGGER.debug("Successfully disconnected from server")
 
     def get_register_list(self, group: RegisterGroup) -> list[str]:
         """Get a list of all registers which belong to a given group."""
-        registers: list[str] = []
-        for register, item in self._register_map.items():
-            if item[Register.GROUP] == group:
-                registers.append(register)
-
+        registers = [d.register for d in self._register_map.by_group(group)]
         if len(registers) == 0:
             _LOGGER.error("Unknown or empty register group: %s", group)
             return []
@@ -121,8 +324,30 @@ class MTECModbusClient:
         Read modbus data.
 
         This is the main API function. It either fetches all registers or a list of given registers.
+        The result is a view on a snapshot, see read_snapshot.
+        """
+        snapshot = Snapshot(table=self._slot_table)
+        slots = self.read_snapshot(snapshot=snapshot, registers=registers)
+        return snapshot.as_register_dict(slots=slots)
+
+    def read_snapshot(
+        self,
+        snapshot: Snapshot,
+        registers: list[str] | None = None,
+        max_age: float = 0.0,
+        changed: list[int] | None = None,
+    ) -> list[int]:
+        """
+        Read modbus data into a snapshot.
+
+        It either fetches all registers or a list of given registers. The slots of the
+        requested registers are invalidated first, so only successfully decoded slots
+        are valid afterwards. Returns the slots of the requested registers.
+
+        With a max_age, clusters whose raw words equal the last read are not decoded again,
+        as long as their last decode is younger than max_age seconds. The slots which were
+        decoded are appended to changed.
         """
-        data: dict[str, dict[str, Any]] = {}
         _LOGGER.debug("Retrieving data...")
 
         if registers is None:  # Create a list of all (numeric) registers
@@ -130,43 +355,257 @@ class MTECModbusClient:
             registers = self._all_numeric_registers
 
         cluster_list = self._get_register_clusters(registers=registers)
-        for reg_cluster in cluster_list:
-            offset = 0
+        slots: list[int] = [item.slot for cluster in cluster_list for item in cluster.items]
+        snapshot.invalidate(slots=slots)
+        raw_cache = snapshot.raw
+        for reg_cluster, words in zip(
+            cluster_list, self._read_clusters(clusters=cluster_list), strict=True
+        ):
+            if words is None:
+                continue
+            key = (reg_cluster.start, reg_cluster.length)
+            timestamp = time.time()
+            raw = array("H", words).tobytes()
+            if (
+                max_age > 0
+                and (cached := raw_cache.get(key)) is not None
+                and cached[0] == raw
+                and timestamp - cached[1] < max_age
+            ):
+                # unchanged cluster: keep the decoded values
+                snapshot.touch(slots=reg_cluster.slots, timestamp=timestamp)
+                continue
+
+            complete = True
+            for item, offset in zip(reg_cluster.items, reg_cluster.offsets, strict=True):
+                if (
+                    value := self._decode_value(words=words, offset=offset, item=item)
+                ) is not None:
+                    snapshot.set(slot=item.slot, value=value, timestamp=timestamp)
+                else:
+                    complete = False
+                    _LOGGER.error(
+                        "Decoding error while decoding register %s",
+                        reg_cluster.start + offset,
+                    )
+            if changed is not None:
+                changed.extend(reg_cluster.slots)
+            # Only completely decoded clusters may be reused
+            if complete:
+                raw_cache[key] = (raw, timestamp)
+            else:
+                raw_cache.pop(key, None)
+
+        _LOGGER.debug("Data retrieval completed")
+        return slots
+
+    def _read_clusters(self, clusters: list[RegisterCluster]) -> list[list[int] | None]:
+        """Read the words of every cluster, None for clusters which couldn't be read."""
+        if self._pipeline_depth > 1 and len(clusters) > 1:
+            try:
+                results = self._read_pipelined(clusters=clusters)
+            except PipelineError as ex:
+                _LOGGER.warning("Pipelining disabled, reading sequentially: %s", ex)
+                self._pipeline_depth = 1
+            except OSError as ex:
+                # e.g. a lost frame, counted like a failed read. The cycle is read sequentially.
+                self._error_count += 1
+                self._pipeline_failures += 1
+                if self._pipeline_failures >= _PIPELINE_MAX_FAILURES:
+                    _LOGGER.warning(
+                        "Pipelining disabled, no response to pipelined requests %i times: %s",
+                        self._pipeline_failures,
+                        ex,
+                    )
+                    self._pipeline_depth = 1
+                else:
+                    _LOGGER.warning(
+                        "No response to pipelined requests, reading sequentially: %s", ex
+                    )
+            else:
+                self._pipeline_failures = 0
+                return results
+        results = []
+        for reg_cluster in clusters:
             _LOGGER.debug(
                 "Fetching data for cluster start %s, length %s, items %s",
-                reg_cluster["start"],
-                reg_cluster[Register.LENGTH],
-                len(reg_cluster["items"]),
+                reg_cluster.start,
+                reg_cluster.length,
+                len(reg_cluster.items),
             )
-            if rawdata := self._read_registers(
-                register=reg_cluster["start"], length=reg_cluster[Register.LENGTH]
-            ):
-                for item in reg_cluster["items"]:
-                    if item.get(Register.TYPE):  # type==None means dummy
-                        register = str(reg_cluster["start"] + offset)
-                        if data_decoded := self._decode_rawdata(
-                            rawdata=rawdata, offset=offset, item=item
-                        ):
-                            data.update({register: data_decoded})
-                        else:
-                            _LOGGER.error("Decoding error while decoding register %s", register)
-                    offset += item[Register.LENGTH]
+            start = time.monotonic()
+            rawdata = self._read_registers(
+                register=str(reg_cluster.start), length=reg_cluster.length
+            )
+            self._update_latency(
+                key=(reg_cluster.start, reg_cluster.length), latency=time.monotonic() - start
+            )
+            results.append(rawdata.registers if rawdata else None)
+        return results
 
-        _LOGGER.debug("Data retrieval completed")
-        return data
+    def _read_pipelined(self, clusters: list[RegisterCluster]) -> list[list[int] | None]:
+        """
+        Read the clusters with up to pipeline_depth requests in flight.
+
+        Responses are matched by transaction id. Raises PipelineError on unexpected responses,
+        and OSError if responses are missing.
+        """
+        results: list[list[int] | None] = [None] * len(clusters)
+        with self._lock:
+            connected = self._modbus_client.connect()  # type: ignore[no-untyped-call]
+            if not connected or (sock := self._modbus_client.socket) is None:
+                _LOGGER.error(
+                    "Couldn't connect to server %s:%i", self._modbus_host, self._modbus_port
+                )
+                # counted like a failed read, so the connection is reset after repeated failures
+                self._error_count += 1
+                return results
+            # transaction id -> index of the cluster
+            pending: dict[int, int] = {}
+            next_index = 0
+            buffer = b""
+            start = first = time.monotonic()
+            try:
+                while next_index < len(clusters) or pending:
+                    requests: list[bytes] = []
+                    while next_index < len(clusters) and len(pending) < self._pipeline_depth:
+                        self._pipeline_tid = (self._pipeline_tid + 1) & 0xFFFF
+                        pending[self._pipeline_tid] = next_index
+                        requests.append(
+                            self._get_read_request(
+                                tid=self._pipeline_tid, cluster=clusters[next_index]
+                            )
+                        )
+                        next_index += 1
+                    # also makes the socket blocking, pymodbus may have left it non-blocking
+                    sock.settimeout(
+                        self._get_read_timeout(
+                            count=max(clusters[index].length for index in pending.values())
+                        )
+                    )
+                    if requests:
+                        sock.sendall(b"".join(requests))
+                    if not (chunk := sock.recv(4096)):
+                        raise ConnectionResetError("Connection closed by the gateway")
+                    buffer += chunk
+                    while len(buffer) >= _MBAP_HEADER.size:
+                        tid, _, length, _ = _MBAP_HEADER.unpack_from(buffer)
+                        if len(buffer) < (end := _MBAP_HEADER.size - 1 + length):
+                            break
+                        if (index := pending.pop(tid, None)) is None:
+                            raise PipelineError(f"Unexpected transaction id {tid}")
+                        if first == start:
+                            first = time.monotonic()
+                        results[index] = self._decode_read_response(
+                            pdu=buffer[_MBAP_HEADER.size : end], cluster=clusters[index]
+                        )
+                        buffer = buffer[end:]
+            except (OSError, PipelineError) as ex:
+                # drop the connection with the responses in flight, it is reopened by the next read
+                self._modbus_client.close()  # type: ignore[no-untyped-call]
+                if isinstance(ex, TimeoutError) and self._rtt is not None and pending:
+                    self._rtt.backoff(
+                        count=max(clusters[index].length for index in pending.values())
+                    )
+                raise
+        elapsed = time.monotonic() - start
+        for reg_cluster in clusters:
+            self._update_latency(
+                key=(reg_cluster.start, reg_cluster.length), latency=elapsed / len(clusters)
+            )
+        self._check_pipeline_speedup(
+            speedup=len(clusters) * (first - start) / elapsed if elapsed > 0 else 1.0
+        )
+        return results
+
+    def _get_read_request(self, tid: int, cluster: RegisterCluster) -> bytes:
+        """Return the modbus TCP frame of a read of the cluster."""
+        pdu = _READ_REQUEST.pack(_FC_READ_HOLDING_REGISTERS, cluster.start, cluster.length)
+        return _MBAP_HEADER.pack(tid, 0, len(pdu) + 1, self._modbus_slave) + pdu
+
+    def _decode_read_response(self, pdu: bytes, cluster: RegisterCluster) -> list[int] | None:
+        """Return the words of a read response, None for exception responses."""
+        if not pdu or pdu[0] & _EXCEPTION_FLAG:
+            _LOGGER.error(
+                "Error while reading register %s, length %s from pymodbus",
+                cluster.start,
+                cluster.length,
+            )
+            self._error_count += 1
+            return None
+        if len(pdu) != 2 + 2 * cluster.length or pdu[1] != 2 * cluster.length:
+            _LOGGER.error(
+                "Error while reading register %s from pymodbus: Requested length %s, received %i",
+                cluster.start,
+                cluster.length,
+                (len(pdu) - 2) // 2,
+            )
+            self._error_count += 1
+            return None
+        words = list(struct.unpack_from(f">{cluster.length}H", pdu, 2))
+        if self._word_cache is not None:
+            self._word_cache.update(address=cluster.start, words=words, timestamp=time.time())
+        return words
+
+    def _check_pipeline_speedup(self, speedup: float) -> None:
+        """
+        Track the speedup of pipelined reads, and disable pipelining if there is none.
+
+        The speedup is the time sequential reads would take, estimated from the first
+        response, divided by the time of the pipelined reads. A gateway, which serializes
+        the requests, answers them one after another, so the speedup stays about 1.
+        """
+        self._pipeline_reads += 1
+        if self._pipeline_reads == 1:
+            self._pipeline_speedup = speedup
+        else:
+            self._pipeline_speedup += _LATENCY_ALPHA * (speedup - self._pipeline_speedup)
+        if (
+            self._pipeline_reads >= _PIPELINE_PROBE_READS
+            and self._pipeline_speedup < _PIPELINE_MIN_SPEEDUP
+        ):
+            _LOGGER.warning(
+                "Pipelining disabled, the gateway serializes the requests (speedup %.2f)",
+                self._pipeline_speedup,
+            )
+            self._pipeline_depth = 1
+
+    def estimate_read_time(self, registers: list[str]) -> float:
+        """
+        Return the estimated time (s) to read the given registers at once.
+
+        It is based on the measured latencies of the clusters of the registers. The clusters
+        aren't cached, as the estimated register lists are rarely read as they are.
+        """
+        latencies = self._cluster_latencies
+        default = (
+            sum(latencies.values()) / len(latencies) if latencies else DEFAULT_CLUSTER_LATENCY
+        )
+        return sum(
+            latencies.get((cluster.start, cluster.length), default)
+            for cluster in self._generate_register_clusters(
+                addresses=self._get_cluster_key(registers=registers)
+            )
+        )
+
+    def _update_latency(self, key: tuple[int, int], latency: float) -> None:
+        """Update the smoothed latency of a cluster."""
+        if (previous := self._cluster_latencies.get(key)) is None:
+            self._cluster_latencies[key] = latency
+        else:
+            self._cluster_latencies[key] = previous + _LATENCY_ALPHA * (latency - previous)
 
     def write_register_by_name(self, name: str, value: Any) -> bool:
         """Write a value to a register with a given name."""
-        if (register := self._mqtt_name_to_register.get(name)) is None:
+        if (item := self._register_map.by_mqtt(name)) is None or item.is_pseudo:
             _LOGGER.error("Can't write unknown register with name: %s", name)
             return False
-        item = self._register_map[register]
-        if value_items := item.get(Register.VALUE_ITEMS):
+        if value_items := item.value_items:
             for value_modbus, value_display in value_items.items():
                 if value_display == value:
                     value = value_modbus
                     break
-        return self.write_register(register=register, value=value)
+        return self.write_register(register=item.register, value=value)
 
     def write_register(self, register: str, value: Any) -> bool:
         """Write a value to a register."""
@@ -174,7 +613,7 @@ class MTECModbusClient:
         if not (item := self._register_map.get(str(register), None)):
             _LOGGER.error("Can't write unknown register: %s", register)
             return False
-        if item.get(Register.WRITABLE, False) is False:
+        if not item.writable:
             _LOGGER.error("Can't write register which is marked read-only: %s", register)
             return False
 
@@ -187,78 +626,186 @@ class MTECModbusClient:
             return False
 
         # adjust scale
-        if item[Register.SCALE] > 1:
-            value *= item[Register.SCALE]
+        if item.scale > 1:
+            value *= item.scale
+
+        return self._write_registers(address=int(register), values=[int(value)])
+
+    def read_words(self, address: int, count: int, max_age: float) -> list[int] | int | None:
+        """
+        Return raw words, from the cache if they are younger than max_age.
 
+        Otherwise they are read through the upstream connection like probe_registers: errors
+        are neither logged nor counted, as reads of other clients must not trigger a reconnect.
+        Returns the words, the modbus exception code or None like probe_registers.
+        """
+        if (cache := self._word_cache) is not None and (
+            words := cache.get(address=address, count=count, max_age=max_age)
+        ) is not None:
+            return words
+        result = self.probe_registers(address=address, count=count)
+        if isinstance(result, list) and cache is not None:
+            cache.update(address=address, words=result, timestamp=time.time())
+        return result
+
+    def probe_registers(
+        self, address: int, count: int, input_registers: bool = False
+    ) -> list[int] | int | None:
+        """
+        Read raw words without logging errors, e.g. to scan the address space.
+
+        Reads holding registers, or input registers if input_registers is set. Returns the
+        words, the modbus exception code if the device rejected the read, or None if the device
+        didn't respond.
+        """
+        read = (
+            self._modbus_client.read_input_registers
+            if input_registers
+            else self._modbus_client.read_holding_registers
+        )
         try:
-            result = self._modbus_client.write_register(
-                address=int(register), value=int(value), device_id=self._modbus_slave
+            with self._lock:
+                result = read(address=address, count=count, device_id=self._modbus_slave)
+        except ModbusException as ex:
+            _LOGGER.debug(
+                "No response while probing register %s, length %s: %s", address, count, ex
+            )
+            return None
+        if result.isError():
+            return int(getattr(result, "exception_code", 0))
+        if len(result.registers) != count:
+            return None
+        return list(result.registers)
+
+    def write_words(self, address: int, values: list[int]) -> bool:
+        """
+        Write raw words through the upstream connection.
+
+        Only complete registers, which are marked writable, can be written.
+        """
+        if not self.is_writable(address=address, count=len(values)):
+            _LOGGER.error(
+                "Can't write registers %s to %s: not writable", address, address + len(values) - 1
             )
+            return False
+        return self._write_registers(address=address, values=values)
+
+    def is_writable(self, address: int, count: int) -> bool:
+        """Return True if the address range consists of complete registers, which are writable."""
+        items = self._register_map.by_address_range(start=address, end=address + count)
+        return (
+            bool(items)
+            and all(item.writable for item in items)
+            and items[0].address == address
+            and sum(item.length for item in items) == count
+        )
+
+    def _write_registers(self, address: int, values: list[int]) -> bool:
+        """Do the actual writing to modbus."""
+        try:
+            with self._lock:
+                if len(values) == 1:
+                    result = self._modbus_client.write_register(
+                        address=address, value=values[0], device_id=self._modbus_slave
+                    )
+                else:
+                    result = self._modbus_client.write_registers(
+                        address=address, values=values, device_id=self._modbus_slave
+                    )
         except ModbusException as ex:
-            _LOGGER.error("Exception while writing register %s to pymodbus: %s", register, ex)
+            _LOGGER.error("Exception while writing register %s to pymodbus: %s", address, ex)
             return False
         except Exception as ex:
-            _LOGGER.error("Unexpected error while writing register %s: %s", register, ex)
+            _LOGGER.error("Unexpected error while writing register %s: %s", address, ex)
             return False
+        finally:
+            # the next read has to return the written value
+            if self._word_cache is not None:
+                self._word_cache.invalidate(address=address, count=len(values))
 
         if result.isError():
-            _LOGGER.error("Error while writing register %s to pymodbus", register)
+            _LOGGER.error("Error while writing register %s to pymodbus", address)
             return False
         return True
 
-    def _get_register_clusters(self, registers: list[str]) -> list[dict[str, Any]]:
-        """Cluster registers in order to optimize modbus traffic."""
-        # Normalize key: use sorted unique numeric registers that exist in the map
-        key_tuple: tuple[int, ...] = tuple(
-            sorted({int(r) for r in registers if r.isnumeric() and r in self._register_map})
+    def pin_register_clusters(self, registers: list[str]) -> list[RegisterCluster]:
+        """Precompute the clusters of a register list, which are kept for the whole runtime."""
+        key_tuple = self._get_cluster_key(registers=registers)
+        if (clusters := self._pinned_clusters.get(key_tuple)) is None:
+            clusters = self._pinned_clusters[key_tuple] = self._generate_register_clusters(
+                addresses=key_tuple
+            )
+        return clusters
+
+    def _get_cluster_key(self, registers: list[str]) -> tuple[int, ...]:
+        """Return the normalized key of a register list: sorted unique numeric register addresses."""
+        return tuple(
+            sorted(
+                {
+                    item.address
+                    for r in registers
+                    if (item := self._register_map.get(r)) and item.address is not None
+                }
+            )
         )
+
+    def _get_register_clusters(self, registers: list[str]) -> list[RegisterCluster]:
+        """Cluster registers in order to optimize modbus traffic."""
+        key_tuple = self._get_cluster_key(registers=registers)
+        if (clusters := self._pinned_clusters.get(key_tuple)) is not None:
+            return clusters
         if key_tuple not in self._cluster_cache:
             # Simple cache size guard to avoid unbounded growth in long-running processes
             if len(self._cluster_cache) > 256:
                 self._cluster_cache.clear()
-            self._cluster_cache[key_tuple] = self._generate_register_clusters(registers=registers)
+            self._cluster_cache[key_tuple] = self._generate_register_clusters(addresses=key_tuple)
         return self._cluster_cache[key_tuple]
 
-    def _generate_register_clusters(self, registers: list[str]) -> list[dict[str, Any]]:
-        """
-        Create clusters.
-
-        Optimizations:
-        - Sort numerically instead of lexicographically to ensure proper clustering.
-        - Ignore non-numeric and unknown registers early to reduce loop work.
-        """
-        cluster: dict[str, Any] = {"start": 0, Register.LENGTH: 0, "items": []}
-        cluster_list: list[dict[str, Any]] = []
-
-        numeric_regs = sorted(
-            {int(r) for r in registers if r.isnumeric() and r in self._register_map}
-        )
-        for reg in numeric_regs:
-            item = self._register_map[str(reg)]
-            # if there is a gap to the current cluster, start a new one
-            if reg > cluster["start"] + cluster[Register.LENGTH]:
-                if cluster["start"] > 0:  # append previous cluster (not the initial dummy)
-                    cluster_list.append(cluster)
-                cluster = {"start": reg, Register.LENGTH: 0, "items": []}
+    def _generate_register_clusters(self, addresses: tuple[int, ...]) -> list[RegisterCluster]:
+        """Create clusters from sorted, unique register addresses."""
+        cluster: RegisterCluster | None = None
+        cluster_list: list[RegisterCluster] = []
+
+        for address in addresses:
+            if (item := self._register_map.by_address(address)) is None:
+                continue
+            # if the gap to the current cluster is too large or it would get too long, start a new one
+            if (
+                cluster is None
+                or address > cluster.start + cluster.length + self._cluster_gap
+                or address + item.length - cluster.start > self._max_cluster_size
+            ):
+                cluster = RegisterCluster(start=address)
+                cluster_list.append(cluster)
             # extend current cluster by item length and append the item
-            cluster[Register.LENGTH] += item[Register.LENGTH]
-            cluster["items"].append(item)
-
-        if cluster["start"] > 0:  # append last cluster
-            cluster_list.append(cluster)
+            cluster.append(item=item)
 
         return cluster_list
 
     def _read_registers(self, register: str, length: int) -> ReadHoldingRegistersResponse | None:
         """Do the actual reading from modbus."""
         try:
-            result: ReadHoldingRegistersResponse = cast(
-                ReadHoldingRegistersResponse,
-                self._modbus_client.read_holding_registers(
-                    address=int(register), count=length, device_id=self._modbus_slave
-                ),
-            )
+            with self._lock:
+                self._set_read_timeout(count=length)
+                start = time.monotonic()
+                try:
+                    result: ReadHoldingRegistersResponse = cast(
+                        ReadHoldingRegistersResponse,
+                        self._modbus_client.read_holding_registers(
+                            address=int(register), count=length, device_id=self._modbus_slave
+                        ),
+                    )
+                finally:
+                    self._set_timeout(timeout=self._modbus_timeout)
+                if self._rtt is not None and not result.isError():
+                    # a response to a repeated request can't be assigned to one of the requests (Karn)
+                    if getattr(result, "retries", 0) == 0:
+                        self._rtt.update(count=length, rtt=time.monotonic() - start)
+                    else:
+                        self._rtt.backoff(count=length)
         except ModbusException as ex:
+            if self._rtt is not None:
+                self._rtt.backoff(count=length)
             _LOGGER.error(
                 "Exception while reading register %s, length %s from pymodbus: %s",
                 register,
@@ -279,94 +826,93 @@ class MTECModbusClient:
                 length,
                 len(result.registers),
             )
+            self._error_count += 1
             return None
+        if self._word_cache is not None:
+            self._word_cache.update(
+                address=int(register), words=result.registers, timestamp=time.time()
+            )
         return result
 
-    def _decode_rawdata(
-        self, rawdata: ReadHoldingRegistersResponse, offset: int, item: dict[str, Any]
-    ) -> dict[str, Any]:
-        """Decode the result from rawdata, starting at offset."""
+    def _set_read_timeout(self, count: int) -> None:
+        """Set the timeout of the next read of count registers."""
+        self._set_timeout(timeout=self._get_read_timeout(count=count))
+
+    def _get_read_timeout(self, count: int) -> float:
+        """Return the timeout of a read of count registers."""
+        # connecting uses the timeout as well, so adapt it only on an open connection
+        if self._rtt is not None and self._modbus_client.is_socket_open():
+            return self._rtt.timeout(count=count)
+        return float(self._modbus_timeout)
+
+    def _set_timeout(self, timeout: float) -> None:
+        """Set the timeout of the upstream connection. Must be called with the lock held."""
+        # pymodbus applies the timeout of the connection to every receive
+        self._modbus_client.comm_params.timeout_connect = timeout
+
+    def _decode_value(self, words: list[int], offset: int, item: RegisterDefinition) -> Any:
+        """Decode the value from the raw register words, starting at offset. Returns None on error."""
         dt = self._modbus_client.DATATYPE
         try:
-            val = None
-            item_type = str(item[Register.TYPE])
-            item_length = int(item[Register.LENGTH])
+            val: Any = None
+            item_type = item.type
+            item_length = item.length
 
             # sanity check: ensure we have enough data
-            if offset < 0 or item_length <= 0 or offset + item_length > len(rawdata.registers):
+            if offset < 0 or item_length <= 0 or offset + item_length > len(words):
                 _LOGGER.error(
                     "Decoding bounds error (type=%s, offset=%s, length=%s, available=%s)",
                     item_type,
                     offset,
                     item_length,
-                    len(rawdata.registers),
+                    len(words),
                 )
-                return {}
+                return None
 
-            if item_type == "U16":
-                reg = rawdata.registers[offset : offset + 1]
+            if item_type == RegisterType.U16:
+                reg = words[offset : offset + 1]
                 val = self._modbus_client.convert_from_registers(
                     registers=reg, data_type=dt.UINT16
                 )
-            elif item_type == "I16":
-                reg = rawdata.registers[offset : offset + 1]
+            elif item_type == RegisterType.I16:
+                reg = words[offset : offset + 1]
                 val = self._modbus_client.convert_from_registers(registers=reg, data_type=dt.INT16)
-            elif item_type == "U32":
-                reg = rawdata.registers[offset : offset + 2]
+            elif item_type == RegisterType.U32:
+                reg = words[offset : offset + 2]
                 val = self._modbus_client.convert_from_registers(
                     registers=reg, data_type=dt.UINT32
                 )
-            elif item_type == "I32":
-                reg = rawdata.registers[offset : offset + 2]
+            elif item_type == RegisterType.I32:
+                reg = words[offset : offset + 2]
                 val = self._modbus_client.convert_from_registers(registers=reg, data_type=dt.INT32)
-            elif item_type == "BYTE":
-                if item_length == 1:
-                    reg1 = int(rawdata.registers[offset])
-                    val = f"{reg1 >> 8:02d} {reg1 & 0xFF:02d}"
-                elif item_length == 2:
-                    reg1 = int(rawdata.registers[offset])
-                    reg2 = int(rawdata.registers[offset + 1])
-                    val = f"{reg1 >> 8:02d} {reg1 & 0xFF:02d}  {reg2 >> 8:02d} {reg2 & 0xFF:02d}"
-                elif item_length == 4:
-                    reg1 = int(rawdata.registers[offset])
-                    reg2 = int(rawdata.registers[offset + 1])
-                    reg3 = int(rawdata.registers[offset + 2])
-                    reg4 = int(rawdata.registers[offset + 3])
-                    val = (
-                        f"{reg1 >> 8:02d} {reg1 & 0xFF:02d} {reg2 >> 8:02d} {reg2 & 0xFF:02d}  "
-                        f"{reg3 >> 8:02d} {reg3 & 0xFF:02d} {reg4 >> 8:02d} {reg4 & 0xFF:02d}"
-                    )
-                else:
+            elif item_type == RegisterType.BYTE:
+                if item_length not in (1, 2, 4):
                     _LOGGER.error("Unsupported BYTE length: %s", item_length)
-                    return {}
-            elif item_type == "BIT":
-                if item_length == 1:
-                    reg1 = int(rawdata.registers[offset])
-                    val = f"{reg1:016b}"
-                elif item_length == 2:
-                    reg1 = int(rawdata.registers[offset])
-                    reg2 = int(rawdata.registers[offset + 1])
-                    val = f"{reg1:016b} {reg2:016b}"
-                else:
-                    # support generic N registers as concatenated 16-bit groups
-                    bits = [
-                        f"{int(rawdata.registers[offset + i]):016b}" for i in range(item_length)
-                    ]
-                    val = " ".join(bits)
-            elif item_type == "DAT":
-                if offset + 3 > len(rawdata.registers):
+                    return None
+                val = tuple(
+                    byte
+                    for word in words[offset : offset + item_length]
+                    for byte in (int(word) >> 8, int(word) & 0xFF)
+                )
+            elif item_type == RegisterType.BIT:
+                # registers are concatenated to one bit field, first register is most significant
+                val = 0
+                for word in words[offset : offset + item_length]:
+                    val = (val << 16) | int(word)
+            elif item_type == RegisterType.DAT:
+                if offset + 3 > len(words):
                     _LOGGER.error("DAT requires 3 registers but not enough data available")
-                    return {}
-                reg1 = int(rawdata.registers[offset])
-                reg2 = int(rawdata.registers[offset + 1])
-                reg3 = int(rawdata.registers[offset + 2])
-                val = (
-                    f"{reg1 >> 8:02d}-{reg1 & 0xFF:02d}-{reg2 >> 8:02d} "
-                    f"{reg2 & 0xFF:02d}:{reg3 >> 8:02d}:{reg3 & 0xFF:02d}"
+                    return None
+                val = decode_date(
+                    value=tuple(
+                        byte
+                        for word in words[offset : offset + 3]
+                        for byte in (int(word) >> 8, int(word) & 0xFF)
+                    )
                 )
-            elif item_type == "STR":
+            elif item_type == RegisterType.STR:
                 # item_length defines number of 16-bit registers to read
-                reg = rawdata.registers[offset : offset + item_length]
+                reg = words[offset : offset + item_length]
                 sval = self._modbus_client.convert_from_registers(
                     registers=reg, data_type=dt.STRING
                 )
@@ -378,24 +924,20 @@ class MTECModbusClient:
                     val = sval
             else:
                 _LOGGER.error("Unknown type %s to decode", item_type)
-                return {}
+                return None
 
             # apply scaling to numeric values
-            item_scale = int(item.get(Register.SCALE, 1))
-            if item_scale > 1 and isinstance(val, (int, float)):
+            item_scale = item.scale
+            if item_scale > 1 and item_type != RegisterType.BIT and isinstance(val, (int, float)):
                 val = float(val) / item_scale
-
-            return {
-                Register.NAME: item[Register.NAME],
-                Register.VALUE: val,
-                Register.UNIT: item.get(Register.UNIT, ""),
-            }
         except Exception as ex:
             _LOGGER.error(
                 "Exception while decoding data (type=%s, offset=%s, length=%s): %s",
-                item.get(Register.TYPE),
+                item.type,
                 offset,
-                item.get(Register.LENGTH),
+                item.length,
                 ex,
             )
-            return {}
+            return None
+        else:
+            return val
@@ -0,0 +1,207 @@
+"""
+Modbus TCP proxy server.
+
+The modbus gateway of the inverter handles concurrent clients poorly. The proxy
+lets other modbus clients (evcc, the HA modbus integration, mtec_util) share the
+single upstream connection of mtec2mqtt:
+
+- reads are answered from the latest raw words of the poll cycles, as long as
+  they are not older than the configured max age
+- other reads and all writes are forwarded through the upstream connection,
+  one request at a time. Errors of forwarded reads don't count as errors of the
+  poll cycle, and the exception code of the device is passed to the client
+
+Supported are the function codes 3/4 (read holding/input registers), 6 (write
+single register) and 16 (write multiple registers). The cache holds holding
+registers only, so reads of input registers are always forwarded as such. The
+unit id of a request is ignored, the configured MODBUS_SLAVE is used upstream.
+
+(c) 2024 by SukramJ
+"""
+
+from __future__ import annotations
+
+import logging
+import socketserver
+import struct
+import threading
+from typing import TYPE_CHECKING, Final
+
+if TYPE_CHECKING:
+    from mtec2mqtt.modbus_client import MTECModbusClient
+
+_LOGGER: Final = logging.getLogger(__name__)
+
+_MBAP_HEADER: Final = struct.Struct(">HHHB")
+_ADDRESS_COUNT: Final = struct.Struct(">HH")
+# Max PDU size of modbus TCP
+_MAX_PDU_LENGTH: Final = 253
+_MAX_READ_COUNT: Final = 125
+_MAX_WRITE_COUNT: Final = 123
+
+_FC_READ_HOLDING_REGISTERS: Final = 0x03
+_FC_READ_INPUT_REGISTERS: Final = 0x04
+_FC_WRITE_SINGLE_REGISTER: Final = 0x06
+_FC_WRITE_MULTIPLE_REGISTERS: Final = 0x10
+
+_EX_ILLEGAL_FUNCTION: Final = 0x01
+_EX_ILLEGAL_DATA_ADDRESS: Final = 0x02
+_EX_ILLEGAL_DATA_VALUE: Final = 0x03
+_EX_GATEWAY_TARGET_FAILED: Final = 0x0B
+
+
+class ModbusProxy:
+    """Modbus TCP server, which is backed by the word cache of the modbus client."""
+
+    def __init__(
+        self, modbus_client: MTECModbusClient, host: str, port: int, max_age: float
+    ) -> None:
+        """Init the modbus proxy."""
+        self._modbus_client: Final = modbus_client
+        self._host: Final = host
+        self._port: Final = port
+        self._max_age: Final = max_age
+        self._server: socketserver.ThreadingTCPServer | None = None
+        self._cache_hits = 0
+        self._cache_misses = 0
+
+    def start(self) -> None:
+        """Start the proxy server in a background thread."""
+        proxy = self
+
+        class _Handler(_RequestHandler):
+            modbus_proxy = proxy
+
+        try:
+            self._server = socketserver.ThreadingTCPServer(
+                (self._host, self._port), _Handler, bind_and_activate=False
+            )
+            self._server.allow_reuse_address = True
+            self._server.daemon_threads = True
+            self._server.server_bind()
+            self._server.server_activate()
+        except OSError as ex:
+            _LOGGER.error("Couldn't start modbus proxy on %s:%i: %s", self._host, self._port, ex)
+            self._server = None
+            return
+        threading.Thread(
+            target=self._server.serve_forever, name="mtec2mqtt-modbus-proxy", daemon=True
+        ).start()
+        _LOGGER.info(
+            "Modbus proxy listening on %s:%i (max age %ss)", self._host, self._port, self._max_age
+        )
+
+    def stop(self) -> None:
+        """Stop the proxy server."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            _LOGGER.debug(
+                "Modbus proxy stopped (cache hits %i, misses %i)",
+                self._cache_hits,
+                self._cache_misses,
+            )
+
+    def handle_pdu(self, pdu: bytes) -> bytes:
+        """Handle a request PDU and return the response PDU."""
+        function_code = pdu[0]
+        if function_code in (_FC_READ_HOLDING_REGISTERS, _FC_READ_INPUT_REGISTERS):
+            return self._read(pdu=pdu)
+        if function_code == _FC_WRITE_SINGLE_REGISTER:
+            return self._write_single(pdu=pdu)
+        if function_code == _FC_WRITE_MULTIPLE_REGISTERS:
+            return self._write_multiple(pdu=pdu)
+        return _exception(function_code=function_code, code=_EX_ILLEGAL_FUNCTION)
+
+    def _read(self, pdu: bytes) -> bytes:
+        """Read registers, holding registers from the cache if possible."""
+        function_code = pdu[0]
+        if len(pdu) != 5:
+            return _exception(function_code=function_code, code=_EX_ILLEGAL_DATA_VALUE)
+        address, count = _ADDRESS_COUNT.unpack_from(pdu, 1)
+        if not 1 <= count <= _MAX_READ_COUNT:
+            return _exception(function_code=function_code, code=_EX_ILLEGAL_DATA_VALUE)
+        if address + count > 0x10000:
+            return _exception(function_code=function_code, code=_EX_ILLEGAL_DATA_ADDRESS)
+        client = self._modbus_client
+        if function_code == _FC_READ_INPUT_REGISTERS:
+            _LOGGER.debug("Modbus proxy: forwarding input read of %s, length %s", address, count)
+            result = client.probe_registers(address=address, count=count, input_registers=True)
+        elif (cache := client.word_cache) is not None and (
+            words := cache.get(address=address, count=count, max_age=self._max_age)
+        ) is not None:
+            self._cache_hits += 1
+            result = words
+        else:
+            self._cache_misses += 1
+            _LOGGER.debug("Modbus proxy: forwarding read of %s, length %s", address, count)
+            result = client.read_words(address=address, count=count, max_age=0.0)
+        if result is None:
+            return _exception(function_code=function_code, code=_EX_GATEWAY_TARGET_FAILED)
+        if isinstance(result, int):
+            # pass the exception of the device, e.g. an illegal data address
+            return _exception(
+                function_code=function_code, code=result or _EX_GATEWAY_TARGET_FAILED
+            )
+        return struct.pack(f">BB{count}H", function_code, 2 * count, *result)
+
+    def _write_single(self, pdu: bytes) -> bytes:
+        """Write a single register."""
+        if len(pdu) != 5:
+            return _exception(function_code=pdu[0], code=_EX_ILLEGAL_DATA_VALUE)
+        address, value = _ADDRESS_COUNT.unpack_from(pdu, 1)
+        return self._write(pdu=pdu, address=address, values=[value], response=pdu)
+
+    def _write_multiple(self, pdu: bytes) -> bytes:
+        """Write multiple registers."""
+        if len(pdu) < 6:
+            return _exception(function_code=pdu[0], code=_EX_ILLEGAL_DATA_VALUE)
+        address, count = _ADDRESS_COUNT.unpack_from(pdu, 1)
+        if not 1 <= count <= _MAX_WRITE_COUNT or pdu[5] != 2 * count or len(pdu) != 6 + 2 * count:
+            return _exception(function_code=pdu[0], code=_EX_ILLEGAL_DATA_VALUE)
+        values = list(struct.unpack_from(f">{count}H", pdu, 6))
+        return self._write(pdu=pdu, address=address, values=values, response=pdu[:5])
+
+    def _write(self, pdu: bytes, address: int, values: list[int], response: bytes) -> bytes:
+        """Forward a write to the upstream connection."""
+        client = self._modbus_client
+        _LOGGER.debug("Modbus proxy: forwarding write of %s, length %s", address, len(values))
+        if not client.is_writable(address=address, count=len(values)):
+            return _exception(function_code=pdu[0], code=_EX_ILLEGAL_DATA_ADDRESS)
+        if not client.write_words(address=address, values=values):
+            return _exception(function_code=pdu[0], code=_EX_GATEWAY_TARGET_FAILED)
+        return response
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Handler of a modbus TCP connection."""
+
+    modbus_proxy: ModbusProxy
+
+    def handle(self) -> None:
+        """Handle the requests of a connection until it is closed."""
+        _LOGGER.debug("Modbus proxy: client %s connected", self.client_address[0])
+        try:
+            while header := self.rfile.read(_MBAP_HEADER.size):
+                if len(header) < _MBAP_HEADER.size:
+                    break
+                transaction_id, protocol_id, length, unit_id = _MBAP_HEADER.unpack(header)
+                if protocol_id != 0 or not 2 <= length <= _MAX_PDU_LENGTH + 1:
+                    _LOGGER.debug("Modbus proxy: invalid frame from %s", self.client_address[0])
+                    break
+                if len(pdu := self.rfile.read(length - 1)) < length - 1:
+                    break
+                response = self.modbus_proxy.handle_pdu(pdu=pdu)
+                self.wfile.write(
+                    _MBAP_HEADER.pack(transaction_id, 0, len(response) + 1, unit_id) + response
+                )
+        except OSError:
+            # client disconnected
+            pass
+        _LOGGER.debug("Modbus proxy: client %s disconnected", self.client_address[0])
+
+
+def _exception(function_code: int, code: int) -> bytes:
+    """Return an exception response PDU."""
+    return bytes((function_code | 0x80, code))
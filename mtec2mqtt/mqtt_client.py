@@ -6,6 +6,20 @@ publication (with optional retain), and topic subscription bookkeeping. It is
 used by the coordinator and, when enabled, integrates with Home Assistant by
 subscribing to its status topic so discovery can be coordinated.
 
+With MQTT v5 enabled, frequently published topics get topic aliases, non
+retained messages carry a message expiry interval, and the acquisition
+timestamp is sent as user property.
+
+If the broker can't keep up, load is shed by priority: above a soft limit of
+messages waiting to be sent, only the latest message of a topic with normal
+priority is kept, above a hard limit low priority messages are delayed as well.
+Critical messages are always handed to paho. The held back messages are sent
+by a worker thread, once the queue has drained.
+
+With a spool directory, messages are written to a disk-backed spool while the
+broker is unreachable or too many messages are waiting to be sent, and are
+replayed in order with a rate limit after the connection is back.
+
 (c) 2024 by Christian Rödel
 (c) 2024 by SukramJ
 """
@@ -19,14 +33,35 @@ import threading
 from typing import Any, Final
 
 from paho.mqtt import client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
 from mtec2mqtt import hass_int
-from mtec2mqtt.const import CLIENT_ID, Config
+from mtec2mqtt.const import (
+    CLIENT_ID,
+    DEFAULT_MQTT_QUEUE_HARD_LIMIT,
+    DEFAULT_MQTT_QUEUE_SOFT_LIMIT,
+    DEFAULT_MQTT_SPOOL_HIGH_WATER,
+    DEFAULT_MQTT_SPOOL_MAX_SIZE,
+    DEFAULT_MQTT_SPOOL_RATE,
+    MQTT_DEFAULT_MESSAGE_EXPIRY,
+    MQTT_PROTOCOL_V5,
+    MQTT_PROTOCOL_V311,
+    MQTT_SPOOL_LATEST_ONLY_DEFAULT,
+    MQTT_USER_PROPERTY_TIMESTAMP,
+    Config,
+    PublishPriority,
+)
 from mtec2mqtt.exceptions import MtecException
+from mtec2mqtt.mqtt_spool import MqttSpool
+from mtec2mqtt.rate_limit import TokenBucket
 
 DEFAULT_RETAIN: bool = False
 _LOGGER: Final = logging.getLogger(__name__)
 
+# payload, retain, timestamp, use_alias of a held back message
+_HeldMessage = tuple[str | bytes, bool, str | None, bool]
+
 
 class MqttClient:
     """Client for mqtt."""
@@ -36,27 +71,98 @@ class MqttClient:
         config: dict[str, Any],
         on_mqtt_message: Callable[[mqtt.Client, Any, mqtt.MQTTMessage], None],
         hass: hass_int.HassIntegration | None = None,
+        on_reconnect: Callable[[], None] | None = None,
     ) -> None:
-        """Init the mqtt client."""
+        """Init the mqtt client. on_reconnect is called, when a lost connection is back."""
         self._on_mqtt_message = on_mqtt_message
         self._hass = hass
+        self._on_reconnect = on_reconnect
         self._username: Final[str] = config[Config.MQTT_LOGIN]
         self._password: Final[str] = config[Config.MQTT_PASSWORD]
         self._hostname: Final[str] = config[Config.MQTT_SERVER]
         self._port: Final[int] = config[Config.MQTT_PORT]
         self._hass_status_topic: Final[str] = f"{config[Config.HASS_BASE_TOPIC]}/status"
-        self._client = self._initialize_client()
+        self._protocol_v5: Final[bool] = (
+            str(config.get(Config.MQTT_PROTOCOL, MQTT_PROTOCOL_V311)) == MQTT_PROTOCOL_V5
+        )
+        self._message_expiry: Final[int] = int(
+            config.get(Config.MQTT_MESSAGE_EXPIRY, MQTT_DEFAULT_MESSAGE_EXPIRY)
+        )
+        # Topic aliases are only valid for one connection; limit is announced by the broker
+        self._topic_alias_maximum: int = 0
+        self._topic_aliases: dict[str, int] = {}
         self._subscribed_topics: set[str] = set()
         self._connected: bool = False
+        self._has_connected: bool = False
         self._lock: Final = threading.RLock()
+        # mids of messages, which have been handed to paho but not yet sent, and of messages,
+        # which have been sent before they were added to the pending ones
+        self._pending: Final[set[int]] = set()
+        self._sent: Final[set[int]] = set()
+        self._soft_limit: Final[int] = config.get(
+            Config.MQTT_QUEUE_SOFT_LIMIT, DEFAULT_MQTT_QUEUE_SOFT_LIMIT
+        )
+        self._hard_limit: Final[int] = max(
+            self._soft_limit,
+            config.get(Config.MQTT_QUEUE_HARD_LIMIT, DEFAULT_MQTT_QUEUE_HARD_LIMIT),
+        )
+        # Held back messages by topic under pressure: coalesced normal and delayed low priority
+        self._coalesced: Final[dict[str, _HeldMessage]] = {}
+        self._delayed: Final[dict[str, _HeldMessage]] = {}
+        self._under_pressure = False
+        self._shed_count = 0
+        # Messages refused by paho without a spool, e.g. while disconnected
+        self._dropped_count = 0
+        self._spool: Final = self._initialize_spool(config=config)
+        self._spool_high_water: Final[int] = config.get(
+            Config.MQTT_SPOOL_HIGH_WATER, DEFAULT_MQTT_SPOOL_HIGH_WATER
+        )
+        self._replay_bucket: Final = TokenBucket(
+            rate=(rate := config.get(Config.MQTT_SPOOL_RATE, DEFAULT_MQTT_SPOOL_RATE)),
+            burst=max(1, int(rate)),
+        )
+        self._drain_event: Final = threading.Event()
+        self._running = True
+        self._client = self._initialize_client()
+        # Sends the held back and spooled messages
+        self._drain_thread: Final = threading.Thread(
+            target=self._drain, name="mqtt-drain", daemon=True
+        )
+        self._drain_thread.start()
+
+    @property
+    def is_connected(self) -> bool:
+        """Return True if connected to the broker."""
+        return self._connected
+
+    @property
+    def protocol_v5(self) -> bool:
+        """Return True if MQTT v5 is used."""
+        return self._protocol_v5
 
     def _on_mqtt_connect(
-        self, mqttclient: mqtt.Client, userdata: Any, flags: Any, rc: int
+        self,
+        mqttclient: mqtt.Client,
+        userdata: Any,
+        flags: Any,
+        rc: int,
+        properties: Any = None,
     ) -> None:
         """Handle mqtt connect."""
         if rc == 0:
-            self._connected = True
-            _LOGGER.info("Connected to MQTT broker")
+            with self._lock:
+                self._topic_aliases.clear()
+                self._topic_alias_maximum = int(getattr(properties, "TopicAliasMaximum", 0))
+                # messages of the previous connection are either resent or dropped by paho
+                self._pending.clear()
+                self._sent.clear()
+                self._connected = True
+            self._drain_event.set()
+            _LOGGER.info(
+                "Connected to MQTT broker (protocol=%s, topic aliases=%i)",
+                MQTT_PROTOCOL_V5 if self._protocol_v5 else MQTT_PROTOCOL_V311,
+                self._topic_alias_maximum,
+            )
             # Subscribe to HA status topic and any user-requested topics
             try:
                 if self._hass:
@@ -66,22 +172,70 @@ class MqttClient:
                         mqttclient.subscribe(topic=topic)
             except Exception as ex:  # defensive: avoid breaking network loop
                 _LOGGER.warning("Post-connect subscription failed: %s", ex)
+            # A broker without persistence lost the retained messages
+            if self._has_connected and self._on_reconnect is not None:
+                self._on_reconnect()
+            self._has_connected = True
         else:
             _LOGGER.error("Error while connecting to MQTT broker: rc=%s", rc)
 
-    def _on_mqtt_disconnect(self, mqttclient: mqtt.Client, userdata: Any, rc: int) -> None:
-        self._connected = False
+    def _on_mqtt_disconnect(
+        self, mqttclient: mqtt.Client, userdata: Any, rc: int, properties: Any = None
+    ) -> None:
+        with self._lock:
+            self._connected = False
+            self._topic_aliases.clear()
         _LOGGER.warning("MQTT broker disconnected: rc=%s", rc)
 
     def _on_mqtt_subscribe(
-        self, mqttclient: mqtt.Client, userdata: Any, mid: int, granted_qos: Any
+        self,
+        mqttclient: mqtt.Client,
+        userdata: Any,
+        mid: int,
+        granted_qos: Any,
+        properties: Any = None,
     ) -> None:
         _LOGGER.info("MQTT broker subscribed to mid %s", mid)
 
+    def _on_mqtt_publish(self, mqttclient: mqtt.Client, userdata: Any, mid: int) -> None:
+        """Handle a sent message."""
+        with self._lock:
+            if mid in self._pending:
+                self._pending.discard(mid)
+            else:
+                self._sent.add(mid)
+            drained = len(self._pending) < self._soft_limit
+        if drained:
+            self._drain_event.set()
+
+    def _initialize_spool(self, config: dict[str, Any]) -> MqttSpool | None:
+        """Open the spool, if a spool directory is configured."""
+        if not (spool_dir := config.get(Config.MQTT_SPOOL_DIR)):
+            return None
+        groups = config.get(Config.MQTT_SPOOL_LATEST_ONLY, MQTT_SPOOL_LATEST_ONLY_DEFAULT)
+        try:
+            return MqttSpool(
+                path=spool_dir,
+                max_size=int(
+                    1024
+                    * 1024
+                    * config.get(Config.MQTT_SPOOL_MAX_SIZE, DEFAULT_MQTT_SPOOL_MAX_SIZE)
+                ),
+                latest_only=[f"{config[Config.MQTT_TOPIC]}/+/{group}/#" for group in groups],
+            )
+        except OSError as ex:
+            _LOGGER.error("Couldn't open MQTT spool %s, spooling disabled: %s", spool_dir, ex)
+            return None
+
     def _initialize_client(self) -> mqtt.Client:
         """Initialize and start the MQTT client (non-blocking, with auto-reconnect)."""
         try:
-            client = mqtt.Client(client_id=CLIENT_ID, protocol=mqtt.MQTTv311, clean_session=True)
+            if self._protocol_v5:
+                client = mqtt.Client(client_id=CLIENT_ID, protocol=mqtt.MQTTv5)
+            else:
+                client = mqtt.Client(
+                    client_id=CLIENT_ID, protocol=mqtt.MQTTv311, clean_session=True
+                )
             client.username_pw_set(username=self._username, password=self._password)
             # Route paho internal logs into our logger (useful for debugging)
             with contextlib.suppress(Exception):
@@ -91,6 +245,7 @@ class MqttClient:
             client.on_message = self._on_mqtt_message
             client.on_subscribe = self._on_mqtt_subscribe
             client.on_disconnect = self._on_mqtt_disconnect
+            client.on_publish = self._on_mqtt_publish
 
             # Set a Last Will and Testament to signal unexpected offline state
             client.will_set(
@@ -109,7 +264,12 @@ class MqttClient:
                 client.queue_qos0_messages = True  # type: ignore[attr-defined]
 
             # Use async connect to avoid blocking and enable auto-reconnect in loop
-            client.connect_async(host=self._hostname, port=self._port, keepalive=60)
+            if self._protocol_v5:
+                client.connect_async(
+                    host=self._hostname, port=self._port, keepalive=60, clean_start=True
+                )
+            else:
+                client.connect_async(host=self._hostname, port=self._port, keepalive=60)
 
             # Start network loop after initiating connection
             client.loop_start()
@@ -123,6 +283,9 @@ class MqttClient:
 
     def stop(self) -> None:
         """Stop the MQTT client."""
+        self._running = False
+        self._drain_event.set()
+        self._drain_thread.join(timeout=5)
         try:
             # Unsubscribe only if connected to avoid unnecessary errors
             with self._lock:
@@ -142,19 +305,250 @@ class MqttClient:
             self._client.on_message = None
             self._client.on_subscribe = None
             self._client.on_disconnect = None
+            self._client.on_publish = None
 
+            if self._spool is not None:
+                self._spool.close()
             _LOGGER.info("MQTT server stopped")
         except Exception as ex:
             _LOGGER.warning("Couldn't stop MQTT: %s", ex)
 
-    def publish(self, topic: str, payload: str, retain: bool = DEFAULT_RETAIN) -> None:
-        """Publish mqtt message."""
+    def publish(
+        self,
+        topic: str,
+        payload: str | bytes,
+        retain: bool = DEFAULT_RETAIN,
+        timestamp: str | None = None,
+        use_alias: bool = False,
+        *,
+        priority: PublishPriority = PublishPriority.CRITICAL,
+    ) -> bool:
+        """
+        Publish mqtt message.
+
+        timestamp and use_alias are only used with MQTT v5: The timestamp is sent as
+        user property and use_alias marks frequently published topics for topic aliases.
+        The priority decides, whether the message may be held back, if the broker can't
+        keep up. Returns False if the message has been dropped.
+        """
         _LOGGER.debug("- %s: %s", topic, str(payload))
         try:
-            # paho will queue messages (including QoS0) while offline due to our configuration
-            self._client.publish(topic=topic, payload=payload, qos=0, retain=retain)
+            if self._spool is not None and self._should_spool():
+                self._spool.append(
+                    topic=topic, payload=payload, retain=retain, timestamp=timestamp
+                )
+                return True
+            if self._hold_back(
+                topic=topic,
+                message=(payload, retain, timestamp, use_alias),
+                priority=priority,
+            ):
+                return True
+            if self._send(
+                topic=topic,
+                payload=payload,
+                retain=retain,
+                timestamp=timestamp,
+                use_alias=use_alias,
+            ):
+                return True
+            if self._spool is not None:
+                # paho refused the message, e.g. as the connection has just been lost
+                self._spool.append(
+                    topic=topic, payload=payload, retain=retain, timestamp=timestamp
+                )
+                return True
         except Exception as ex:
             _LOGGER.error("Couldn't send MQTT command: %s", ex)
+            return False
+        with self._lock:
+            self._dropped_count += 1
+            if self._dropped_count == 1:
+                _LOGGER.warning(
+                    "MQTT client refused message to %s, dropping messages until it accepts "
+                    "them again",
+                    topic,
+                )
+        return False
+
+    def _send(
+        self,
+        topic: str,
+        payload: str | bytes,
+        retain: bool,
+        timestamp: str | None,
+        use_alias: bool,
+    ) -> bool:
+        """Hand a message to paho. Returns False if paho didn't accept it."""
+        properties: Properties | None = None
+        # The topic aliases are reset on (dis)connect with the lock held, so a message with an
+        # alias is queued by paho for the connection the alias belongs to. paho drops the
+        # messages of a lost connection on reconnect, so they never reach the next one.
+        with self._lock:
+            alias_count = len(self._topic_aliases)
+            if self._protocol_v5:
+                topic, properties = self._get_v5_publish_args(
+                    topic=topic, retain=retain, timestamp=timestamp, use_alias=use_alias
+                )
+            # paho will queue messages (including QoS0) while offline due to our configuration
+            info = self._client.publish(
+                topic=topic, payload=payload, qos=0, retain=retain, properties=properties
+            )
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                if len(self._topic_aliases) > alias_count:
+                    # the broker didn't get the topic of the new alias
+                    self._topic_aliases.pop(topic, None)
+                return False
+        with self._lock:
+            # the message may have been sent before publish returned
+            if info.mid in self._sent:
+                self._sent.discard(info.mid)
+            else:
+                self._pending.add(info.mid)
+            if self._dropped_count:
+                _LOGGER.warning(
+                    "MQTT client accepts messages again, %i dropped", self._dropped_count
+                )
+                self._dropped_count = 0
+        return True
+
+    def _hold_back(self, topic: str, message: _HeldMessage, priority: PublishPriority) -> bool:
+        """
+        Hold back a message, if too many messages are waiting to be sent.
+
+        Returns True if the message has been held back. An older held back message of
+        the topic is replaced, so only the latest one is sent.
+        """
+        if priority == PublishPriority.CRITICAL:
+            return False
+        with self._lock:
+            pending = len(self._pending)
+            if priority == PublishPriority.NORMAL and pending >= self._soft_limit:
+                held = self._coalesced
+            elif priority == PublishPriority.LOW and pending >= self._hard_limit:
+                held = self._delayed
+            else:
+                # the new message supersedes a held back one
+                self._coalesced.pop(topic, None)
+                self._delayed.pop(topic, None)
+                return False
+            if topic in held:
+                self._shed_count += 1
+            held[topic] = message
+            if not self._under_pressure:
+                self._under_pressure = True
+                _LOGGER.debug(
+                    "MQTT broker can't keep up (%i messages waiting), holding back updates",
+                    pending,
+                )
+        return True
+
+    def _should_spool(self) -> bool:
+        """
+        Return True if a message has to be spooled.
+
+        That is while the broker is unreachable, too many messages are waiting to be sent
+        by paho, or the spool isn't replayed completely, which keeps the messages in order.
+        """
+        if not self._connected or (self._spool is not None and not self._spool.is_empty):
+            return True
+        with self._lock:
+            return len(self._pending) >= self._spool_high_water
+
+    def _drain(self) -> None:
+        """Send the held back and the spooled messages, once the queue has drained."""
+        while self._running:
+            self._drain_event.wait(timeout=1.0)
+            self._drain_event.clear()
+            if not self._connected:
+                continue
+            self._send_held_back()
+            if self._spool is not None:
+                self._replay_spool(spool=self._spool)
+
+    def _send_held_back(self) -> None:
+        """Send held back messages, coalesced ones first, while below the soft limit."""
+        while self._running and self._connected:
+            with self._lock:
+                if len(self._pending) >= self._soft_limit:
+                    return
+                held = self._coalesced or self._delayed
+                if not held:
+                    if self._under_pressure:
+                        self._under_pressure = False
+                        if self._shed_count:
+                            _LOGGER.warning(
+                                "MQTT broker couldn't keep up, %i intermediate updates dropped",
+                                self._shed_count,
+                            )
+                        self._shed_count = 0
+                    return
+                topic = next(iter(held))
+                payload, retain, timestamp, use_alias = held.pop(topic)
+            if not self._send(
+                topic=topic,
+                payload=payload,
+                retain=retain,
+                timestamp=timestamp,
+                use_alias=use_alias,
+            ):
+                with self._lock:
+                    # keep it, unless a newer message of the topic has been held back meanwhile
+                    held.setdefault(topic, (payload, retain, timestamp, use_alias))
+                return
+
+    def _replay_spool(self, spool: MqttSpool) -> None:
+        """Replay the spooled messages, while the broker is connected."""
+        while self._running and self._connected:
+            with self._lock:
+                room = self._spool_high_water - len(self._pending)
+            if room <= 0 or not (
+                messages := spool.read(max_count=min(room, self._replay_bucket.burst))
+            ):
+                return
+            sent = 0
+            for topic, payload, retain, timestamp in messages:
+                self._replay_bucket.acquire()
+                if not self._connected or not self._send(
+                    topic=topic,
+                    payload=payload,
+                    retain=retain,
+                    timestamp=timestamp,
+                    use_alias=False,
+                ):
+                    break
+                sent += 1
+            spool.commit(count=sent)
+            if spool.is_empty:
+                _LOGGER.info("MQTT spool replayed completely")
+
+    def _get_v5_publish_args(
+        self, topic: str, retain: bool, timestamp: str | None, use_alias: bool
+    ) -> tuple[str, Properties | None]:
+        """Return the topic and publish properties for MQTT v5."""
+        properties = Properties(PacketTypes.PUBLISH)  # type: ignore[no-untyped-call]
+        has_properties = False
+        if not retain and self._message_expiry > 0:
+            properties.MessageExpiryInterval = self._message_expiry
+            has_properties = True
+        if timestamp:
+            properties.UserProperty = (MQTT_USER_PROPERTY_TIMESTAMP, timestamp)
+            has_properties = True
+        # Aliases are only used while connected, as they are bound to the current connection.
+        # Must be called with the lock held until the message is handed to paho.
+        if use_alias and self._connected:
+            if (alias := self._topic_aliases.get(topic)) is not None:
+                # Alias is known by the broker: the topic can be sent empty
+                properties.TopicAlias = alias
+                topic = ""
+                has_properties = True
+            elif len(self._topic_aliases) < self._topic_alias_maximum:
+                # Register new alias by sending it together with the full topic once
+                alias = len(self._topic_aliases) + 1
+                self._topic_aliases[topic] = alias
+                properties.TopicAlias = alias
+                has_properties = True
+        return topic, properties if has_properties else None
 
     def subscribe_to_topic(self, topic: str) -> None:
         """Subscribe on topic."""
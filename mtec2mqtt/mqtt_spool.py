@@ -0,0 +1,366 @@
+"""
+Disk-backed spool for MQTT messages, which can't be sent to the broker.
+
+Messages are appended to segment files (one JSON object per line) and replayed
+in order, once the broker is reachable again. The segments are bounded in size
+and count: if the spool exceeds its max size, the oldest segment is dropped.
+
+Topics, for which only the latest message matters (retained messages and the
+configured state topics), are not logged. Only their latest message is kept and
+replayed after the logged messages.
+
+Binary payloads are stored base64 encoded.
+
+Files of the spool directory:
+    <n>.spool     segment with sequence number n
+    position      segment and byte offset of the next message to replay
+    latest.json   latest message of every latest-only topic
+
+(c) 2024 by SukramJ
+"""
+
+from __future__ import annotations
+
+import base64
+from collections.abc import Iterable
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Any, BinaryIO, Final
+
+from paho.mqtt.client import topic_matches_sub
+
+from mtec2mqtt.const import UTF8
+
+_LOGGER: Final = logging.getLogger(__name__)
+
+_SEGMENT_SUFFIX: Final = ".spool"
+_POSITION_FILE: Final = "position"
+_LATEST_FILE: Final = "latest.json"
+# Size of a segment, before a new one is started
+_SEGMENT_SIZE: Final = 1024 * 1024
+# Min. interval (s) between two writes of the latest messages
+_LATEST_SAVE_INTERVAL: Final = 5.0
+
+# topic, payload, retain, timestamp
+SpoolMessage = tuple[str, str | bytes, bool, str | None]
+# key of a base64 encoded binary payload
+_BASE64_KEY: Final = "b64"
+
+
+class MqttSpool:
+    """Append-only spool of MQTT messages on disk."""
+
+    def __init__(
+        self,
+        path: str,
+        max_size: int,
+        latest_only: Iterable[str] = (),
+        segment_size: int = _SEGMENT_SIZE,
+    ) -> None:
+        """
+        Open the spool in directory path, which is created if necessary.
+
+        max_size limits the size of all segments in bytes. latest_only are topic filters
+        of topics, for which only the latest message is kept.
+        """
+        self._path: Final = Path(path)
+        self._path.mkdir(parents=True, exist_ok=True)
+        self._max_size: Final = max(max_size, 2 * segment_size)
+        self._segment_size: Final = segment_size
+        self._latest_only: Final = tuple(latest_only)
+        self._lock: Final = threading.Lock()
+        # size of every segment by sequence number, in order
+        self._segments: Final[dict[int, int]] = {
+            int(file.stem): file.stat().st_size
+            for file in sorted(self._path.glob(f"*{_SEGMENT_SUFFIX}"), key=lambda f: int(f.stem))
+        }
+        self._read_segment, self._read_offset = self._load_position()
+        self._latest: Final[dict[str, SpoolMessage]] = self._load_latest()
+        self._latest_saved = time.monotonic()
+        self._latest_dirty = False
+        self._write_segment = max(self._segments, default=self._read_segment)
+        self._repair_segment(sequence=self._write_segment)
+        self._writer = self._open_segment(sequence=self._write_segment)
+        # positions after the messages of the last read, None for latest-only messages
+        self._read_positions: list[tuple[int, int] | None] = []
+        self._read_latest: list[SpoolMessage] = []
+        self._dropped = 0
+        if not self.is_empty:
+            _LOGGER.info(
+                "MQTT spool %s contains %i bytes and %i latest-only messages to replay",
+                path,
+                self.size,
+                len(self._latest),
+            )
+
+    @property
+    def is_empty(self) -> bool:
+        """Return True if there are no messages to replay."""
+        with self._lock:
+            return self._is_empty()
+
+    @property
+    def size(self) -> int:
+        """Return the size of all segments in bytes."""
+        return sum(self._segments.values())
+
+    def append(
+        self, topic: str, payload: str | bytes, retain: bool, timestamp: str | None
+    ) -> None:
+        """Append a message."""
+        message: SpoolMessage = (topic, payload, retain, timestamp)
+        with self._lock:
+            if retain or any(topic_matches_sub(sub, topic) for sub in self._latest_only):
+                self._latest[topic] = message
+                self._latest_dirty = True
+                self._save_latest(force=False)
+                return
+            line = (json.dumps(_dump_message(message), separators=(",", ":")) + "\n").encode(UTF8)
+            self._writer.write(line)
+            self._writer.flush()
+            self._segments[self._write_segment] += len(line)
+            if self._segments[self._write_segment] >= self._segment_size:
+                self._rotate()
+
+    def read(self, max_count: int) -> list[SpoolMessage]:
+        """
+        Return up to max_count of the next messages to replay.
+
+        The messages are removed from the spool by commit, once they have been sent.
+        Logged messages are returned first, the latest-only messages afterwards.
+        """
+        with self._lock:
+            self._read_positions = []
+            self._read_latest = []
+            messages: list[SpoolMessage] = []
+            segment, offset = self._read_segment, self._read_offset
+            while len(messages) < max_count and segment in self._segments:
+                with (self._path / f"{segment}{_SEGMENT_SUFFIX}").open("rb") as file:
+                    file.seek(offset)
+                    while len(messages) < max_count and (line := file.readline()):
+                        if not line.endswith(b"\n"):
+                            # incomplete line of an interrupted write
+                            break
+                        offset += len(line)
+                        try:
+                            message = _load_message(json.loads(line))
+                        except (TypeError, ValueError):
+                            _LOGGER.warning("Skipping invalid message in MQTT spool: %r", line)
+                            if not messages:
+                                self._read_segment, self._read_offset = segment, offset
+                            continue
+                        messages.append(message)
+                        self._read_positions.append((segment, offset))
+                if len(messages) >= max_count or segment == self._write_segment:
+                    break
+                segment, offset = self._next_segment(segment=segment), 0
+            if (
+                len(messages) < max_count
+                and self._logged_size(segment=segment, offset=offset) == 0
+            ):
+                self._read_latest = list(self._latest.values())[: max_count - len(messages)]
+                messages.extend(self._read_latest)
+                self._read_positions.extend([None] * len(self._read_latest))
+            return messages
+
+    def commit(self, count: int) -> None:
+        """Remove the first count messages of the last read from the spool."""
+        with self._lock:
+            for position in self._read_positions[:count]:
+                # the segment may have been dropped since the read
+                if position is not None and position > (self._read_segment, self._read_offset):
+                    self._read_segment, self._read_offset = position
+            latest_count = sum(1 for position in self._read_positions[:count] if position is None)
+            for message in self._read_latest[:latest_count]:
+                # keep messages, which have been replaced after the read
+                if self._latest.get(message[0]) is message:
+                    del self._latest[message[0]]
+                    self._latest_dirty = True
+            self._read_positions = []
+            self._read_latest = []
+            # remove completely replayed segments
+            for segment in [s for s in self._segments if s < self._read_segment]:
+                self._remove_segment(sequence=segment)
+            if (
+                self._read_segment != self._write_segment
+                and self._read_offset >= self._segments.get(self._read_segment, 0)
+            ):
+                self._remove_segment(sequence=self._read_segment)
+                self._read_segment, self._read_offset = self._next_segment(self._read_segment), 0
+            if self._is_empty():
+                # start over with an empty segment
+                for segment in [s for s in self._segments if s != self._write_segment]:
+                    self._remove_segment(sequence=segment)
+                self._writer.truncate(0)
+                self._segments[self._write_segment] = 0
+                self._read_segment, self._read_offset = self._write_segment, 0
+                if self._dropped:
+                    _LOGGER.warning(
+                        "MQTT spool replayed, %i bytes of messages were dropped", self._dropped
+                    )
+                    self._dropped = 0
+            self._save_position()
+            self._save_latest(force=self._is_empty())
+
+    def close(self) -> None:
+        """Save the state and close the current segment."""
+        with self._lock:
+            self._save_position()
+            self._save_latest(force=True)
+            self._writer.close()
+
+    def _is_empty(self) -> bool:
+        """Return True if there are no messages. Must be called with the lock held."""
+        return not self._latest and self._logged_size(self._read_segment, self._read_offset) == 0
+
+    def _logged_size(self, segment: int, offset: int) -> int:
+        """Return the bytes of logged messages after the position."""
+        return sum(size for s, size in self._segments.items() if s >= segment) - offset
+
+    def _next_segment(self, segment: int) -> int:
+        """Return the sequence number of the segment after segment."""
+        return min((s for s in self._segments if s > segment), default=self._write_segment)
+
+    def _rotate(self) -> None:
+        """Start a new segment and drop the oldest segments, if the spool is too large."""
+        self._writer.close()
+        self._write_segment += 1
+        self._writer = self._open_segment(sequence=self._write_segment)
+        while self.size > self._max_size and len(self._segments) > 1:
+            oldest = min(self._segments)
+            dropped = self._segments[oldest]
+            if oldest == self._read_segment:
+                dropped -= self._read_offset
+                self._read_segment, self._read_offset = self._next_segment(oldest), 0
+            self._remove_segment(sequence=oldest)
+            # warn once per outage
+            log = _LOGGER.debug if self._dropped else _LOGGER.warning
+            self._dropped += dropped
+            log(
+                "MQTT spool is full (%i bytes), dropping the oldest messages (%i bytes so far)",
+                self._max_size,
+                self._dropped,
+            )
+        self._save_position()
+
+    def _open_segment(self, sequence: int) -> BinaryIO:
+        """Open a segment for appending."""
+        self._segments.setdefault(sequence, 0)
+        return (self._path / f"{sequence}{_SEGMENT_SUFFIX}").open("ab")
+
+    def _repair_segment(self, sequence: int) -> None:
+        """Cut off an incomplete last line of a segment, e.g. after a power failure."""
+        if not (size := self._segments.get(sequence, 0)):
+            return
+        file = self._path / f"{sequence}{_SEGMENT_SUFFIX}"
+        data = file.read_bytes()
+        if data.endswith(b"\n"):
+            return
+        end = data.rfind(b"\n") + 1
+        _LOGGER.warning("Removing incomplete message at the end of MQTT spool %s", file)
+        with file.open("r+b") as handle:
+            handle.truncate(end)
+        self._segments[sequence] = end
+        if self._read_segment == sequence:
+            self._read_offset = min(self._read_offset, end)
+        _LOGGER.debug("Repaired segment %s: %i -> %i bytes", file, size, end)
+
+    def _remove_segment(self, sequence: int) -> None:
+        """Delete a segment."""
+        self._segments.pop(sequence, None)
+        (self._path / f"{sequence}{_SEGMENT_SUFFIX}").unlink(missing_ok=True)
+
+    def _load_position(self) -> tuple[int, int]:
+        """Return the saved read position, or the start of the oldest segment."""
+        oldest = min(self._segments, default=0)
+        try:
+            segment, offset = map(int, (self._path / _POSITION_FILE).read_text().split())
+        except (OSError, ValueError):
+            return oldest, 0
+        if segment not in self._segments:
+            return oldest, 0
+        return segment, min(offset, self._segments[segment])
+
+    def _save_position(self) -> None:
+        """Save the read position."""
+        _write_atomic(
+            file=self._path / _POSITION_FILE, data=f"{self._read_segment} {self._read_offset}"
+        )
+
+    def _load_latest(self) -> dict[str, SpoolMessage]:
+        """Return the saved latest-only messages."""
+        try:
+            data = json.loads((self._path / _LATEST_FILE).read_text(encoding=UTF8))
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as ex:
+            _LOGGER.warning("Couldn't load latest messages of MQTT spool: %s", ex)
+            return {}
+        if not isinstance(data, list):
+            _LOGGER.warning("Couldn't load latest messages of MQTT spool: not a list")
+            return {}
+        latest: dict[str, SpoolMessage] = {}
+        for item in data:
+            try:
+                message = _load_message(item)
+            except (TypeError, ValueError):
+                _LOGGER.warning("Skipping invalid latest message in MQTT spool: %r", item)
+                continue
+            latest[message[0]] = message
+        return latest
+
+    def _save_latest(self, force: bool) -> None:
+        """Save the latest-only messages, at most every few seconds unless forced."""
+        if not self._latest_dirty or (
+            not force and time.monotonic() - self._latest_saved < _LATEST_SAVE_INTERVAL
+        ):
+            return
+        _write_atomic(
+            file=self._path / _LATEST_FILE,
+            data=json.dumps(
+                [_dump_message(message) for message in self._latest.values()],
+                separators=(",", ":"),
+            ),
+        )
+        self._latest_saved = time.monotonic()
+        self._latest_dirty = False
+
+
+def _dump_message(message: SpoolMessage) -> list[Any]:
+    """Return the JSON representation of a message."""
+    topic, payload, retain, timestamp = message
+    if isinstance(payload, bytes):
+        return [topic, {_BASE64_KEY: base64.b64encode(payload).decode()}, retain, timestamp]
+    return [topic, payload, retain, timestamp]
+
+
+def _load_message(item: Any) -> SpoolMessage:
+    """
+    Return the message of its JSON representation.
+
+    Raises TypeError or ValueError if it is invalid.
+    """
+    topic, payload, retain, timestamp = item
+    if isinstance(payload, dict):
+        if (encoded := payload.get(_BASE64_KEY)) is None:
+            raise ValueError(f"Invalid payload {payload!r}")
+        payload = base64.b64decode(encoded, validate=True)
+    if (
+        not isinstance(topic, str)
+        or not isinstance(payload, str | bytes)
+        or not isinstance(retain, bool)
+        or not isinstance(timestamp, str | None)
+    ):
+        raise TypeError(f"Invalid message {item!r}")
+    return topic, payload, retain, timestamp
+
+
+def _write_atomic(file: Path, data: str) -> None:
+    """Replace the content of a file atomically."""
+    tmp_file = file.with_suffix(".tmp")
+    tmp_file.write_text(data, encoding=UTF8)
+    os.replace(tmp_file, file)
@@ -12,31 +12,61 @@ shutdown on OS signals.
 
 from __future__ import annotations
 
+from collections.abc import Callable, Mapping
 import contextlib
-from datetime import datetime, timedelta
+from datetime import datetime
+from functools import partial
 import logging
+import math
 import signal
+import sys
 import threading
 import time
 from typing import Any, Final
 
 from paho.mqtt import client as paho
 
-from mtec2mqtt import hass_int, modbus_client, mqtt_client
+from mtec2mqtt import (
+    hass_int,
+    http_api,
+    modbus_client,
+    modbus_proxy,
+    mqtt_client,
+    publisher,
+    shared_snapshot,
+    sinks,
+)
 from mtec2mqtt.config import init_config, init_register_map
 from mtec2mqtt.const import (
+    DEFAULT_FAST_LANE_INTERVAL,
+    DEFAULT_HTTP_API_HOST,
+    DEFAULT_MODBUS_PROXY_HOST,
+    DEFAULT_MODBUS_PROXY_MAX_AGE,
+    DEFAULT_MQTT_REPLAY_RATE,
     EQUIPMENT,
+    HASS_DISCOVERY_DEFAULTS,
+    MQTT_REFRESH_COMMAND,
     REFRESH_DEFAULTS,
+    SCHEDULER_WEIGHTS_DEFAULT,
     SECONDARY_REGISTER_GROUPS,
     UTF8,
     Config,
+    MqttPayloadFormat,
     Register,
     RegisterGroup,
+    RegisterType,
 )
+from mtec2mqtt.formatting import build_bit_table, decode_bits, get_type_formatter
+from mtec2mqtt.register_map import RegisterDefinition
+from mtec2mqtt.scheduler import PollEntry, PollScheduler
+from mtec2mqtt.snapshot import Snapshot
 
 _LOGGER: Final = logging.getLogger(__name__)
 
+# Pseudo-registers, which change without a change of the raw data
+_TIME_PSEUDO_REGISTERS: Final = frozenset({"api-date"})
 PVDATA_TYPE = dict[str, dict[str, Any] | int | float | str | bool]
+PUBLISH_PLAN_TYPE = dict[str, tuple[int, str, Callable[[Any], str]]]
 run_status = False
 
 
@@ -53,10 +83,20 @@ class MtecCoordinator:
     def __init__(self) -> None:
         """Initialize the coordinator."""
         config = init_config()
-        self._register_map, register_groups = init_register_map()
+        self._register_map: Final = init_register_map()
         self._hass: Final = (
             hass_int.HassIntegration(
-                hass_base_topic=config[Config.HASS_BASE_TOPIC], register_map=self._register_map
+                hass_base_topic=config[Config.HASS_BASE_TOPIC],
+                register_map=self._register_map,
+                discovery_rate=config.get(
+                    Config.HASS_DISCOVERY_RATE,
+                    HASS_DISCOVERY_DEFAULTS[Config.HASS_DISCOVERY_RATE],
+                ),
+                discovery_batch=config.get(
+                    Config.HASS_DISCOVERY_BATCH,
+                    HASS_DISCOVERY_DEFAULTS[Config.HASS_DISCOVERY_BATCH],
+                ),
+                device_discovery=config.get(Config.HASS_DEVICE_DISCOVERY, False),
             )
             if config[Config.HASS_ENABLE]
             else None
@@ -64,25 +104,43 @@ class MtecCoordinator:
         self._modbus_client: Final = modbus_client.MTECModbusClient(
             config=config,
             register_map=self._register_map,
-            register_groups=register_groups,
+        )
+        self._http_api: Final = (
+            http_api.HttpApi(
+                host=config.get(Config.HTTP_API_HOST, DEFAULT_HTTP_API_HOST),
+                port=http_port,
+                get_plan=lambda: self.poll_plan,
+            )
+            if (http_port := config.get(Config.HTTP_API_PORT))
+            else None
+        )
+        self._modbus_proxy: Final = (
+            modbus_proxy.ModbusProxy(
+                modbus_client=self._modbus_client,
+                host=config.get(Config.MODBUS_PROXY_HOST, DEFAULT_MODBUS_PROXY_HOST),
+                port=proxy_port,
+                max_age=config.get(Config.MODBUS_PROXY_MAX_AGE, DEFAULT_MODBUS_PROXY_MAX_AGE),
+            )
+            if (proxy_port := config.get(Config.MODBUS_PROXY_PORT))
+            else None
         )
         self._mqtt_client: Final = mqtt_client.MqttClient(
-            config=config, on_mqtt_message=self._on_mqtt_message, hass=self._hass
+            config=config,
+            on_mqtt_message=self._on_mqtt_message,
+            hass=self._hass,
+            on_reconnect=self._on_mqtt_reconnect,
         )
 
-        # Cache register lists per group to avoid recomputing on every poll
-        self._registers_by_group: dict[RegisterGroup, list[str]] = {}
-        try:
-            for grp in self._modbus_client.register_groups:
-                # Ensure keys are of type RegisterGroup for consistent lookups
-                self._registers_by_group[RegisterGroup(grp)] = (
-                    self._modbus_client.get_register_list(group=RegisterGroup(grp))
-                )
-        except Exception:
-            # Fallback: compute lazily if anything unexpected happens
-            self._registers_by_group = {}
-
         self._mqtt_float_format: Final[str] = config[Config.MQTT_FLOAT_FORMAT]
+        # All register values are kept in one slot based snapshot
+        self._snapshot: Final = Snapshot(table=self._modbus_client.slot_table)
+        self._slot_by_register: Final = self._modbus_client.slot_table.slot_by_register
+        self._shared_snapshot: shared_snapshot.SharedSnapshotWriter | None = None
+        self._shared_memory_name: Final[str | None] = config.get(Config.SHARED_MEMORY_NAME)
+        self._group_layouts: dict[RegisterGroup, _GroupLayout] = {}
+        # Publish plans per group. Prepared once, as the topic base is only known after init.
+        self._publish_plans: dict[RegisterGroup, PUBLISH_PLAN_TYPE] = {}
+        self._publish_plan_base: str = ""
         self._mqtt_refresh_config: Final[int] = config.get(
             Config.REFRESH_CONFIG, REFRESH_DEFAULTS[Config.REFRESH_CONFIG]
         )
@@ -98,10 +156,60 @@ class MtecCoordinator:
         self._mqtt_refresh_total: Final[int] = config.get(
             Config.REFRESH_TOTAL, REFRESH_DEFAULTS[Config.REFRESH_TOTAL]
         )
+        # Max age of unchanged data, which is neither decoded nor published again until then
+        self._refresh_unchanged: Final[int] = config.get(
+            Config.REFRESH_UNCHANGED, REFRESH_DEFAULTS[Config.REFRESH_UNCHANGED]
+        )
         self._mqtt_topic: Final[str] = config[Config.MQTT_TOPIC]
+        self._serial_no: str = ""
+        # MQTT is published from its own thread, so the poll loop never waits for the broker
+        self._mqtt_publisher: Final = publisher.GroupPublisher(
+            publish=self._mqtt_client.publish,
+            replay_rate=config.get(Config.MQTT_REPLAY_RATE, DEFAULT_MQTT_REPLAY_RATE),
+        )
+        # Command topic to publish the cached state again, known with the serial number
+        self._refresh_topic: str | None = None
+        self._mqtt_sink: Final = sinks.MqttSink(
+            publisher=self._mqtt_publisher,
+            get_plan=lambda topic_base, group: self._get_publish_plan(
+                topic_base=topic_base, group=group
+            ),
+            topic=self._mqtt_topic,
+            protocol_v5=self._mqtt_client.protocol_v5,
+        )
+        # All output sinks get the same decoded updates
+        self._sinks: Final = self._create_sinks(config=config)
+        # Modbus I/O time budget per poll cycle (s), 0 = no limit
+        self._modbus_cycle_budget: Final[float] = config.get(Config.MODBUS_CYCLE_BUDGET, 0)
+        self._scheduler_weights: Final[dict[RegisterGroup, float]] = {
+            **SCHEDULER_WEIGHTS_DEFAULT,
+            **{
+                RegisterGroup(group): weight
+                for group, weight in (config.get(Config.SCHEDULER_WEIGHTS) or {}).items()
+            },
+        }
+        # Registers which are polled in the fast lane, with their own interval
+        self._fast_lane_interval: Final[float] = config.get(
+            Config.FAST_LANE_INTERVAL, DEFAULT_FAST_LANE_INTERVAL
+        )
+        self._fast_lane_registers: Final = self._get_fast_lane_registers(
+            names=config.get(Config.FAST_LANE_REGISTERS) or []
+        )
+        self._scheduler: Final = self._create_scheduler()
+        if self._fast_lane_registers:
+            # The fast lane is polled on its own, so its clusters are computed once
+            self._modbus_client.pin_register_clusters(registers=self._fast_lane_registers)
+            _LOGGER.info(
+                "Fast lane: polling %s every %ss",
+                ", ".join(self._fast_lane_registers),
+                self._fast_lane_interval,
+            )
         self._hass_birth_gracetime: Final[int] = config.get(Config.HASS_BIRTH_GRACETIME, 15)
         self._hass_status_topic: Final[str] = f"{config[Config.HASS_BASE_TOPIC]}/status"
         self._hass_birth_timer: threading.Timer | None = None
+        # Set when HA announced going offline or the broker connection was lost, so the next
+        # discovery is sent completely
+        self._hass_force_discovery = False
 
         if config[Config.DEBUG] is True:
             logging.getLogger().setLevel(level=logging.DEBUG)
@@ -116,7 +224,17 @@ class MtecCoordinator:
             with contextlib.suppress(Exception):
                 self._hass_birth_timer.cancel()
             self._hass_birth_timer = None
+        if self._http_api is not None:
+            self._http_api.stop()
+        if self._modbus_proxy is not None:
+            self._modbus_proxy.stop()
+        if self._shared_snapshot is not None:
+            self._shared_snapshot.close()
+            self._shared_snapshot = None
         self._modbus_client.disconnect()
+        for sink in self._sinks:
+            sink.stop()
+        self._mqtt_publisher.stop()
         self._mqtt_client.stop()
         _LOGGER.info("Stopping clients")
 
@@ -130,14 +248,18 @@ class MtecCoordinator:
 
     def run(self) -> None:
         """Run the coordinator."""
-        next_read_config = datetime.now()
-        next_read_day = datetime.now()
-        next_read_total = datetime.now()
-        next_read_static = datetime.now()
-        now_ext_idx = 0
-        sec_groups_len = len(SECONDARY_REGISTER_GROUPS)
-
         self._modbus_client.connect()
+        self._mqtt_publisher.start()
+        for sink in self._sinks:
+            sink.start()
+        if self._http_api is not None:
+            self._http_api.start()
+        if self._modbus_proxy is not None:
+            self._modbus_proxy.start()
+        if self._shared_memory_name:
+            self._shared_snapshot = shared_snapshot.SharedSnapshotWriter(
+                name=self._shared_memory_name, table=self._snapshot.table
+            )
 
         # Initialize
         pv_config = None
@@ -149,7 +271,9 @@ class MtecCoordinator:
         serial_no = pv_config[Register.SERIAL_NO][Register.VALUE]  # type: ignore[unreachable]
         firmware_version = pv_config[Register.FIRMWARE_VERSION][Register.VALUE]
         equipment_info = pv_config[Register.EQUIPMENT_INFO][Register.VALUE]
-        topic_base = f"{self._mqtt_topic}/{serial_no}"
+        self._serial_no = str(serial_no)
+        self._refresh_topic = f"{self._mqtt_topic}/{serial_no}/{MQTT_REFRESH_COMMAND}"
+        self._mqtt_client.subscribe_to_topic(topic=self._refresh_topic)
         if self._hass and not self._hass.is_initialized:
             self._hass.initialize(
                 mqtt=self._mqtt_client,
@@ -159,59 +283,122 @@ class MtecCoordinator:
             )
 
         # Main loop - exit on signal only
+        self._scheduler.start(now=time.monotonic())
         while run_status:
             # check if modbus is alive and reconnect if necessary
             if self._modbus_client.error_count > 10:
                 self._reconnect_modbus()
 
-            now = datetime.now()
+            now = time.monotonic()
+            if due := self._scheduler.get_due(now=now):
+                self._poll(entries=due, now=now)
 
-            # Now base
-            if pvdata := self.read_mtec_data(group=RegisterGroup.BASE):
-                self.write_to_mqtt(pvdata=pvdata, topic_base=topic_base, group=RegisterGroup.BASE)
+            if (wait := self._scheduler.next_due - time.monotonic()) > 0:
+                _LOGGER.debug("Sleep %.1fs", wait)
+                time.sleep(wait)
 
-            # Config
-            if next_read_config <= now and (
-                pvdata := self.read_mtec_data(group=RegisterGroup.CONFIG)
-            ):
-                self.write_to_mqtt(
-                    pvdata=pvdata, topic_base=topic_base, group=RegisterGroup.CONFIG
+    def _create_sinks(self, config: dict[str, Any]) -> list[sinks.OutputSink]:
+        """Create the output sinks: MQTT in the configured payload format, and the further sinks."""
+        payload_format = MqttPayloadFormat(
+            config.get(Config.MQTT_PAYLOAD_FORMAT, MqttPayloadFormat.TEXT)
+        )
+        output: list[sinks.OutputSink] = []
+        if payload_format != MqttPayloadFormat.COMPACT:
+            output.append(self._mqtt_sink)
+        elif self._hass is not None:
+            _LOGGER.warning(
+                "Home Assistant needs the text payload format, set MQTT_PAYLOAD_FORMAT to %s",
+                MqttPayloadFormat.BOTH,
+            )
+        if payload_format != MqttPayloadFormat.TEXT:
+            output.append(
+                sinks.CompactSink(
+                    publisher=self._mqtt_publisher,
+                    register_map=self._register_map,
+                    topic=self._mqtt_topic,
                 )
-                next_read_config = now + timedelta(seconds=self._mqtt_refresh_config)
-
-            # Now extended - read groups in a round-robin - one per loop
-            if sec_groups_len:
-                if (group := SECONDARY_REGISTER_GROUPS.get(now_ext_idx)) and (
-                    pvdata := self.read_mtec_data(group=group)
-                ):
-                    self.write_to_mqtt(pvdata=pvdata, topic_base=topic_base, group=group)
-
-                # advance round-robin index efficiently without magic numbers
-                now_ext_idx = (now_ext_idx + 1) % sec_groups_len
-
-            # Day
-            if next_read_day <= now and (pvdata := self.read_mtec_data(group=RegisterGroup.DAY)):
-                self.write_to_mqtt(pvdata=pvdata, topic_base=topic_base, group=RegisterGroup.DAY)
-                next_read_day = now + timedelta(seconds=self._mqtt_refresh_day)
-
-            # Total
-            if next_read_total <= now and (
-                pvdata := self.read_mtec_data(group=RegisterGroup.TOTAL)
-            ):
-                self.write_to_mqtt(pvdata=pvdata, topic_base=topic_base, group=RegisterGroup.TOTAL)
-                next_read_total = now + timedelta(seconds=self._mqtt_refresh_total)
+            )
+        output.extend(sinks.create_sinks(config=config))
+        return output
+
+    def _create_scheduler(self) -> PollScheduler:
+        """Create the poll scheduler with the configured group refresh intervals."""
+        refresh_now = self._mqtt_refresh_now
+        sec_groups = list(SECONDARY_REGISTER_GROUPS.values())
+        group_intervals: dict[RegisterGroup, float] = {
+            RegisterGroup.BASE: refresh_now,
+            RegisterGroup.CONFIG: self._mqtt_refresh_config,
+        }
+        # Secondary groups keep their round-robin rate, one group per REFRESH_NOW
+        group_intervals.update((group, refresh_now * len(sec_groups)) for group in sec_groups)
+        group_intervals.update(
+            {
+                RegisterGroup.DAY: self._mqtt_refresh_day,
+                RegisterGroup.TOTAL: self._mqtt_refresh_total,
+                RegisterGroup.STATIC: self._mqtt_refresh_static,
+            }
+        )
+        return PollScheduler(
+            register_map=self._register_map,
+            group_intervals=group_intervals,
+            group_offsets={group: idx * refresh_now for idx, group in enumerate(sec_groups)},
+            group_weights=self._scheduler_weights,
+            register_intervals=dict.fromkeys(self._fast_lane_registers, self._fast_lane_interval),
+        )
 
-            # Static
-            if next_read_static <= now and (
-                pvdata := self.read_mtec_data(group=RegisterGroup.STATIC)
+    def _get_fast_lane_registers(self, names: list[str]) -> list[str]:
+        """Return the registers of the fast lane by their MQTT names."""
+        registers: list[str] = []
+        for name in names:
+            if (item := self._register_map.by_mqtt(name)) is None or item.is_pseudo:
+                _LOGGER.warning("Ignoring unknown or calculated fast lane register: %s", name)
+                continue
+            registers.append(item.register)
+        return registers
+
+    @property
+    def poll_plan(self) -> dict[str, Any]:
+        """Return the plan of the last poll cycle for diagnostics."""
+        plan = self._scheduler.last_plan
+        return plan.as_dict() if plan is not None else {}
+
+    def _poll(self, entries: list[PollEntry], now: float) -> None:
+        """Read all due entries at once, then update and publish the affected groups."""
+        plan = self._scheduler.plan(
+            entries=entries,
+            now=now,
+            budget=self._modbus_cycle_budget,
+            estimate=self._modbus_client.estimate_read_time,
+        )
+        if plan.deferred:
+            _LOGGER.debug("Poll plan exceeds the cycle budget: %s", plan.as_dict())
+            for entry in plan.deferred:
+                self._scheduler.defer(entry=entry, now=now, delay=self._mqtt_refresh_now)
+        entries = plan.selected
+        groups: dict[RegisterGroup, list[PollEntry]] = {}
+        for entry in entries:
+            groups.setdefault(entry.group, []).append(entry)
+        _LOGGER.info("Reading registers for groups: %s", ", ".join(groups))
+
+        changed: list[int] = []
+        self._modbus_client.read_snapshot(
+            snapshot=self._snapshot,
+            registers=[register for entry in entries for register in entry.registers],
+            max_age=self._refresh_unchanged,
+            changed=changed,
+        )
+        changed_slots = set(changed)
+        for group, group_entries in groups.items():
+            slots = [slot for entry in group_entries for slot in entry.slots]
+            if self._update_group(
+                group=group, slots=slots, changed=not changed_slots.isdisjoint(slots)
             ):
-                self.write_to_mqtt(
-                    pvdata=pvdata, topic_base=topic_base, group=RegisterGroup.STATIC
-                )
-                next_read_static = now + timedelta(seconds=self._mqtt_refresh_static)
-
-            _LOGGER.debug("Sleep %ss", self._mqtt_refresh_now)
-            time.sleep(self._mqtt_refresh_now)
+                self._publish_group(group=group)
+                for entry in group_entries:
+                    self._scheduler.reschedule(entry=entry, now=now)
+            else:
+                for entry in group_entries:
+                    self._scheduler.retry(entry=entry, now=now, delay=self._mqtt_refresh_now)
 
     def _on_mqtt_message(
         self,
@@ -229,17 +416,22 @@ class MtecCoordinator:
                         "Received HASS online message. Scheduling discovery info in %i sec",
                         gracetime,
                     )
-                    # Avoid blocking the MQTT network thread; schedule delayed discovery
-                    if self._hass_birth_timer is not None:
-                        with contextlib.suppress(Exception):
-                            self._hass_birth_timer.cancel()
-                    self._hass_birth_timer = threading.Timer(
-                        interval=gracetime, function=self._send_hass_discovery
-                    )
-                    self._hass_birth_timer.daemon = True
-                    self._hass_birth_timer.start()
+                    self._schedule_hass_discovery(delay=gracetime)
                 elif msg == "offline":
                     _LOGGER.info("Received HASS offline message.")
+                    self._hass_force_discovery = True
+            elif self._hass is not None and self._hass.is_config_topic(topic=topic):
+                self._hass.handle_config_message(
+                    topic=topic, payload=msg, retained=bool(message.retain)
+                )
+            elif topic == self._refresh_topic:
+                # Avoid blocking the MQTT network thread; the replay is paced
+                threading.Thread(
+                    target=self._replay_state,
+                    kwargs={"groups": _get_refresh_groups(payload=msg)},
+                    name="mqtt-replay",
+                    daemon=True,
+                ).start()
             elif (topic_parts := message.topic.split("/")) is not None and len(topic_parts) >= 4:
                 register_name = topic_parts[3]
                 self._modbus_client.write_register_by_name(name=register_name, value=msg)
@@ -248,155 +440,380 @@ class MtecCoordinator:
         except Exception as ex:
             _LOGGER.warning("Error while handling MQTT message: %s", ex)
 
+    def _on_mqtt_reconnect(self) -> None:
+        """Send the retained messages again, as a broker without persistence lost them."""
+        if self._hass is None or not self._hass.is_initialized:
+            # Avoid blocking the MQTT network thread; the replay is paced
+            threading.Thread(
+                target=self._replay_state,
+                kwargs={"retained_only": True},
+                name="mqtt-replay",
+                daemon=True,
+            ).start()
+            return
+        _LOGGER.info("Reconnected to MQTT broker. Scheduling discovery info")
+        self._hass_force_discovery = True
+        self._schedule_hass_discovery(delay=0)
+
+    def _schedule_hass_discovery(self, delay: float) -> None:
+        """Send the discovery info after delay seconds."""
+        # Avoid blocking the MQTT network thread; schedule delayed discovery
+        if self._hass_birth_timer is not None:
+            with contextlib.suppress(Exception):
+                self._hass_birth_timer.cancel()
+        self._hass_birth_timer = threading.Timer(
+            interval=delay, function=self._send_hass_discovery
+        )
+        self._hass_birth_timer.daemon = True
+        self._hass_birth_timer.start()
+
     def _send_hass_discovery(self) -> None:
         """Send Home Assistant discovery info after grace period (timer callback)."""
         try:
             if self._hass is not None:
-                self._hass.send_discovery_info()
+                # Force a full resend only after HA went offline or the broker connection was
+                # lost, otherwise skip unchanged configs
+                force = self._hass_force_discovery
+                self._hass_force_discovery = False
+                self._hass.send_discovery_info(force=force)
         except Exception as ex:  # defensive
             _LOGGER.warning("Failed to send HASS discovery info: %s", ex)
         finally:
             # clear the timer reference
             self._hass_birth_timer = None
+        # State topics aren't retained, so HA gets the current state from the cache
+        self._replay_state()
+
+    def _replay_state(
+        self, groups: list[RegisterGroup] | None = None, retained_only: bool = False
+    ) -> None:
+        """Publish the last published state of the groups (default: all) again."""
+        try:
+            count = self._mqtt_publisher.replay(groups=groups, retained_only=retained_only)
+            _LOGGER.info(
+                "Published the cached %s again (%i messages, groups: %s)",
+                "retained messages" if retained_only else "state",
+                count,
+                ", ".join(groups) if groups is not None else "all",
+            )
+        except Exception as ex:  # defensive
+            _LOGGER.warning("Failed to publish the cached state: %s", ex)
 
     def read_mtec_data(self, group: RegisterGroup) -> PVDATA_TYPE:
-        """Read data from MTEC modbus."""
-        _LOGGER.info("Reading registers for group: %s", group)
-        if (registers := self._registers_by_group.get(group)) is None:
-            # Lazy compute and cache if not present
-            registers = self._modbus_client.get_register_list(group=group)
-            self._registers_by_group[group] = registers
-        # Only compute current time if needed (for api-date)
-        now_str: str | None = None
-        data = self._modbus_client.read_modbus_data(registers=registers)
-        pvdata: PVDATA_TYPE = {}
-        try:  # assign all data  # pylint: disable=too-many-nested-blocks
-            RV = Register.VALUE
-            RMQTT = Register.MQTT
-            RDEV = Register.DEVICE_CLASS
-            RVITEMS = Register.VALUE_ITEMS
-            rdata = data  # local alias
-            reg_map = self._register_map  # local alias to reduce attribute lookups
-            for register in registers:
-                item = reg_map[register]
-                if mqtt_key := item[RMQTT]:
-                    if register.isdigit():
-                        entry = rdata[register]
-                        value = entry[RV]
-                        if register == "10011":
-                            fw0, fw1 = str(value).split("  ")
-                            entry[RV] = f"V{fw0.replace(' ', '.')}-V{fw1.replace(' ', '.')}"
-                        elif register == "10008":
-                            entry[RV] = _get_equipment_info(value=value)
-                        elif item.get(RDEV) == "enum" and (value_items := item.get(RVITEMS)):
-                            entry[RV] = _convert_code(value=value, value_items=value_items)
-
-                        pvdata[mqtt_key] = entry
-                    else:  # non-numeric registers are deemed to be calculated pseudo-registers
-                        # use locals to avoid repeated dict lookups
-                        if register == "consumption":
-                            pvdata[mqtt_key] = rdata["11016"][RV] - rdata["11000"][RV]
-                        elif register == "consumption-day":
-                            pvdata[mqtt_key] = (
-                                rdata["31005"][RV]
-                                + rdata["31001"][RV]
-                                + rdata["31004"][RV]
-                                - rdata["31000"][RV]
-                                - rdata["31003"][RV]
-                            )
-                        elif register == "autarky-day":
-                            cons_day = pvdata.get("consumption_day")
-                            pvdata[mqtt_key] = (
-                                100 * (1 - (rdata["31001"][RV] / cons_day))
-                                if isinstance(cons_day, (float, int)) and float(cons_day) > 0
-                                else 0
-                            )
-                        elif register == "ownconsumption-day":
-                            gen_day = rdata["31005"][RV]
-                            pvdata[mqtt_key] = (
-                                100 * (1 - rdata["31000"][RV] / gen_day) if gen_day > 0 else 0
-                            )
-                        elif register == "consumption-total":
-                            pvdata[mqtt_key] = (
-                                rdata["31112"][RV]
-                                + rdata["31104"][RV]
-                                + rdata["31110"][RV]
-                                - rdata["31102"][RV]
-                                - rdata["31108"][RV]
-                            )
-                        elif register == "autarky-total":
-                            cons_total = pvdata.get("consumption_total")
-                            pvdata[mqtt_key] = (
-                                100 * (1 - (rdata["31104"][RV] / cons_total))
-                                if isinstance(cons_total, (float, int)) and float(cons_total) > 0
-                                else 0
-                            )
-                        elif register == "ownconsumption-total":
-                            gen_total = rdata["31112"][RV]
-                            pvdata[mqtt_key] = (
-                                100 * (1 - rdata["31102"][RV] / gen_total) if gen_total > 0 else 0
-                            )
-                        elif register == "api-date":
-                            if now_str is None:
-                                now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                            pvdata[mqtt_key] = now_str
-                        else:
-                            _LOGGER.warning("Unknown calculated pseudo-register: %s", register)
-
-                        # Avoid to report negative values, which might occur in some edge cases
-                        val = pvdata[mqtt_key]
-                        if isinstance(val, float) and val < 0:
-                            pvdata[mqtt_key] = 0
+        """Read data from MTEC modbus. The result is a view on the snapshot of the group."""
+        if not self._read_group(group=group):
+            return {}
+        layout = self._get_group_layout(group=group)
+        return self._snapshot.as_mqtt_dict(slots=layout.slots, converters=layout.converters)
 
+    def _read_group(self, group: RegisterGroup) -> bool:
+        """Read a group into the snapshot. Return False if the data is incomplete."""
+        _LOGGER.info("Reading registers for group: %s", group)
+        layout = self._get_group_layout(group=group)
+        changed: list[int] = []
+        self._modbus_client.read_snapshot(
+            snapshot=self._snapshot,
+            registers=layout.registers,
+            max_age=self._refresh_unchanged,
+            changed=changed,
+        )
+        return self._update_group(group=group, slots=layout.register_slots, changed=bool(changed))
+
+    def _update_group(
+        self, group: RegisterGroup, slots: tuple[int, ...] | list[int], changed: bool
+    ) -> bool:
+        """Check the read slots of a group and update its pseudo-registers. Return False if incomplete."""
+        layout = self._get_group_layout(group=group)
+        snapshot = self._snapshot
+        if not snapshot.all_valid(slots=slots):
+            _LOGGER.warning("Retrieved Modbus data is incomplete for group: %s", group)
+            return False
+        if not changed and snapshot.all_valid(slots=layout.pseudo_slots):
+            # Raw data unchanged, so only the time based pseudo-registers have to be calculated
+            pseudo = layout.time_pseudo
+        else:
+            snapshot.invalidate(slots=layout.pseudo_slots)
+            pseudo = layout.pseudo
+        try:
+            # non-numeric registers are deemed to be calculated pseudo-registers
+            for slot, register in pseudo:
+                if (value := self._calculate_pseudo_register(register=register)) is None:
+                    continue
+                # Avoid to report negative values, which might occur in some edge cases
+                if isinstance(value, float) and value < 0:
+                    value = 0
+                snapshot.set(slot=slot, value=value, timestamp=snapshot.timestamp)
         except Exception as ex:
             _LOGGER.warning("Retrieved Modbus data is incomplete: %s", ex)
-            return {}
-        return pvdata
+            return False
+        return True
+
+    def _calculate_pseudo_register(self, register: str) -> Any:
+        """Calculate the value of a pseudo-register from the snapshot."""
+        v = self._snapshot.values
+        s = self._slot_by_register
+        if register == "consumption":
+            return v[s["11016"]] - v[s["11000"]]
+        if register == "consumption-day":
+            return v[s["31005"]] + v[s["31001"]] + v[s["31004"]] - v[s["31000"]] - v[s["31003"]]
+        if register == "autarky-day":
+            cons_day = self._snapshot.get(slot=s["consumption-day"])
+            return (
+                100 * (1 - (v[s["31001"]] / cons_day))
+                if isinstance(cons_day, (float, int)) and float(cons_day) > 0
+                else 0
+            )
+        if register == "ownconsumption-day":
+            gen_day = v[s["31005"]]
+            return 100 * (1 - v[s["31000"]] / gen_day) if gen_day > 0 else 0
+        if register == "consumption-total":
+            return v[s["31112"]] + v[s["31104"]] + v[s["31110"]] - v[s["31102"]] - v[s["31108"]]
+        if register == "autarky-total":
+            cons_total = self._snapshot.get(slot=s["consumption-total"])
+            return (
+                100 * (1 - (v[s["31104"]] / cons_total))
+                if isinstance(cons_total, (float, int)) and float(cons_total) > 0
+                else 0
+            )
+        if register == "ownconsumption-total":
+            gen_total = v[s["31112"]]
+            return 100 * (1 - v[s["31102"]] / gen_total) if gen_total > 0 else 0
+        if register == "api-date":
+            return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        _LOGGER.warning("Unknown calculated pseudo-register: %s", register)
+        return None
+
+    def _get_group_layout(self, group: RegisterGroup) -> _GroupLayout:
+        """Return the slot layout of a group."""
+        if (layout := self._group_layouts.get(group)) is None:
+            if not (definitions := self._register_map.by_group(group)):
+                _LOGGER.error("Unknown or empty register group: %s", group)
+            layout = self._group_layouts[group] = _GroupLayout(definitions=definitions)
+        return layout
 
     def write_to_mqtt(self, pvdata: PVDATA_TYPE, topic_base: str, group: RegisterGroup) -> None:
-        """Write data to MQTT."""
-        fmt = self._mqtt_float_format
-        publish = self._mqtt_client.publish
+        """Write data to MQTT. Only the published parameters of the group are written."""
         RV = Register.VALUE
-        base = f"{topic_base}/{group}"
-        for param, data in pvdata.items():
-            topic = f"{base}/{param}/state"
-            value = data[RV] if isinstance(data, dict) else data
-
-            if isinstance(value, float):
-                payload = fmt.format(value)
-            elif isinstance(value, bool):
-                payload = "1" if value else "0"
-            else:
-                payload = str(value)
-            publish(topic=topic, payload=payload)
+        values = {
+            param: data[RV] if isinstance(data, dict) else data for param, data in pvdata.items()
+        }
+        self._mqtt_sink.publish(
+            topic_base=topic_base, group=group, values=values, timestamp=self._snapshot.timestamp
+        )
+
+    def _publish_group(self, group: RegisterGroup) -> None:
+        """
+        Decode the valid values of a group once and pass them to all sinks.
+
+        Sinks with changes_only get the changed values, the other sinks all valid values.
+        """
+        snapshot = self._snapshot
+        values = snapshot.values
+        is_valid = snapshot.is_valid
+        is_changed = snapshot.is_changed
+        layout = self._get_group_layout(group=group)
+        converters = layout.converters
+
+        def _convert(slot: int) -> Any:
+            if (converter := converters.get(slot)) is not None:
+                return converter(values[slot])
+            return values[slot]
+
+        changed = {
+            param: _convert(slot)
+            for param, slot in layout.params
+            if is_changed(slot) and is_valid(slot)
+        }
+        complete = (
+            {
+                param: changed[param] if param in changed else _convert(slot)
+                for param, slot in layout.params
+                if is_valid(slot)
+            }
+            if any(not sink.changes_only for sink in self._sinks)
+            else {}
+        )
+        updates = {
+            changes_only: sinks.GroupUpdate(
+                group=group,
+                serial_no=self._serial_no,
+                timestamp=snapshot.timestamp,
+                values=sink_values,
+            )
+            for changes_only, sink_values in ((True, changed), (False, complete))
+        }
+        for sink in self._sinks:
+            if not (update := updates[sink.changes_only]).values:
+                continue
+            try:
+                sink.write(update=update)
+            except Exception as ex:
+                _LOGGER.error("Output %s failed: %s", sink.name, ex)
+        if self._http_api is not None:
+            self._update_http_api(group=group)
+        if self._shared_snapshot is not None:
+            self._shared_snapshot.write(snapshot=snapshot, slots=layout.slots)
+        snapshot.clear_changed(slots=layout.slots)
+
+    def _update_http_api(self, group: RegisterGroup) -> None:
+        """Pass the values of a group to the HTTP API."""
+        if self._http_api is None:
+            return
+        layout = self._get_group_layout(group=group)
+        snapshot = self._snapshot
+        values: dict[str, dict[str, Any]] = {}
+        changed: list[str] = []
+        for item in layout.definitions:
+            if not (param := item.mqtt) or not snapshot.is_valid(item.slot):
+                continue
+            values[param] = {
+                Register.NAME: item.name,
+                Register.VALUE: snapshot.get_formatted(
+                    slot=item.slot, converter=layout.converters.get(item.slot)
+                ),
+                Register.UNIT: item.unit,
+                "timestamp": datetime.fromtimestamp(snapshot.timestamps[item.slot]).isoformat(
+                    timespec="seconds"
+                ),
+            }
+            if snapshot.is_changed(item.slot):
+                changed.append(param)
+        self._http_api.update_group(
+            group=group, timestamp=snapshot.timestamp, values=values, changed=changed
+        )
+
+    def _get_publish_plan(self, topic_base: str, group: RegisterGroup) -> PUBLISH_PLAN_TYPE:
+        """Return the publish plan (slot, topic and formatter per parameter) of a group."""
+        if topic_base != self._publish_plan_base:
+            self._publish_plans.clear()
+            self._publish_plan_base = topic_base
+        if (plan := self._publish_plans.get(group)) is None:
+            base = f"{topic_base}/{group}"
+            plan = {}
+            for item in self._get_group_layout(group=group).definitions:
+                if param := item.mqtt:
+                    plan[param] = self._build_publish_entry(base=base, param=param, item=item)
+            self._publish_plans[group] = plan
+        return plan
+
+    def _build_publish_entry(
+        self, base: str, param: str, item: RegisterDefinition
+    ) -> tuple[int, str, Callable[[Any], str]]:
+        """Build the slot, the interned topic and the payload formatter of a parameter."""
+        if (precision := item.precision) is None and (scale := item.scale) > 1:
+            # Derive precision from scale, e.g. scale 10 -> 1 decimal, scale 1000 -> 3 decimals
+            precision = math.ceil(math.log10(scale))
+        float_format = f"{{:.{precision}f}}" if precision is not None else self._mqtt_float_format
+        return (
+            item.slot,
+            sys.intern(f"{base}/{param}/state"),
+            _get_formatter(float_format=float_format),
+        )
 
 
-def _convert_code(value: int | str, value_items: dict[int, str]) -> str:
-    """Convert bms fault code register value."""
-    if isinstance(value, int):
-        return value_items.get(value, "Unknown")
+class _GroupLayout:
+    """Slots and conversions of a register group, prepared once."""
+
+    __slots__ = (
+        "converters",
+        "definitions",
+        "params",
+        "pseudo",
+        "pseudo_slots",
+        "register_slots",
+        "registers",
+        "slots",
+        "time_pseudo",
+    )
+
+    def __init__(self, definitions: tuple[RegisterDefinition, ...]) -> None:
+        """Init the group layout."""
+        self.definitions: Final = definitions
+        # numeric registers, which are read from modbus
+        self.registers: Final = [d.register for d in definitions if not d.is_pseudo]
+        self.register_slots: Final = tuple(
+            d.slot for d in definitions if not d.is_pseudo and d.mqtt
+        )
+        self.slots: Final = tuple(d.slot for d in definitions)
+        # published parameters: (mqtt name, slot)
+        self.params: Final = tuple((d.mqtt, d.slot) for d in definitions if d.mqtt)
+        # calculated pseudo-registers: (slot, register)
+        self.pseudo: Final = tuple(
+            (d.slot, d.register) for d in definitions if d.is_pseudo and d.mqtt
+        )
+        self.pseudo_slots: Final = tuple(slot for slot, _ in self.pseudo)
+        # pseudo-registers, which are calculated again on every read
+        self.time_pseudo: Final = tuple(
+            (slot, register)
+            for slot, register in self.pseudo
+            if register in _TIME_PSEUDO_REGISTERS
+        )
+        # converters from native values to published values, by slot
+        self.converters: Final[dict[int, Callable[[Any], Any]]] = {
+            d.slot: converter
+            for d in definitions
+            if d.mqtt and (converter := _get_value_converter(item=d)) is not None
+        }
+
+
+def _get_formatter(float_format: str) -> Callable[[Any], str]:
+    """Return a payload formatter using the given float format."""
+    fmt = float_format.format
+
+    def _format(value: Any) -> str:
+        if isinstance(value, float):
+            return fmt(value)
+        if isinstance(value, bool):
+            return "1" if value else "0"
+        return str(value)
+
+    return _format
+
+
+def _get_value_converter(item: RegisterDefinition) -> Callable[[Any], Any] | None:
+    """Return the converter from the native value of a register to its published value."""
+    if item.register == "10011":
+        return _get_firmware_version
+    if item.register == "10008":
+        return _get_equipment_info
+    if item.device_class == "enum" and (value_items := item.value_items):
+        if item.type == RegisterType.BIT:
+            return partial(
+                decode_bits, table=build_bit_table(value_items=value_items, length=item.length)
+            )
+        return partial(_convert_code, value_items=value_items)
+    return get_type_formatter(definition=item)
+
+
+def _get_refresh_groups(payload: str) -> list[RegisterGroup] | None:
+    """Return the groups of a refresh command: comma separated, empty or all for all groups."""
+    if not (names := [name.strip() for name in payload.split(",") if name.strip()]) or (
+        "all" in names
+    ):
+        return None
+    groups: list[RegisterGroup] = []
+    for name in names:
+        try:
+            groups.append(RegisterGroup(name))
+        except ValueError:
+            _LOGGER.warning("Ignoring unknown group of refresh command: %s", name)
+    return groups
 
-    faults: list[str] = []
-    value_no = int(f"0b{value.replace(' ', '')}", 2)
-    for no, fault in value_items.items():
-        if _has_bit(val=value_no, idx=no):
-            faults.append(fault)
 
-    if not faults:
-        faults.append("OK")
-    return ", ".join(faults)
+def _convert_code(value: int, value_items: Mapping[int, str]) -> str:
+    """Convert an enum code register value."""
+    return value_items.get(value, "Unknown")
 
 
-def _get_equipment_info(value: str) -> str:
+def _get_equipment_info(value: tuple[int, ...]) -> str:
     """Extract the Equipment info from code."""
-    upper, lower = value.split(" ")
-    return EQUIPMENT.get(int(upper), {}).get(int(lower), "unknown")
+    upper, lower = value
+    return EQUIPMENT.get(upper, {}).get(lower, "unknown")
 
 
-def _has_bit(val: int, idx: int) -> bool:
-    """Return true if idx bit is set."""
-    return (val & (1 << idx)) > 0
+def _get_firmware_version(value: tuple[int, ...]) -> str:
+    """Return the firmware version from its 8 bytes."""
+    return f"V{'.'.join(f'{b:02d}' for b in value[:4])}-V{'.'.join(f'{b:02d}' for b in value[4:])}"
 
 
 # ==========================================
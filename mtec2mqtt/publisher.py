@@ -0,0 +1,241 @@
+"""
+Publisher thread for MQTT.
+
+The poll loop hands the values of an updated group to the publisher, which
+formats and publishes them from a worker thread. So the poll loop never waits
+for the MQTT client, and its timing is not affected by the broker.
+
+The queue holds at most one result per group and publish options (alias use,
+priority, retain): a result, which has not been published yet, is merged with the next
+result of the same group and options, and the later values win. The queue is
+bounded by the number of groups, and no latest value gets lost.
+
+The last published payload of every topic is kept, so the state can be published
+again without reading the inverter, e.g. after a restart of Home Assistant. A
+replay is paced, and publishes the latest payloads from the worker thread, so it
+never overwrites a newer value.
+
+(c) 2024 by SukramJ
+"""
+
+from __future__ import annotations
+
+from collections.abc import Callable, Collection
+import logging
+import threading
+from typing import Any, Final, Protocol
+
+from mtec2mqtt.const import DEFAULT_MQTT_REPLAY_RATE, PublishPriority, RegisterGroup
+from mtec2mqtt.rate_limit import TokenBucket
+
+_LOGGER: Final = logging.getLogger(__name__)
+
+# topic -> (value, formatter)
+GROUP_MESSAGES_TYPE = dict[str, tuple[Any, Callable[[Any], str | bytes]]]
+# payload, timestamp, use_alias and retain of the last published message of a topic
+_PublishedMessage = tuple[str | bytes, str | None, bool, bool]
+
+
+class PublishCallable(Protocol):
+    """Signature of MqttClient.publish."""
+
+    def __call__(
+        self,
+        topic: str,
+        payload: str | bytes,
+        retain: bool = ...,
+        timestamp: str | None = ...,
+        use_alias: bool = ...,
+        *,
+        priority: PublishPriority = ...,
+    ) -> bool:
+        """Publish a message. Returns False if it has been dropped."""
+
+
+class GroupResult:
+    """Values of a group, which wait to be published."""
+
+    __slots__ = ("group", "messages", "priority", "retain", "timestamp", "use_alias")
+
+    def __init__(
+        self,
+        *,
+        group: RegisterGroup,
+        messages: GROUP_MESSAGES_TYPE,
+        timestamp: str | None,
+        use_alias: bool,
+        priority: PublishPriority,
+        retain: bool = False,
+    ) -> None:
+        """Init the result."""
+        self.group: Final = group
+        self.messages: Final = messages
+        self.timestamp = timestamp
+        self.use_alias: Final = use_alias
+        self.priority: Final = priority
+        self.retain: Final = retain
+
+
+# group, use_alias, priority and retain of a queued result
+_ResultKey = tuple[RegisterGroup, bool, PublishPriority, bool]
+
+
+class GroupPublisher:
+    """Formats and publishes group results from a worker thread."""
+
+    def __init__(
+        self, publish: PublishCallable, replay_rate: float = DEFAULT_MQTT_REPLAY_RATE
+    ) -> None:
+        """Init the publisher. replay_rate limits the messages per second of a replay."""
+        self._publish: Final = publish
+        self._pending: Final[dict[_ResultKey, GroupResult]] = {}
+        self._condition: Final = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._running = False
+        # last published message by group and topic
+        self._published: Final[dict[RegisterGroup, dict[str, _PublishedMessage]]] = {}
+        # group and topic of the messages to publish again from _published
+        self._replay: Final[list[tuple[RegisterGroup, str]]] = []
+        self._replay_bucket: Final = TokenBucket(
+            rate=replay_rate, burst=max(1, int(replay_rate / 10))
+        )
+        self._replay_lock: Final = threading.Lock()
+
+    def start(self) -> None:
+        """Start the worker thread."""
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="mqtt-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Publish the pending results and stop the worker thread."""
+        if self._thread is None:
+            return
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join(timeout=timeout)
+        self._thread = None
+
+    def submit(
+        self,
+        *,
+        group: RegisterGroup,
+        messages: GROUP_MESSAGES_TYPE,
+        timestamp: str | None = None,
+        use_alias: bool = False,
+        priority: PublishPriority = PublishPriority.NORMAL,
+        retain: bool = False,
+    ) -> None:
+        """
+        Queue the values of a group. Never blocks on the MQTT client.
+
+        The values are merged into a queued result of the group with the same use_alias,
+        priority and retain. The timestamp of the queued result is kept, if timestamp is None.
+        """
+        if not messages:
+            return
+        with self._condition:
+            key = (group, use_alias, priority, retain)
+            if (pending := self._pending.get(key)) is not None:
+                pending.messages.update(messages)
+                if timestamp is not None:
+                    pending.timestamp = timestamp
+            else:
+                self._pending[key] = GroupResult(
+                    group=group,
+                    messages=messages,
+                    timestamp=timestamp,
+                    use_alias=use_alias,
+                    priority=priority,
+                    retain=retain,
+                )
+            self._condition.notify()
+
+    def replay(
+        self, groups: Collection[RegisterGroup] | None = None, retained_only: bool = False
+    ) -> int:
+        """
+        Publish the last payloads of the groups (default: all groups) again.
+
+        With retained_only, only the retained messages are published again, e.g. after a
+        broker lost them. Blocks until all messages are handed to the worker thread, paced by
+        the replay rate. Returns the number of messages.
+        """
+        with self._replay_lock:
+            with self._condition:
+                topics = [
+                    (group, topic)
+                    for group, messages in self._published.items()
+                    if groups is None or group in groups
+                    for topic, (_, _, _, retain) in messages.items()
+                    if retain or not retained_only
+                ]
+            burst = self._replay_bucket.burst
+            for start in range(0, len(topics), burst):
+                batch = topics[start : start + burst]
+                self._replay_bucket.acquire(tokens=len(batch))
+                with self._condition:
+                    self._replay.extend(batch)
+                    self._condition.notify()
+            return len(topics)
+
+    def _run(self) -> None:
+        """Publish the queued results and replays."""
+        while True:
+            with self._condition:
+                while self._running and not self._pending and not self._replay:
+                    self._condition.wait()
+                if not self._pending and not self._replay:
+                    return
+                # retained results first, e.g. a schema before the first frame it describes
+                results = sorted(self._pending.values(), key=lambda result: not result.retain)
+                self._pending.clear()
+                replay = list(self._replay)
+                self._replay.clear()
+            for result in results:
+                self._publish_result(result=result)
+            if replay:
+                self._publish_replay(replay=replay)
+
+    def _publish_result(self, result: GroupResult) -> None:
+        """Format and publish the values of a group."""
+        publish = self._publish
+        timestamp = result.timestamp
+        use_alias = result.use_alias
+        priority = result.priority
+        retain = result.retain
+        published: dict[str, _PublishedMessage] = {}
+        for topic, (value, formatter) in result.messages.items():
+            try:
+                payload = formatter(value)
+            except Exception as ex:
+                _LOGGER.error("Couldn't format value %s of %s: %s", value, topic, ex)
+                continue
+            publish(
+                topic=topic,
+                payload=payload,
+                retain=retain,
+                timestamp=timestamp,
+                use_alias=use_alias,
+                priority=priority,
+            )
+            published[topic] = (payload, timestamp, use_alias, retain)
+        with self._condition:
+            self._published.setdefault(result.group, {}).update(published)
+
+    def _publish_replay(self, replay: list[tuple[RegisterGroup, str]]) -> None:
+        """Publish the last payloads of topics again."""
+        publish = self._publish
+        for group, topic in replay:
+            payload, timestamp, use_alias, retain = self._published[group][topic]
+            publish(
+                topic=topic,
+                payload=payload,
+                retain=retain,
+                timestamp=timestamp,
+                use_alias=use_alias,
+                priority=PublishPriority.NORMAL,
+            )
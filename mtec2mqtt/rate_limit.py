@@ -0,0 +1,63 @@
+"""
+Rate limiting helpers.
+
+Provides a small token bucket which is used to pace bursts of MQTT messages
+(e.g. Home Assistant discovery) into a smooth stream.
+
+(c) 2024 by SukramJ
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Final
+
+
+class TokenBucket:
+    """Thread safe token bucket."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        """Init the token bucket."""
+        self._rate: Final = max(float(rate), 0.001)
+        self._burst: Final = max(int(burst), 1)
+        self._tokens: float = float(self._burst)
+        self._last = time.monotonic()
+        self._lock: Final = threading.Lock()
+
+    @property
+    def burst(self) -> int:
+        """Return the bucket size."""
+        return self._burst
+
+    @property
+    def rate(self) -> float:
+        """Return the refill rate in tokens per second."""
+        return self._rate
+
+    def _refill(self) -> None:
+        """Refill tokens according to the elapsed time."""
+        now = time.monotonic()
+        self._tokens = min(float(self._burst), self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+    def try_acquire(self, tokens: int = 1) -> bool:
+        """Take tokens without waiting. Return False if not enough tokens are available."""
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: int = 1) -> None:
+        """Take tokens, sleep until enough tokens are available."""
+        tokens = min(tokens, self._burst)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self._rate
+            time.sleep(wait)
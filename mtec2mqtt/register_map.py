@@ -0,0 +1,254 @@
+"""
+Typed register map.
+
+Validates the register definitions of registers.yaml against a schema and
+provides immutable register definitions together with indexes by group, by
+MQTT name, by address and by address range, which are built once at load time.
+
+(c) 2024 by SukramJ
+"""
+
+from __future__ import annotations
+
+from bisect import bisect_right
+from collections.abc import Iterator, Mapping
+from types import MappingProxyType
+from typing import Any, Final
+
+import voluptuous as vol
+
+from mtec2mqtt.const import HAPlatform, Register, RegisterGroup, RegisterType
+
+# Number of registers required by fixed length types
+_TYPE_LENGTHS: Final = {
+    RegisterType.U16: 1,
+    RegisterType.I16: 1,
+    RegisterType.U32: 2,
+    RegisterType.I32: 2,
+    RegisterType.DAT: 3,
+}
+
+# Keys that indicate HA exposure when present in register config
+_HASS_KEYS: Final = (
+    Register.COMPONENT_TYPE,
+    Register.DEVICE_CLASS,
+    Register.PAYLOAD_OFF,
+    Register.PAYLOAD_ON,
+    Register.STATE_CLASS,
+    Register.VALUE_ITEMS,
+    Register.VALUE_TEMPLATE,
+)
+
+REGISTER_SCHEMA: Final = vol.Schema(
+    {
+        vol.Required(Register.NAME.value): vol.All(str, vol.Length(min=1)),
+        vol.Optional(Register.LENGTH.value): vol.All(int, vol.Range(min=1, max=125)),
+        vol.Optional(Register.TYPE.value): vol.Coerce(RegisterType),
+        vol.Optional(Register.UNIT.value, default=""): vol.Any(None, str),
+        vol.Optional(Register.SCALE.value, default=1): vol.All(int, vol.Range(min=1)),
+        vol.Optional(Register.PRECISION.value): vol.All(int, vol.Range(min=0, max=10)),
+        vol.Optional(Register.REFRESH.value): vol.All(int, vol.Range(min=1)),
+        vol.Optional(Register.WRITABLE.value, default=False): bool,
+        vol.Optional(Register.MQTT.value): vol.All(str, vol.Length(min=1)),
+        vol.Optional(Register.GROUP.value): vol.Coerce(RegisterGroup),
+        vol.Optional(Register.COMPONENT_TYPE.value): vol.Coerce(HAPlatform),
+        vol.Optional(Register.DEVICE_CLASS.value): str,
+        vol.Optional(Register.STATE_CLASS.value): str,
+        vol.Optional(Register.VALUE_TEMPLATE.value): str,
+        vol.Optional(Register.VALUE_ITEMS.value): {vol.Coerce(int): str},
+        vol.Optional(Register.PAYLOAD_ON.value): str,
+        vol.Optional(Register.PAYLOAD_OFF.value): str,
+    }
+)
+
+
+class RegisterDefinition:
+    """Immutable definition of a single register or calculated pseudo-register."""
+
+    __slots__ = (
+        "address",
+        "component_type",
+        "device_class",
+        "group",
+        "has_hass_config",
+        "is_pseudo",
+        "length",
+        "mqtt",
+        "name",
+        "payload_off",
+        "payload_on",
+        "precision",
+        "refresh",
+        "register",
+        "scale",
+        "slot",
+        "state_class",
+        "type",
+        "unit",
+        "value_items",
+        "value_template",
+        "writable",
+    )
+
+    address: int | None
+    component_type: HAPlatform | None
+    device_class: str | None
+    group: RegisterGroup | None
+    has_hass_config: bool
+    is_pseudo: bool
+    length: int
+    mqtt: str | None
+    name: str
+    payload_off: str | None
+    payload_on: str | None
+    precision: int | None
+    refresh: int | None
+    register: str
+    scale: int
+    slot: int
+    state_class: str | None
+    type: RegisterType | None
+    unit: str
+    value_items: Mapping[int, str] | None
+    value_template: str | None
+    writable: bool
+
+    def __init__(self, register: str, slot: int, config: dict[str, Any]) -> None:
+        """Init the register definition from a validated config."""
+        value_items = config.get(Register.VALUE_ITEMS)
+        values: dict[str, Any] = {
+            "address": int(register) if register.isnumeric() else None,
+            "component_type": config.get(Register.COMPONENT_TYPE),
+            "device_class": config.get(Register.DEVICE_CLASS),
+            "group": config.get(Register.GROUP),
+            "has_hass_config": any(k in config for k in _HASS_KEYS),
+            "is_pseudo": not register.isnumeric(),
+            "length": config.get(Register.LENGTH) or 0,
+            "mqtt": config.get(Register.MQTT),
+            "name": config[Register.NAME],
+            "payload_off": config.get(Register.PAYLOAD_OFF),
+            "payload_on": config.get(Register.PAYLOAD_ON),
+            "precision": config.get(Register.PRECISION),
+            "refresh": config.get(Register.REFRESH),
+            "register": register,
+            "scale": config[Register.SCALE],
+            "slot": slot,
+            "state_class": config.get(Register.STATE_CLASS),
+            "type": config.get(Register.TYPE),
+            "unit": config[Register.UNIT] or "",
+            "value_items": MappingProxyType(value_items) if value_items else None,
+            "value_template": config.get(Register.VALUE_TEMPLATE),
+            "writable": config[Register.WRITABLE],
+        }
+        for attr, value in values.items():
+            object.__setattr__(self, attr, value)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        """Prevent modifications."""
+        raise AttributeError(f"RegisterDefinition is immutable, can't set {name}")
+
+    def __repr__(self) -> str:
+        """Return the representation."""
+        return f"RegisterDefinition({self.register}, {self.name})"
+
+
+class RegisterMap(Mapping[str, RegisterDefinition]):
+    """Validated register map with prebuilt indexes."""
+
+    def __init__(self, definitions: list[RegisterDefinition]) -> None:
+        """Init the register map and build the indexes."""
+        self._definitions: Final = tuple(sorted(definitions, key=lambda d: d.slot))
+        self._by_register: Final = {d.register: d for d in self._definitions}
+        self._by_mqtt: Final = {d.mqtt: d for d in self._definitions if d.mqtt}
+        self._by_address: Final = {
+            d.address: d for d in self._definitions if d.address is not None
+        }
+        groups: dict[RegisterGroup, list[RegisterDefinition]] = {}
+        for definition in self._definitions:
+            if definition.group:
+                groups.setdefault(definition.group, []).append(definition)
+        self._by_group: Final = {group: tuple(defs) for group, defs in groups.items()}
+        self._groups: Final = tuple(self._by_group)
+        # Address ranges, sorted by start address
+        self._ranges: Final = tuple(
+            sorted(
+                (d for d in self._definitions if d.address is not None and d.length),
+                key=lambda d: d.address or 0,
+            )
+        )
+        self._range_starts: Final = tuple(d.address or 0 for d in self._ranges)
+
+    def __getitem__(self, register: str) -> RegisterDefinition:
+        """Return the definition of a register."""
+        return self._by_register[register]
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over the registers in slot order."""
+        return iter(self._by_register)
+
+    def __len__(self) -> int:
+        """Return the number of registers."""
+        return len(self._definitions)
+
+    @property
+    def definitions(self) -> tuple[RegisterDefinition, ...]:
+        """Return all definitions ordered by slot."""
+        return self._definitions
+
+    @property
+    def groups(self) -> tuple[RegisterGroup, ...]:
+        """Return all register groups."""
+        return self._groups
+
+    def by_address(self, address: int) -> RegisterDefinition | None:
+        """Return the definition of the register starting at address."""
+        return self._by_address.get(address)
+
+    def by_group(self, group: RegisterGroup | str) -> tuple[RegisterDefinition, ...]:
+        """Return the definitions of a group, including pseudo-registers."""
+        return self._by_group.get(RegisterGroup(group), ())
+
+    def by_mqtt(self, mqtt: str) -> RegisterDefinition | None:
+        """Return the definition with a given MQTT name."""
+        return self._by_mqtt.get(mqtt)
+
+    def by_address_range(self, start: int, end: int) -> list[RegisterDefinition]:
+        """Return the definitions which overlap the address range [start, end)."""
+        ranges = self._ranges
+        # registers don't overlap, so only the register starting before start may overlap it
+        idx = max(bisect_right(self._range_starts, start) - 1, 0)
+        result: list[RegisterDefinition] = []
+        while idx < len(ranges) and (address := ranges[idx].address or 0) < end:
+            if address + ranges[idx].length > start:
+                result.append(ranges[idx])
+            idx += 1
+        return result
+
+
+def build_register_map(r_map: dict[str, dict[str, Any]]) -> RegisterMap:
+    """Validate the raw register map and build the typed register map. Raises vol.Invalid."""
+    definitions: list[RegisterDefinition] = []
+    mqtt_names: set[str] = set()
+    for key, val in r_map.items():
+        register = str(key)
+        try:
+            config = REGISTER_SCHEMA(val)
+        except vol.Invalid as err:
+            raise vol.Invalid(f"Invalid register config {register}: {err}") from err
+        if register.isnumeric():
+            if not (reg_type := config.get(Register.TYPE)) or not config.get(Register.LENGTH):
+                raise vol.Invalid(f"Invalid register config {register}: type and length required")
+            if (expected := _TYPE_LENGTHS.get(reg_type)) is not None and expected != config[
+                Register.LENGTH
+            ]:
+                raise vol.Invalid(
+                    f"Invalid register config {register}: {reg_type} requires length {expected}"
+                )
+        if mqtt := config.get(Register.MQTT):
+            if mqtt in mqtt_names:
+                raise vol.Invalid(f"Invalid register config {register}: duplicate mqtt {mqtt}")
+            mqtt_names.add(mqtt)
+        definitions.append(
+            RegisterDefinition(register=register, slot=len(definitions), config=config)
+        )
+    return RegisterMap(definitions=definitions)
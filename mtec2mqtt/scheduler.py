@@ -0,0 +1,205 @@
+"""
+Poll scheduler for register reads.
+
+Every register is polled with its own refresh interval, which defaults to the
+refresh interval of its group. Registers of a group with the same interval are
+scheduled together as one poll entry. At each tick all due entries are read at
+once, so the cluster planner can merge adjacent addresses of different groups
+into shared modbus reads. Registers with their own interval start without the
+offset of their group, so they are due in the same tick as other registers with
+the same interval, e.g. the day and total counters.
+
+With a time budget, the due entries are ranked by the weight of their group
+and how overdue they are. Entries are selected until their estimated read time
+exceeds the budget, the rest is deferred to the next tick. As deferred entries
+get more overdue, they get a higher rank, so every group gets its fair share.
+
+(c) 2024 by SukramJ
+"""
+
+from __future__ import annotations
+
+from collections.abc import Callable, Mapping
+import time
+from typing import Any, Final
+
+from mtec2mqtt.const import RegisterGroup
+from mtec2mqtt.register_map import RegisterMap
+
+
+class PollEntry:
+    """Registers of a group, which are polled with the same interval."""
+
+    __slots__ = ("due", "group", "interval", "next_due", "registers", "slots")
+
+    def __init__(
+        self, group: RegisterGroup, interval: float, registers: list[str], slots: list[int]
+    ) -> None:
+        """Init the poll entry."""
+        self.group: Final = group
+        self.interval: Final = interval
+        self.registers: Final = registers
+        self.slots: Final = slots
+        # when the entry is polled next, and when it became due (kept while deferred)
+        self.next_due: float = 0.0
+        self.due: float = 0.0
+
+    def __repr__(self) -> str:
+        """Return the representation."""
+        return f"PollEntry({self.group}, {self.interval}s, {len(self.registers)} registers)"
+
+
+class PollPlan:
+    """The plan of a single poll cycle."""
+
+    __slots__ = ("budget", "deferred", "estimate", "selected", "timestamp")
+
+    def __init__(
+        self,
+        selected: list[PollEntry],
+        deferred: list[PollEntry],
+        budget: float,
+        estimate: float,
+    ) -> None:
+        """Init the poll plan."""
+        self.selected: Final = selected
+        self.deferred: Final = deferred
+        self.budget: Final = budget
+        self.estimate: Final = estimate
+        self.timestamp: Final = time.time()
+
+    def as_dict(self) -> dict[str, Any]:
+        """Return the plan for diagnostics."""
+        return {
+            "timestamp": self.timestamp,
+            "budget": self.budget,
+            "estimate": round(self.estimate, 4),
+            "selected": [str(entry.group) for entry in self.selected],
+            "deferred": [str(entry.group) for entry in self.deferred],
+        }
+
+
+class PollScheduler:
+    """Schedule the numeric registers of the given groups by their refresh intervals."""
+
+    def __init__(
+        self,
+        register_map: RegisterMap,
+        group_intervals: Mapping[RegisterGroup, float],
+        group_offsets: Mapping[RegisterGroup, float] | None = None,
+        group_weights: Mapping[RegisterGroup, float] | None = None,
+        register_intervals: Mapping[str, float] | None = None,
+    ) -> None:
+        """
+        Init the scheduler. Groups are polled in the order of group_intervals.
+
+        register_intervals override the refresh interval of single registers.
+        """
+        register_intervals = register_intervals or {}
+        entries: dict[tuple[RegisterGroup, float], PollEntry] = {}
+        for group, group_interval in group_intervals.items():
+            for item in register_map.by_group(group):
+                if item.is_pseudo:
+                    continue
+                interval = float(
+                    register_intervals.get(item.register) or item.refresh or group_interval
+                )
+                if (entry := entries.get((group, interval))) is None:
+                    entry = entries[(group, interval)] = PollEntry(
+                        group=group, interval=interval, registers=[], slots=[]
+                    )
+                entry.registers.append(item.register)
+                entry.slots.append(item.slot)
+        self._entries: Final = tuple(entries.values())
+        self._group_intervals: Final = group_intervals
+        self._group_offsets: Final = group_offsets or {}
+        self._group_weights: Final = group_weights or {}
+        self._order: Final = {id(entry): idx for idx, entry in enumerate(self._entries)}
+        self._last_plan: PollPlan | None = None
+        self.start(now=time.monotonic())
+
+    @property
+    def entries(self) -> tuple[PollEntry, ...]:
+        """Return all poll entries."""
+        return self._entries
+
+    @property
+    def last_plan(self) -> PollPlan | None:
+        """Return the plan of the last poll cycle."""
+        return self._last_plan
+
+    @property
+    def next_due(self) -> float:
+        """Return the monotonic time when the next entry is due."""
+        return min((entry.next_due for entry in self._entries), default=time.monotonic())
+
+    def start(self, now: float) -> None:
+        """Schedule all entries relative to now."""
+        for entry in self._entries:
+            offset = (
+                self._group_offsets.get(entry.group, 0.0)
+                if entry.interval == self._group_intervals[entry.group]
+                else 0.0
+            )
+            entry.next_due = entry.due = now + offset
+
+    def get_due(self, now: float) -> list[PollEntry]:
+        """Return the entries, which are due at now."""
+        return [entry for entry in self._entries if entry.next_due <= now]
+
+    def plan(
+        self,
+        entries: list[PollEntry],
+        now: float,
+        budget: float,
+        estimate: Callable[[list[str]], float],
+    ) -> PollPlan:
+        """
+        Select the due entries, which fit into the time budget.
+
+        The entry with the highest rank is always selected. A budget of 0 selects all entries.
+        The selected entries are read together, so the read time is estimated for all their
+        registers, as adjacent registers of different entries share clusters.
+        """
+        selected: list[PollEntry] = []
+        deferred: list[PollEntry] = []
+        registers: list[str] = []
+        total = 0.0
+        for entry in sorted(entries, key=lambda e: self._get_rank(entry=e, now=now), reverse=True):
+            estimated = estimate(registers + entry.registers)
+            if selected and budget > 0 and estimated > budget:
+                deferred.append(entry)
+                continue
+            selected.append(entry)
+            registers.extend(entry.registers)
+            total = estimated
+        # Keep the configured group order for reading and publishing
+        selected.sort(key=lambda e: self._order[id(e)])
+        self._last_plan = PollPlan(
+            selected=selected, deferred=deferred, budget=budget, estimate=total
+        )
+        return self._last_plan
+
+    def _get_rank(self, entry: PollEntry, now: float) -> float:
+        """Return the rank of a due entry by the weight of its group and how overdue it is."""
+        overdue = max(now - entry.due, 0.0) / entry.interval
+        return self._group_weights.get(entry.group, 1.0) * (1.0 + overdue)
+
+    @staticmethod
+    def reschedule(entry: PollEntry, now: float) -> None:
+        """Schedule the next poll of an entry after a successful read."""
+        # Keep the phase, so entries with related intervals stay due in the same tick
+        entry.next_due = entry.due + entry.interval
+        if entry.next_due <= now:
+            entry.next_due = now + entry.interval
+        entry.due = entry.next_due
+
+    @staticmethod
+    def retry(entry: PollEntry, now: float, delay: float) -> None:
+        """Schedule a retry of an entry after a failed read."""
+        entry.next_due = entry.due = now + min(entry.interval, delay)
+
+    @staticmethod
+    def defer(entry: PollEntry, now: float, delay: float) -> None:
+        """Defer an entry to a later cycle. It keeps its due time, so its rank grows."""
+        entry.next_due = now + min(entry.interval, delay)
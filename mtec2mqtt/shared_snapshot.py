@@ -0,0 +1,274 @@
+"""
+Shared-memory snapshot for processes on the same host.
+
+The coordinator writes the values of every updated group into a shared-memory
+segment, so local processes (e.g. control loops) can read the latest values
+without a socket, serialization or MQTT broker.
+
+Layout of the segment (little endian):
+
+Header, 64 bytes
+    0   4s  magic b"MTEC"
+    4   H   layout version (1)
+    6   H   record size (64)
+    8   I   number of slots
+    12  I   offset of the slot table
+    16  I   length of the slot table
+    20  I   offset of the records
+    24  Q   sequence, odd while a write is in progress
+    32  d   time of the last write (unix time)
+    40  24x reserved
+
+Slot table
+    UTF-8 JSON list with one object per slot: register, mqtt, name, unit, group.
+    It is written once, when the segment is created.
+
+Records, one per slot
+    0   B   kind: 0 = no value, 1 = int, 2 = float, 3 = text
+    1   B   flags: bit 0 = valid
+    2   B   length of the text in bytes
+    3   5x  reserved
+    8   d   acquisition time (unix time)
+    16  q   value of kind int
+    24  d   value of kind float
+    32  32s value of kind text, UTF-8
+
+Values are stored in their native types. Values, which are neither int nor float
+(e.g. dates or byte values), and ints beyond 64 bit are stored as text with the
+formatting of the register type. Enum values are stored as their raw code.
+
+Consistency is ensured by a seqlock: the writer makes the sequence odd before
+and even again after a write. A reader copies the records and retries while the
+sequence is odd or changed during the copy.
+
+(c) 2024 by SukramJ
+"""
+
+from __future__ import annotations
+
+from collections.abc import Iterable
+import json
+import logging
+from multiprocessing import shared_memory
+import struct
+import time
+from typing import Any, Final, cast
+
+from mtec2mqtt.const import UTF8
+from mtec2mqtt.snapshot import SlotTable, Snapshot
+
+_LOGGER: Final = logging.getLogger(__name__)
+
+MAGIC: Final = b"MTEC"
+LAYOUT_VERSION: Final = 1
+
+_HEADER: Final = struct.Struct("<4sHHIIIIQd24x")
+_SEQUENCE: Final = struct.Struct("<Qd")
+_SEQUENCE_OFFSET: Final = 24
+_RECORD: Final = struct.Struct("<BBB5xdqd32s")
+_TEXT_SIZE: Final = 32
+
+KIND_NONE: Final = 0
+KIND_INT: Final = 1
+KIND_FLOAT: Final = 2
+KIND_TEXT: Final = 3
+_FLAG_VALID: Final = 0x01
+
+_INT64_MIN: Final = -(1 << 63)
+_INT64_MAX: Final = (1 << 63) - 1
+# Max attempts of a reader to get a consistent copy
+_READ_RETRIES: Final = 1000
+
+
+class SharedSnapshotWriter:
+    """Writes snapshot values into a shared-memory segment."""
+
+    def __init__(self, name: str, table: SlotTable) -> None:
+        """Create the shared-memory segment."""
+        slot_table = json.dumps(
+            [
+                {
+                    "register": table.registers[slot],
+                    "mqtt": table.mqtt[slot],
+                    "name": table.names[slot],
+                    "unit": table.units[slot],
+                    "group": table.groups[slot],
+                }
+                for slot in range(len(table))
+            ],
+            separators=(",", ":"),
+        ).encode(UTF8)
+        records_offset = (_HEADER.size + len(slot_table) + 7) & ~7
+        size = records_offset + len(table) * _RECORD.size
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # left over by a previous run, which was not stopped gracefully
+            _LOGGER.warning("Replacing existing shared memory %s", name)
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self._buf: Final = cast(memoryview, self._shm.buf)
+        self._table: Final = table
+        self._records_offset: Final = records_offset
+        self._sequence = 0
+        _HEADER.pack_into(
+            self._buf,
+            0,
+            MAGIC,
+            LAYOUT_VERSION,
+            _RECORD.size,
+            len(table),
+            _HEADER.size,
+            len(slot_table),
+            records_offset,
+            0,
+            0.0,
+        )
+        self._buf[_HEADER.size : _HEADER.size + len(slot_table)] = slot_table
+        _LOGGER.info("Shared memory snapshot %s created (%i bytes)", name, size)
+
+    def write(self, snapshot: Snapshot, slots: Iterable[int]) -> None:
+        """Write the values of slots into the segment."""
+        buf = self._buf
+        pack_into = _RECORD.pack_into
+        offset = self._records_offset
+        size = _RECORD.size
+        formatters = self._table.formatters
+        values = snapshot.values
+        timestamps = snapshot.timestamps
+        is_valid = snapshot.is_valid
+        self._sequence += 1
+        _SEQUENCE.pack_into(buf, _SEQUENCE_OFFSET, self._sequence, time.time())
+        for slot in slots:
+            if not is_valid(slot):
+                pack_into(
+                    buf, offset + slot * size, KIND_NONE, 0, 0, timestamps[slot], 0, 0.0, b""
+                )
+                continue
+            value = values[slot]
+            if isinstance(value, float):
+                pack_into(
+                    buf,
+                    offset + slot * size,
+                    KIND_FLOAT,
+                    _FLAG_VALID,
+                    0,
+                    timestamps[slot],
+                    0,
+                    value,
+                    b"",
+                )
+            elif isinstance(value, int) and _INT64_MIN <= value <= _INT64_MAX:
+                pack_into(
+                    buf,
+                    offset + slot * size,
+                    KIND_INT,
+                    _FLAG_VALID,
+                    0,
+                    timestamps[slot],
+                    value,
+                    0.0,
+                    b"",
+                )
+            else:
+                text = str(
+                    formatter(value) if (formatter := formatters[slot]) is not None else value
+                ).encode(UTF8)[:_TEXT_SIZE]
+                pack_into(
+                    buf,
+                    offset + slot * size,
+                    KIND_TEXT,
+                    _FLAG_VALID,
+                    len(text),
+                    timestamps[slot],
+                    0,
+                    0.0,
+                    text,
+                )
+        self._sequence += 1
+        _SEQUENCE.pack_into(buf, _SEQUENCE_OFFSET, self._sequence, time.time())
+
+    def close(self) -> None:
+        """Close and remove the segment."""
+        self._shm.close()
+        self._shm.unlink()
+
+
+class SharedSnapshotReader:
+    """
+    Reads the values of a shared-memory snapshot.
+
+    Usage:
+        reader = SharedSnapshotReader(name="mtec2mqtt")
+        values = reader.read()
+        battery_soc, timestamp = values["battery_soc"]
+    """
+
+    def __init__(self, name: str) -> None:
+        """Attach to an existing shared-memory segment."""
+        # the segment is owned by the coordinator and must not be removed, when the reader exits
+        self._shm: Final = shared_memory.SharedMemory(name=name, track=False)
+        self._buf: Final = cast(memoryview, self._shm.buf)
+        (
+            magic,
+            version,
+            record_size,
+            slot_count,
+            table_offset,
+            table_length,
+            records_offset,
+            _,
+            _,
+        ) = _HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or version != LAYOUT_VERSION or record_size != _RECORD.size:
+            self.close()
+            raise ValueError(f"Unsupported shared memory layout of {name}: {magic!r}, {version}")
+        self._slot_count: Final[int] = slot_count
+        self._records_offset: Final[int] = records_offset
+        self._records_end: Final[int] = records_offset + slot_count * record_size
+        self.slots: Final[list[dict[str, Any]]] = json.loads(
+            bytes(self._buf[table_offset : table_offset + table_length])
+        )
+        # key of every slot: the mqtt name, or the register for registers without
+        self._keys: Final[tuple[str, ...]] = tuple(s["mqtt"] or s["register"] for s in self.slots)
+
+    @property
+    def sequence(self) -> int:
+        """Return the current sequence. It changes with every write."""
+        return int(_SEQUENCE.unpack_from(self._buf, _SEQUENCE_OFFSET)[0])
+
+    def read_records(self) -> tuple[int, float, bytes]:
+        """Return a consistent copy of all records, with its sequence and write time."""
+        buf = self._buf
+        for _ in range(_READ_RETRIES):
+            sequence, timestamp = _SEQUENCE.unpack_from(buf, _SEQUENCE_OFFSET)
+            if sequence & 1:
+                time.sleep(0)
+                continue
+            records = bytes(buf[self._records_offset : self._records_end])
+            if _SEQUENCE.unpack_from(buf, _SEQUENCE_OFFSET)[0] == sequence:
+                return sequence, timestamp, records
+        raise TimeoutError("No consistent copy of the shared memory snapshot")
+
+    def read(self) -> dict[str, tuple[Any, float]]:
+        """Return (value, acquisition time) of all valid slots, keyed by mqtt name or register."""
+        _, _, records = self.read_records()
+        result: dict[str, tuple[Any, float]] = {}
+        for key, (kind, flags, length, timestamp, int_value, float_value, text) in zip(
+            self._keys, _RECORD.iter_unpack(records), strict=True
+        ):
+            if not flags & _FLAG_VALID:
+                continue
+            if kind == KIND_INT:
+                result[key] = (int_value, timestamp)
+            elif kind == KIND_FLOAT:
+                result[key] = (float_value, timestamp)
+            elif kind == KIND_TEXT:
+                result[key] = (text[:length].decode(UTF8, errors="ignore"), timestamp)
+        return result
+
+    def close(self) -> None:
+        """Detach from the segment."""
+        self._shm.close()
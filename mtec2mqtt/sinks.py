@@ -0,0 +1,469 @@
+"""
+Output sinks for the polled values.
+
+The coordinator decodes the values of a group once, and passes them as
+GroupUpdate to every sink: the changed values to sinks with changes_only, all
+valid values of the group to the other sinks. MQTT is one sink (text messages
+per value and/or compact binary frames per group), further sinks write the
+complete groups to InfluxDB (line protocol via HTTP or to a file) or to daily
+CSV files.
+
+Sinks must not block the poll loop. The batched sinks buffer the updates and
+write them from their own thread every flush interval. A failing sink keeps its
+updates (up to a bounded buffer) and retries with backoff, without affecting
+the other sinks.
+
+(c) 2024 by SukramJ
+"""
+
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from collections import deque
+from collections.abc import Callable, Mapping
+import csv
+from datetime import date, datetime, timedelta
+import gzip
+import logging
+import math
+from pathlib import Path
+import threading
+from typing import Any, Final
+from urllib import error, request
+
+from mtec2mqtt.compact import COMPACT_SCHEMA_TOPIC, COMPACT_TOPIC, CompactSchema
+from mtec2mqtt.const import (
+    DEFAULT_CSV_FLUSH_INTERVAL,
+    DEFAULT_INFLUX_FLUSH_INTERVAL,
+    DEFAULT_INFLUX_MEASUREMENT,
+    DEFAULT_SINK_MAX_BUFFER,
+    NOW_GROUP_PREFIX,
+    PUBLISH_PRIORITIES,
+    UTF8,
+    Config,
+    PublishPriority,
+    RegisterGroup,
+)
+from mtec2mqtt.publisher import GROUP_MESSAGES_TYPE, GroupPublisher
+from mtec2mqtt.register_map import RegisterMap
+
+_LOGGER: Final = logging.getLogger(__name__)
+
+# param -> (slot, topic, formatter)
+PUBLISH_PLAN_TYPE = Mapping[str, tuple[int, str, Callable[[Any], str]]]
+
+# Number of buffered updates, which trigger a flush before the flush interval
+_BATCH_SIZE: Final = 1000
+# Max delay (s) between two attempts of a failing sink
+_MAX_RETRY_DELAY: Final = 300.0
+_HTTP_TIMEOUT: Final = 10.0
+_CSV_PREFIX: Final = "mtec2mqtt-"
+_CSV_HEADER: Final = ("timestamp", "serial_no", "group", "parameter", "value")
+
+
+class GroupUpdate:
+    """Decoded values of a group after a read."""
+
+    __slots__ = ("group", "serial_no", "timestamp", "values")
+
+    def __init__(
+        self, group: RegisterGroup, serial_no: str, timestamp: float, values: dict[str, Any]
+    ) -> None:
+        """Init the update. values are the published values by MQTT parameter name."""
+        self.group: Final = group
+        self.serial_no: Final = serial_no
+        self.timestamp: Final = timestamp
+        self.values: Final = values
+
+
+class OutputSink(ABC):
+    """Destination of the polled values."""
+
+    name: str = ""
+    # True if the sink only gets the values, which changed with the last read
+    changes_only: bool = True
+
+    def start(self) -> None:
+        """Start the sink."""
+
+    def stop(self) -> None:
+        """Write the pending updates and stop the sink."""
+
+    @abstractmethod
+    def write(self, update: GroupUpdate) -> None:
+        """Pass an update to the sink. Must not block."""
+
+
+class MqttSink(OutputSink):
+    """Publishes the values to the MQTT state topics."""
+
+    name = "mqtt"
+
+    def __init__(
+        self,
+        publisher: GroupPublisher,
+        get_plan: Callable[[str, RegisterGroup], PUBLISH_PLAN_TYPE],
+        topic: str,
+        protocol_v5: bool,
+    ) -> None:
+        """Init the sink. get_plan returns the publish plan of a topic base and group."""
+        self._publisher: Final = publisher
+        self._get_plan: Final = get_plan
+        self._topic: Final = topic
+        self._protocol_v5: Final = protocol_v5
+
+    def write(self, update: GroupUpdate) -> None:
+        """Publish the values below the topic of the serial number."""
+        self.publish(
+            topic_base=f"{self._topic}/{update.serial_no}",
+            group=update.group,
+            values=update.values,
+            timestamp=update.timestamp,
+        )
+
+    def publish(
+        self, topic_base: str, group: RegisterGroup, values: Mapping[str, Any], timestamp: float
+    ) -> None:
+        """Publish the values below topic_base. Parameters without publish plan are skipped."""
+        plan = self._get_plan(topic_base, group)
+        messages: GROUP_MESSAGES_TYPE = {}
+        for param, value in values.items():
+            if (entry := plan.get(param)) is not None:
+                _, topic, formatter = entry
+                messages[topic] = (value, formatter)
+        # MQTT v5 only: acquisition timestamp as user property and topic aliases for now-* topics
+        self._publisher.submit(
+            group=group,
+            messages=messages,
+            timestamp=datetime.fromtimestamp(timestamp).isoformat(timespec="seconds")
+            if self._protocol_v5
+            else None,
+            use_alias=self._protocol_v5 and group.startswith(NOW_GROUP_PREFIX),
+            priority=PUBLISH_PRIORITIES.get(group, PublishPriority.NORMAL),
+        )
+
+
+class CompactSink(OutputSink):
+    """Publishes all valid values of a group as one compact binary frame."""
+
+    name = "compact"
+    # an invalid value must be absent from the next frame
+    changes_only = False
+
+    def __init__(
+        self,
+        publisher: GroupPublisher,
+        register_map: RegisterMap,
+        topic: str,
+    ) -> None:
+        """Init the sink."""
+        self._publisher: Final = publisher
+        self._register_map: Final = register_map
+        self._topic: Final = topic
+        self._schemas: Final[dict[RegisterGroup, CompactSchema]] = {}
+        # Values of the last frame by group
+        self._values: Final[dict[RegisterGroup, dict[str, Any]]] = {}
+
+    def write(self, update: GroupUpdate) -> None:
+        """
+        Publish the frame of the group if its values changed, and its retained schema once.
+
+        The frame holds exactly the valid values of the update. The schema is queued before the first frame. It is cached by the publisher like the
+        frames, so it is published again after the broker lost the retained messages.
+        """
+        group = update.group
+        base = f"{self._topic}/{update.serial_no}/{group}"
+        priority = PUBLISH_PRIORITIES.get(group, PublishPriority.NORMAL)
+        if (schema := self._schemas.get(group)) is None:
+            schema = self._schemas[group] = CompactSchema.from_definitions(
+                group=group, definitions=self._register_map.by_group(group)
+            )
+            self._publisher.submit(
+                group=group,
+                messages={f"{base}/{COMPACT_SCHEMA_TOPIC}": (schema.to_json(), _as_is)},
+                priority=priority,
+                retain=True,
+            )
+        if (values := update.values) == self._values.get(group):
+            return
+        self._values[group] = values
+        self._publisher.submit(
+            group=group,
+            messages={
+                f"{base}/{COMPACT_TOPIC}": (
+                    schema.encode(values=values, timestamp=update.timestamp),
+                    _as_is,
+                )
+            },
+            priority=priority,
+        )
+
+
+class BatchedSink(OutputSink):
+    """Sink, which buffers the updates and writes them in batches from its own thread."""
+
+    # Every written point or row carries the complete group
+    changes_only = False
+
+    def __init__(self, flush_interval: float, max_buffer: int = DEFAULT_SINK_MAX_BUFFER) -> None:
+        """Init the sink."""
+        self._flush_interval: Final = max(flush_interval, 0.1)
+        self._max_buffer: Final = max_buffer
+        self._buffer: Final[deque[GroupUpdate]] = deque()
+        self._condition: Final = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._running = False
+        self._failing = False
+        self._dropped = 0
+
+    def start(self) -> None:
+        """Start the writer thread."""
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=f"sink-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Write the pending updates and stop the writer thread."""
+        if self._thread is None:
+            return
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join(timeout=timeout)
+        self._thread = None
+
+    def write(self, update: GroupUpdate) -> None:
+        """Buffer an update. The oldest update is dropped, if the buffer is full."""
+        with self._condition:
+            if len(self._buffer) >= self._max_buffer:
+                self._buffer.popleft()
+                self._dropped += 1
+            self._buffer.append(update)
+            if len(self._buffer) >= _BATCH_SIZE and not self._failing:
+                self._condition.notify()
+
+    @abstractmethod
+    def _flush(self, batch: list[GroupUpdate]) -> None:
+        """Write a batch of updates. Raises an exception if the batch couldn't be written."""
+
+    def _run(self) -> None:
+        """Write the buffered updates every flush interval."""
+        delay = self._flush_interval
+        while True:
+            with self._condition:
+                # a failing sink waits for its retry delay
+                if self._running and (self._failing or len(self._buffer) < _BATCH_SIZE):
+                    self._condition.wait(timeout=delay)
+                stopping = not self._running
+                batch = list(self._buffer)
+                self._buffer.clear()
+            if batch and not self._write_batch(batch=batch):
+                if stopping:
+                    _LOGGER.error(
+                        "Output %s: dropping %i unwritten updates on shutdown",
+                        self.name,
+                        len(batch),
+                    )
+                    return
+                delay = min(delay * 2, _MAX_RETRY_DELAY)
+                continue
+            delay = self._flush_interval
+            if stopping:
+                return
+
+    def _write_batch(self, batch: list[GroupUpdate]) -> bool:
+        """Write a batch. On failure, the batch is put back into the buffer."""
+        try:
+            self._flush(batch=batch)
+        except Exception as ex:
+            with self._condition:
+                pending = batch + list(self._buffer)
+                if (excess := len(pending) - self._max_buffer) > 0:
+                    del pending[:excess]
+                    self._dropped += excess
+                self._buffer.clear()
+                self._buffer.extend(pending)
+            # warn once per failure period
+            log = _LOGGER.debug if self._failing else _LOGGER.warning
+            log("Output %s failed, retrying later: %s", self.name, ex)
+            self._failing = True
+            return False
+        if self._failing:
+            _LOGGER.info("Output %s recovered", self.name)
+            self._failing = False
+        if self._dropped:
+            _LOGGER.warning(
+                "Output %s: %i updates were dropped, as the buffer was full",
+                self.name,
+                self._dropped,
+            )
+            self._dropped = 0
+        return True
+
+
+class InfluxSink(BatchedSink):
+    """Writes the values in InfluxDB line protocol via HTTP or to a file."""
+
+    name = "influx"
+
+    def __init__(
+        self,
+        *,
+        url: str | None,
+        file: str | None,
+        token: str | None,
+        measurement: str,
+        flush_interval: float,
+    ) -> None:
+        """
+        Init the sink.
+
+        url is the complete write endpoint, e.g.
+        http://influx:8086/api/v2/write?org=home&bucket=mtec or
+        http://influx:8086/write?db=mtec. Without url, the lines are appended to file.
+        """
+        super().__init__(flush_interval=flush_interval)
+        self._url: Final = url
+        self._file: Final = Path(file) if file else None
+        self._token: Final = token
+        self._measurement: Final = _escape_key(measurement)
+
+    def _flush(self, batch: list[GroupUpdate]) -> None:
+        """Write the batch."""
+        if not (body := "".join(self._encode(update=update) for update in batch)):
+            return
+        if self._url:
+            headers = {"Content-Type": "text/plain; charset=utf-8", "Content-Encoding": "gzip"}
+            if self._token:
+                headers["Authorization"] = f"Token {self._token}"
+            req = request.Request(
+                self._url, data=gzip.compress(body.encode(UTF8)), headers=headers, method="POST"
+            )
+            try:
+                with request.urlopen(req, timeout=_HTTP_TIMEOUT) as response:  # noqa: S310
+                    response.read()
+            except error.HTTPError as ex:
+                if not 400 <= ex.code < 500:  # noqa: PLR2004
+                    raise
+                # rejected data won't be accepted by a retry
+                _LOGGER.error(
+                    "Output %s: dropping %i updates rejected by InfluxDB: %s",
+                    self.name,
+                    len(batch),
+                    ex.read().decode(UTF8, errors="replace"),
+                )
+        elif self._file is not None:
+            with self._file.open("a", encoding=UTF8) as file:
+                file.write(body)
+
+    def _encode(self, update: GroupUpdate) -> str:
+        """Return the line of an update."""
+        fields = ",".join(
+            f"{_escape_key(param)}={field}"
+            for param, value in update.values.items()
+            if (field := _encode_field(value=value)) is not None
+        )
+        if not fields:
+            return ""
+        # ns timestamp in ms resolution, as the float can't carry more digits
+        return (
+            f"{self._measurement},serial_no={_escape_key(update.serial_no)},"
+            f"group={_escape_key(update.group)} {fields} {int(update.timestamp * 1000) * 1000000}\n"
+        )
+
+
+class CsvSink(BatchedSink):
+    """Appends the values to a CSV file per day: timestamp, serial_no, group, parameter, value."""
+
+    name = "csv"
+
+    def __init__(self, directory: str, flush_interval: float, keep_days: int) -> None:
+        """Init the sink. Files older than keep_days are deleted, 0 keeps all files."""
+        super().__init__(flush_interval=flush_interval)
+        self._directory: Final = Path(directory)
+        self._keep_days: Final = keep_days
+
+    def _flush(self, batch: list[GroupUpdate]) -> None:
+        """Append the batch to the files of the days."""
+        days: dict[date, list[GroupUpdate]] = {}
+        for update in batch:
+            days.setdefault(datetime.fromtimestamp(update.timestamp).date(), []).append(update)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        for day, updates in days.items():
+            path = self._directory / f"{_CSV_PREFIX}{day.isoformat()}.csv"
+            is_new = not path.exists()
+            with path.open("a", encoding=UTF8, newline="") as file:
+                writer = csv.writer(file)
+                if is_new:
+                    writer.writerow(_CSV_HEADER)
+                for update in updates:
+                    timestamp = datetime.fromtimestamp(update.timestamp).isoformat(
+                        timespec="seconds"
+                    )
+                    writer.writerows(
+                        (timestamp, update.serial_no, update.group, param, value)
+                        for param, value in update.values.items()
+                    )
+            if is_new:
+                self._remove_old_files(today=day)
+
+    def _remove_old_files(self, today: date) -> None:
+        """Delete the files, which are older than keep_days."""
+        if self._keep_days <= 0:
+            return
+        oldest = (today - timedelta(days=self._keep_days)).isoformat()
+        for path in self._directory.glob(f"{_CSV_PREFIX}*.csv"):
+            if path.stem.removeprefix(_CSV_PREFIX) < oldest:
+                _LOGGER.debug("Deleting old CSV file %s", path)
+                path.unlink(missing_ok=True)
+
+
+def create_sinks(config: dict[str, Any]) -> list[OutputSink]:
+    """Create the configured sinks besides MQTT."""
+    sinks: list[OutputSink] = []
+    if (url := config.get(Config.INFLUX_URL)) or config.get(Config.INFLUX_FILE):
+        sinks.append(
+            InfluxSink(
+                url=url,
+                file=config.get(Config.INFLUX_FILE),
+                token=config.get(Config.INFLUX_TOKEN),
+                measurement=config.get(Config.INFLUX_MEASUREMENT, DEFAULT_INFLUX_MEASUREMENT),
+                flush_interval=config.get(
+                    Config.INFLUX_FLUSH_INTERVAL, DEFAULT_INFLUX_FLUSH_INTERVAL
+                ),
+            )
+        )
+    if directory := config.get(Config.CSV_DIR):
+        sinks.append(
+            CsvSink(
+                directory=directory,
+                flush_interval=config.get(Config.CSV_FLUSH_INTERVAL, DEFAULT_CSV_FLUSH_INTERVAL),
+                keep_days=config.get(Config.CSV_KEEP_DAYS, 0),
+            )
+        )
+    return sinks
+
+
+def _as_is(payload: str | bytes) -> str | bytes:
+    """Return the payload, which is already encoded."""
+    return payload
+
+
+def _escape_key(key: str) -> str:
+    """Escape a measurement, tag or field key of the line protocol."""
+    return key.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def _encode_field(value: Any) -> str | None:
+    """Return the field value of the line protocol, or None if it can't be written."""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    # numbers are always written as float, as a field must not change its type
+    if isinstance(value, (int, float)):
+        return repr(float(value)) if math.isfinite(value) else None
+    if value is None:
+        return None
+    text = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{text}"'
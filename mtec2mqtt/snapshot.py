@@ -0,0 +1,177 @@
+"""
+Slot based snapshot of register values.
+
+Every register of the register map gets a fixed slot, assigned when the map is
+loaded. A snapshot keeps the values in a preallocated list indexed by slot,
+together with a validity bitmap and the acquisition timestamp of every slot.
+The static metadata (register, name, unit, mqtt name, group, formatter) is kept
+once in a shared slot table. Values are stored in native types and only
+formatted by the views. The raw words of every cluster read into a snapshot are
+kept, so unchanged clusters don't need to be decoded again.
+
+(c) 2024 by SukramJ
+"""
+
+from __future__ import annotations
+
+from array import array
+from collections.abc import Callable, Mapping
+from typing import Any, Final
+
+from mtec2mqtt.const import Register
+from mtec2mqtt.formatting import get_type_formatter
+from mtec2mqtt.register_map import RegisterMap
+
+
+class SlotTable:
+    """Static metadata of all register slots."""
+
+    __slots__ = (
+        "formatters",
+        "groups",
+        "mqtt",
+        "names",
+        "registers",
+        "slot_by_mqtt",
+        "slot_by_register",
+        "units",
+    )
+
+    def __init__(self, register_map: RegisterMap) -> None:
+        """Init the slot table from the register map."""
+        definitions = register_map.definitions
+        self.registers: Final[tuple[str, ...]] = tuple(d.register for d in definitions)
+        self.names: Final[tuple[str, ...]] = tuple(d.name for d in definitions)
+        self.units: Final[tuple[str, ...]] = tuple(d.unit for d in definitions)
+        self.mqtt: Final[tuple[str | None, ...]] = tuple(d.mqtt for d in definitions)
+        self.groups: Final[tuple[str | None, ...]] = tuple(d.group for d in definitions)
+        self.formatters: Final[tuple[Callable[[Any], Any] | None, ...]] = tuple(
+            get_type_formatter(definition=d) for d in definitions
+        )
+        self.slot_by_register: Final[dict[str, int]] = {
+            register: slot for slot, register in enumerate(self.registers)
+        }
+        self.slot_by_mqtt: Final[dict[str, int]] = {
+            mqtt: slot for slot, mqtt in enumerate(self.mqtt) if mqtt
+        }
+
+    def __len__(self) -> int:
+        """Return the number of slots."""
+        return len(self.registers)
+
+
+class Snapshot:
+    """Values of all register slots with validity and acquisition timestamps."""
+
+    __slots__ = ("changed", "raw", "table", "timestamp", "timestamps", "valid", "values")
+
+    def __init__(self, table: SlotTable) -> None:
+        """Init an empty snapshot."""
+        size = len(table)
+        self.table: Final = table
+        self.values: Final[list[Any]] = [None] * size
+        self.valid: Final = bytearray((size + 7) // 8)
+        # slots which have been set since the last clear_changed
+        self.changed: Final = bytearray((size + 7) // 8)
+        # raw words and decode time per cluster, keyed by (start, length)
+        self.raw: Final[dict[tuple[int, int], tuple[bytes, float]]] = {}
+        self.timestamps: Final = array("d", bytes(8 * size))
+        self.timestamp: float = 0.0
+
+    def set(self, slot: int, value: Any, timestamp: float) -> None:
+        """Set the value of a slot and mark it valid."""
+        self.values[slot] = value
+        self.timestamps[slot] = timestamp
+        self.valid[slot >> 3] |= 1 << (slot & 7)
+        self.changed[slot >> 3] |= 1 << (slot & 7)
+        self.timestamp = max(self.timestamp, timestamp)
+
+    def touch(self, slots: tuple[int, ...] | list[int], timestamp: float) -> None:
+        """Mark slots valid with unchanged values, acquired at timestamp."""
+        valid = self.valid
+        timestamps = self.timestamps
+        for slot in slots:
+            timestamps[slot] = timestamp
+            valid[slot >> 3] |= 1 << (slot & 7)
+        self.timestamp = max(self.timestamp, timestamp)
+
+    def invalidate(self, slots: tuple[int, ...] | list[int]) -> None:
+        """Mark slots invalid. Values are kept."""
+        valid = self.valid
+        for slot in slots:
+            valid[slot >> 3] &= ~(1 << (slot & 7)) & 0xFF
+
+    def clear_changed(self, slots: tuple[int, ...] | list[int]) -> None:
+        """Reset the changed flag of slots."""
+        changed = self.changed
+        for slot in slots:
+            changed[slot >> 3] &= ~(1 << (slot & 7)) & 0xFF
+
+    def is_changed(self, slot: int) -> bool:
+        """Return True if the slot has been set since the last clear_changed."""
+        return bool(self.changed[slot >> 3] & (1 << (slot & 7)))
+
+    def is_valid(self, slot: int) -> bool:
+        """Return True if the slot holds a valid value."""
+        return bool(self.valid[slot >> 3] & (1 << (slot & 7)))
+
+    def all_valid(self, slots: tuple[int, ...] | list[int]) -> bool:
+        """Return True if all slots hold valid values."""
+        valid = self.valid
+        return all(valid[slot >> 3] & (1 << (slot & 7)) for slot in slots)
+
+    def get(self, slot: int, default: Any = None) -> Any:
+        """Return the value of a slot, or default if it is invalid."""
+        return self.values[slot] if self.is_valid(slot) else default
+
+    def get_formatted(
+        self, slot: int, converter: Callable[[Any], Any] | None = None, default: Any = None
+    ) -> Any:
+        """Return the formatted value of a slot, or default if it is invalid."""
+        if not self.is_valid(slot):
+            return default
+        value = self.values[slot]
+        if (convert := converter or self.table.formatters[slot]) is not None:
+            return convert(value)
+        return value
+
+    def as_register_dict(self, slots: tuple[int, ...] | list[int]) -> dict[str, dict[str, Any]]:
+        """Return a view of the valid slots keyed by register."""
+        table = self.table
+        return {
+            table.registers[slot]: {
+                Register.NAME: table.names[slot],
+                Register.VALUE: self.get_formatted(slot=slot),
+                Register.UNIT: table.units[slot],
+            }
+            for slot in slots
+            if self.is_valid(slot)
+        }
+
+    def as_mqtt_dict(
+        self,
+        slots: tuple[int, ...] | list[int],
+        converters: Mapping[int, Callable[[Any], Any]] | None = None,
+    ) -> dict[str, dict[str, Any] | int | float | str | bool]:
+        """
+        Return a view of the valid slots keyed by mqtt name.
+
+        Modbus registers are returned as {name, value, unit}, calculated pseudo-registers as plain value.
+        Values are formatted with the given converter of the slot, or with the formatter of the register type.
+        """
+        table = self.table
+        converters = converters or {}
+        result: dict[str, dict[str, Any] | int | float | str | bool] = {}
+        for slot in slots:
+            if (mqtt := table.mqtt[slot]) is None or not self.is_valid(slot):
+                continue
+            value = self.get_formatted(slot=slot, converter=converters.get(slot))
+            if table.registers[slot].isnumeric():
+                result[mqtt] = {
+                    Register.NAME: table.names[slot],
+                    Register.VALUE: value,
+                    Register.UNIT: table.units[slot],
+                }
+            else:
+                result[mqtt] = value
+        return result
@@ -0,0 +1,355 @@
+"""
+Benchmark of the modbus gateway.
+
+Measures the latency distribution of reads of different sizes, the largest read
+without errors, which gaps between registers can be read across, how the gateway
+handles back-to-back and pipelined requests, and derives the cluster size, gap,
+timeout and poll budget for this installation.
+
+(c) 2024 by SukramJ
+"""
+
+from __future__ import annotations
+
+import math
+import socket
+import struct
+import time
+from typing import TYPE_CHECKING, Any, Final
+
+from mtec2mqtt.const import NOW_GROUP_PREFIX, REFRESH_DEFAULTS, Config
+
+if TYPE_CHECKING:
+    from mtec2mqtt.modbus_client import MTECModbusClient
+    from mtec2mqtt.register_map import RegisterMap
+
+READ_SIZES: Final = (1, 2, 4, 8, 16, 32, 64, 125)
+PIPELINE_DEPTHS: Final = (1, 2, 4, 8)
+# Largest gap between registers, which is tested
+_MAX_TESTED_GAP: Final = 32
+_MBAP_HEADER: Final = struct.Struct(">HHHB")
+_READ_REQUEST: Final = struct.Struct(">BHH")
+_FC_READ_HOLDING_REGISTERS: Final = 0x03
+_FRAMER_SOCKET: Final = "socket"
+# Min. speedup of pipelined requests, which is worth pipelining
+_PIPELINE_MIN_SPEEDUP: Final = 1.25
+
+
+class LatencyStats:
+    """Latency distribution of a series of requests."""
+
+    __slots__ = ("errors", "latencies", "requests")
+
+    def __init__(self) -> None:
+        """Init empty stats."""
+        self.latencies: Final[list[float]] = []
+        self.errors = 0
+        self.requests = 0
+
+    def add(self, latency: float, success: bool) -> None:
+        """Add the result of a request."""
+        self.requests += 1
+        if success:
+            self.latencies.append(latency)
+        else:
+            self.errors += 1
+
+    @property
+    def error_rate(self) -> float:
+        """Return the share of failed requests."""
+        return self.errors / self.requests if self.requests else 0.0
+
+    def percentile(self, quantile: float) -> float:
+        """Return a percentile (0..1) of the latencies of successful requests in s."""
+        if not (latencies := sorted(self.latencies)):
+            return math.nan
+        return latencies[min(len(latencies) - 1, int(quantile * len(latencies)))]
+
+    def as_dict(self) -> dict[str, Any]:
+        """Return the stats in ms."""
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "p50": round(1000 * self.percentile(0.5), 1),
+            "p90": round(1000 * self.percentile(0.9), 1),
+            "p99": round(1000 * self.percentile(0.99), 1),
+            "max": round(1000 * max(self.latencies, default=math.nan), 1),
+        }
+
+
+class GatewayBench:
+    """Benchmark of the modbus gateway."""
+
+    def __init__(
+        self,
+        api: MTECModbusClient,
+        config: dict[str, Any],
+        samples: int = 20,
+        pause: float = 0.05,
+    ) -> None:
+        """Init the benchmark. Requests of a series are separated by pause seconds."""
+        self._api: Final = api
+        self._config: Final = config
+        self._samples: Final = samples
+        self._pause: Final = pause
+
+    def run(self, address: int | None = None) -> dict[str, Any]:
+        """Run all measurements and return the results with the recommended config."""
+        register_map = self._api.register_map
+        if address is None:
+            address = get_longest_run(register_map=register_map)[0]
+        sizes = self.measure_sizes(address=address)
+        gaps = self.measure_gaps()
+        back_to_back = self.measure_back_to_back(address=address)
+        pipelining = self.measure_pipelining(address=address)
+        return {
+            "address": address,
+            "sizes": {size: stats.as_dict() for size, stats in sizes.items()},
+            "gaps": gaps,
+            "back_to_back": back_to_back.as_dict(),
+            "pipelining": pipelining,
+            "recommendation": self.recommend(sizes=sizes, gaps=gaps, pipelining=pipelining),
+        }
+
+    def measure_sizes(self, address: int) -> dict[int, LatencyStats]:
+        """
+        Measure the latency of reads of increasing size.
+
+        At the first size with errors, the largest size without errors is searched by bisection.
+        """
+        results: dict[int, LatencyStats] = {}
+        good = 0
+        for size in READ_SIZES:
+            stats = results[size] = self._measure(address=address, count=size, pause=self._pause)
+            if stats.errors:
+                bad = size
+                while bad - good > 1:
+                    size = (good + bad) // 2
+                    stats = results[size] = self._measure(
+                        address=address,
+                        count=size,
+                        pause=self._pause,
+                        samples=max(3, self._samples // 4),
+                    )
+                    if stats.errors:
+                        bad = size
+                    else:
+                        good = size
+                break
+            good = size
+        return dict(sorted(results.items()))
+
+    def measure_gaps(self) -> dict[int, bool]:
+        """Test reads across the gaps between the known registers. Stops at the first failure."""
+        results: dict[int, bool] = {}
+        for gap, start, end in get_gaps(register_map=self._api.register_map):
+            if gap in results:
+                continue
+            results[gap] = isinstance(
+                self._api.probe_registers(address=start, count=end - start), list
+            )
+            time.sleep(self._pause)
+            if not results[gap]:
+                break
+        return results
+
+    def measure_back_to_back(self, address: int) -> LatencyStats:
+        """Measure reads, which are sent without any pause."""
+        return self._measure(address=address, count=1, pause=0.0, samples=3 * self._samples)
+
+    def measure_pipelining(self, address: int) -> dict[int, float | None]:
+        """
+        Send several requests without waiting for the responses.
+
+        Returns the time per request in ms by pipeline depth, None if responses got lost
+        or didn't match the requests. Only supported for modbus TCP.
+        """
+        results: dict[int, float | None] = {}
+        if self._config.get(Config.MODBUS_FRAMER, _FRAMER_SOCKET) != _FRAMER_SOCKET:
+            return results
+        for depth in PIPELINE_DEPTHS:
+            results[depth] = self._measure_pipeline(address=address, depth=depth)
+            if results[depth] is None:
+                break
+        return results
+
+    def recommend(
+        self,
+        sizes: dict[int, LatencyStats],
+        gaps: dict[int, bool],
+        pipelining: dict[int, float | None] | None = None,
+    ) -> dict[str, Any]:
+        """Return the recommended config."""
+        # largest size without errors
+        max_size = max((size for size, stats in sizes.items() if not stats.errors), default=1)
+        overhead, per_register = fit_latency(
+            points=[
+                (size, stats.percentile(0.5)) for size, stats in sizes.items() if not stats.errors
+            ]
+        )
+        # reading the gap is cheaper than another request, as long as the gateway accepts it
+        tolerated_gap = max((gap for gap, ok in gaps.items() if ok), default=0)
+        cost_gap = int(overhead / per_register) if per_register > 0 else tolerated_gap
+        cluster_gap = max(0, min(tolerated_gap, cost_gap))
+        p99 = max(
+            (stats.percentile(0.99) for stats in sizes.values() if not stats.errors),
+            default=math.nan,
+        )
+        timeout = max(1, math.ceil(3 * p99)) if not math.isnan(p99) else None
+        # defer low priority groups, if reading all now-* groups takes more than half of REFRESH_NOW
+        refresh_now = self._config.get(Config.REFRESH_NOW, REFRESH_DEFAULTS[Config.REFRESH_NOW])
+        clusters, words = count_clusters(
+            register_map=self._api.register_map,
+            prefix=NOW_GROUP_PREFIX,
+            max_size=max_size,
+            gap=cluster_gap,
+        )
+        estimate = clusters * overhead + words * per_register
+        budget = round(refresh_now / 2, 1) if estimate > refresh_now / 2 else 0
+        # fastest pipeline depth, if the gateway handles pipelined requests in parallel
+        pipeline_depth = 1
+        if pipelining and (sequential := pipelining.get(1)):
+            timings = {depth: ms for depth, ms in pipelining.items() if ms is not None}
+            fastest = min(timings, key=lambda depth: timings[depth])
+            if timings[fastest] * _PIPELINE_MIN_SPEEDUP <= sequential:
+                pipeline_depth = fastest
+        return {
+            Config.MODBUS_MAX_CLUSTER_SIZE.value: max_size,
+            Config.MODBUS_CLUSTER_GAP.value: cluster_gap,
+            Config.MODBUS_TIMEOUT.value: timeout,
+            Config.MODBUS_CYCLE_BUDGET.value: budget,
+            Config.MODBUS_PIPELINE_DEPTH.value: pipeline_depth,
+            "estimated_now_read_time": round(estimate, 3),
+        }
+
+    def _measure(
+        self, address: int, count: int, pause: float, samples: int | None = None
+    ) -> LatencyStats:
+        """Measure a series of reads."""
+        stats = LatencyStats()
+        for _ in range(samples or self._samples):
+            start = time.monotonic()
+            response = self._api.probe_registers(address=address, count=count)
+            stats.add(latency=time.monotonic() - start, success=isinstance(response, list))
+            if pause:
+                time.sleep(pause)
+        return stats
+
+    def _measure_pipeline(self, address: int, depth: int) -> float | None:
+        """Return the time per request in ms with depth requests in flight, None on errors."""
+        host = self._config[Config.MODBUS_IP]
+        port = self._config[Config.MODBUS_PORT]
+        unit = self._config[Config.MODBUS_SLAVE]
+        timeout = self._config.get(Config.MODBUS_TIMEOUT, 5)
+        pdu = _READ_REQUEST.pack(_FC_READ_HOLDING_REGISTERS, address, 1)
+        try:
+            with socket.create_connection((host, port), timeout=timeout) as sock:
+                start = time.monotonic()
+                for sample in range(self._samples):
+                    tids = [(sample * depth + idx) & 0xFFFF for idx in range(depth)]
+                    sock.sendall(
+                        b"".join(
+                            _MBAP_HEADER.pack(tid, 0, len(pdu) + 1, unit) + pdu for tid in tids
+                        )
+                    )
+                    # responses may arrive in any order, they are matched by transaction id
+                    pending = set(tids)
+                    while pending:
+                        header = _recv_exactly(sock=sock, size=_MBAP_HEADER.size)
+                        response_tid, _, length, _ = _MBAP_HEADER.unpack(header)
+                        response = _recv_exactly(sock=sock, size=length - 1)
+                        if (
+                            response_tid not in pending
+                            or response[0] != _FC_READ_HOLDING_REGISTERS
+                        ):
+                            return None
+                        pending.discard(response_tid)
+                    time.sleep(self._pause)
+                elapsed = time.monotonic() - start - self._samples * self._pause
+        except OSError:
+            return None
+        return round(1000 * elapsed / (self._samples * depth), 2)
+
+
+def get_longest_run(register_map: RegisterMap) -> tuple[int, int]:
+    """Return start and length of the longest run of adjacent known registers."""
+    best = (0, 0)
+    start = end = -1
+    for item in sorted(
+        (d for d in register_map.definitions if d.address is not None),
+        key=lambda d: d.address or 0,
+    ):
+        address = item.address or 0
+        if address != end:
+            start = address
+        end = address + item.length
+        if end - start > best[1]:
+            best = (start, end - start)
+    return best
+
+
+def get_gaps(register_map: RegisterMap) -> list[tuple[int, int, int]]:
+    """Return the gaps between known registers as (gap, start, end) of a read across, by size."""
+    items = sorted(
+        (d for d in register_map.definitions if d.address is not None),
+        key=lambda d: d.address or 0,
+    )
+    gaps: list[tuple[int, int, int]] = []
+    for left, right in zip(items, items[1:], strict=False):
+        left_end = (left.address or 0) + left.length
+        right_address = right.address or 0
+        if 0 < (gap := right_address - left_end) <= _MAX_TESTED_GAP:
+            gaps.append((gap, left.address or 0, right_address + right.length))
+    return sorted(gaps)
+
+
+def count_clusters(
+    register_map: RegisterMap, prefix: str, max_size: int, gap: int
+) -> tuple[int, int]:
+    """Return the number of reads and read registers of the groups with prefix."""
+    clusters = words = 0
+    start = end = -1
+    items = sorted(
+        (
+            d
+            for d in register_map.definitions
+            if d.address is not None and d.group and d.group.startswith(prefix)
+        ),
+        key=lambda d: d.address or 0,
+    )
+    for item in items:
+        address = item.address or 0
+        if start < 0 or address > end + gap or address + item.length - start > max_size:
+            if start >= 0:
+                words += end - start
+            clusters += 1
+            start = address
+        end = address + item.length
+    if start >= 0:
+        words += end - start
+    return clusters, words
+
+
+def fit_latency(points: list[tuple[int, float]]) -> tuple[float, float]:
+    """Return the overhead per request and the time per register (s) of a least squares fit."""
+    if not points:
+        return 0.0, 0.0
+    if len(points) == 1:
+        return points[0][1], 0.0
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x if var_x else 0.0
+    slope = max(slope, 0.0)
+    return max(mean_y - slope * mean_x, 0.0), slope
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    """Receive exactly size bytes."""
+    data = b""
+    while len(data) < size:
+        if not (chunk := sock.recv(size - len(data))):
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
@@ -1,21 +1,53 @@
 """
 A test utility for MTEC Modbus API.
 
+Without arguments, an interactive menu is shown. For scripting, the subcommands
+list, read, write and dump print their result as table, JSON or CSV to stdout:
+
+    mtec_util list --group now-base --format json
+    mtec_util read --group now-battery --register 10100 --format csv
+    mtec_util write 50000 "General mode" --yes
+    mtec_util dump --writable
+    mtec_util scan 10000 20000 --output scan.json --previous old-scan.json
+    mtec_util bench --write-config
+
 (c) 2023 by Christian Rödel
 (c) 2024 by SukramJ
 """
 
 from __future__ import annotations
 
+import argparse
+from collections.abc import Sequence
+import csv
+import json
 import logging
-from typing import Final
+import sys
+from typing import Any, Final
 
 from mtec2mqtt import modbus_client
-from mtec2mqtt.config import init_config, init_register_map
-from mtec2mqtt.const import Register, RegisterGroup
+from mtec2mqtt.config import init_config, init_register_map, update_config_file
+from mtec2mqtt.const import Config, Register, RegisterGroup
+from mtec2mqtt.register_map import RegisterDefinition, RegisterMap
+from mtec2mqtt.util.gateway_bench import GatewayBench
+from mtec2mqtt.util.register_scan import (
+    MAX_READ_COUNT,
+    RegisterScanner,
+    ScanDiff,
+    ScanResult,
+    build_draft,
+)
 
 _LOGGER: Final = logging.getLogger(__name__)
 
+_FORMAT_CSV: Final = "csv"
+_FORMAT_JSON: Final = "json"
+_FORMAT_TABLE: Final = "table"
+
+_CONFIG_FIELDS: Final = ("register", "mqtt", "unit", "mode", "group", "name")
+_VALUE_FIELDS: Final = ("register", "name", "value", "unit")
+_DUMP_FIELDS: Final = ("register", "mqtt", "group", "mode", "name", "value", "unit")
+
 
 def read_register(api: modbus_client.MTECModbusClient) -> None:
     """Read register."""
@@ -62,15 +94,12 @@ def write_register(api: modbus_client.MTECModbusClient) -> None:
     _LOGGER.info("Current settings of writable registers:")
     _LOGGER.info("Reg   Name                           Value  Unit")
     _LOGGER.info("----- ------------------------------ ------ ----")
-    register_map_sorted = dict(sorted(api.register_map.items()))
-    for register, item in register_map_sorted.items():
-        if item[Register.WRITABLE]:
-            data = api.read_modbus_data(registers=[register])
-            value = ""
-            if data:
-                value = data[register][Register.VALUE]
-            unit = item[Register.UNIT] if item[Register.UNIT] else ""
-            _LOGGER.info("%s; %s; %s; %s", register, item[Register.NAME], str(value), unit)
+    writable = [item for item in _sorted_by_address(api.register_map) if item.writable]
+    # one bulk read of all writable registers, clustered into as few requests as possible
+    data = api.read_modbus_data(registers=[item.register for item in writable])
+    for item in writable:
+        value = data[item.register][Register.VALUE] if item.register in data else ""
+        _LOGGER.info("%s; %s; %s; %s", item.register, item.name, str(value), item.unit)
 
     _LOGGER.info("")
     register = input("Register: ")
@@ -102,13 +131,10 @@ def list_register_config(api: modbus_client.MTECModbusClient) -> None:
             not register.isnumeric()
         ):  # non-numeric registers are deemed to be calculated pseudo-registers
             register = ""
-        mqtt = item[Register.MQTT] if item[Register.MQTT] else ""
-        unit = item[Register.UNIT] if item[Register.UNIT] else ""
-        group = item[Register.GROUP] if item[Register.GROUP] else ""
-        mode = "RW" if item[Register.WRITABLE] else "R"
-        _LOGGER.info(
-            "%s; %s; %s; %s; %s; %s", register, mqtt, unit, mode, group, item[Register.NAME]
-        )
+        mqtt = item.mqtt or ""
+        group = item.group or ""
+        mode = "RW" if item.writable else "R"
+        _LOGGER.info("%s; %s; %s; %s; %s; %s", register, mqtt, item.unit, mode, group, item.name)
 
 
 def list_register_config_by_groups(api: modbus_client.MTECModbusClient) -> None:
@@ -119,37 +145,326 @@ def list_register_config_by_groups(api: modbus_client.MTECModbusClient) -> None:
         _LOGGER.info("")
         _LOGGER.info("Reg   MQTT Parameter                 Unit Mode Name                   ")
         _LOGGER.info("----- ------------------------------ ---- ---- -----------------------")
-        register_map_sorted = dict(sorted(api.register_map.items()))
-        for register, item in register_map_sorted.items():
-            if item[Register.GROUP] == group:
-                if (
-                    not register.isnumeric()
-                ):  # non-nu1meric registers are deemed to be calculated pseudo-registers
-                    register = ""
-                mqtt = item[Register.MQTT] if item[Register.MQTT] else ""
-                unit = item[Register.UNIT] if item[Register.UNIT] else ""
-                mode = "RW" if item[Register.WRITABLE] else "R"
-                _LOGGER.info(
-                    "%s; %s; %s; %s; %s; %s",
-                    group,
-                    register,
-                    mqtt,
-                    unit,
-                    mode,
-                    item[Register.NAME],
-                )
+        for item in sorted(api.register_map.by_group(group), key=lambda d: d.register):
+            # non-numeric registers are deemed to be calculated pseudo-registers
+            register = "" if item.is_pseudo else item.register
+            mqtt = item.mqtt or ""
+            mode = "RW" if item.writable else "R"
+            _LOGGER.info(
+                "%s; %s; %s; %s; %s; %s",
+                group,
+                register,
+                mqtt,
+                item.unit,
+                mode,
+                item.name,
+            )
         _LOGGER.info("")
 
 
-def main() -> None:
+def _sorted_by_address(register_map: RegisterMap) -> list[RegisterDefinition]:
+    """Return the definitions sorted by address. Pseudo-registers come last."""
+    return sorted(
+        register_map.definitions, key=lambda d: (d.address is None, d.address or 0, d.register)
+    )
+
+
+def _select_definitions(
+    register_map: RegisterMap, groups: Sequence[str] | None, registers: Sequence[str] | None
+) -> list[RegisterDefinition] | None:
+    """Return the definitions of the given groups and registers, or all. None if one is unknown."""
+    if not groups and not registers:
+        return _sorted_by_address(register_map)
+    selected: dict[str, RegisterDefinition] = {}
+    for group in groups or ():
+        if group not in register_map.groups:
+            _LOGGER.error("Unknown register group: %s", group)
+            return None
+        selected.update((d.register, d) for d in register_map.by_group(group))
+    for register in registers or ():
+        # registers can be given by number or by mqtt name
+        if (item := register_map.get(register) or register_map.by_mqtt(register)) is None:
+            _LOGGER.error("Unknown register: %s", register)
+            return None
+        selected[item.register] = item
+    return sorted(selected.values(), key=lambda d: (d.address is None, d.address or 0, d.register))
+
+
+def _get_config_row(item: RegisterDefinition) -> dict[str, Any]:
+    """Return the configuration of a register as output row."""
+    return {
+        "register": "" if item.is_pseudo else item.register,
+        "mqtt": item.mqtt or "",
+        "unit": item.unit,
+        "mode": "RW" if item.writable else "R",
+        "group": item.group or "",
+        "name": item.name,
+    }
+
+
+def _read_rows(
+    api: modbus_client.MTECModbusClient, definitions: list[RegisterDefinition]
+) -> list[dict[str, Any]]:
+    """Read the given modbus registers with clustered bulk reads and return the output rows."""
+    items = [item for item in definitions if not item.is_pseudo]
+    data = api.read_modbus_data(registers=[item.register for item in items])
+    return [
+        {
+            **_get_config_row(item),
+            "value": data[item.register][Register.VALUE] if item.register in data else None,
+        }
+        for item in items
+    ]
+
+
+def _print_rows(rows: list[dict[str, Any]], fields: Sequence[str], fmt: str) -> None:
+    """Print rows as table, JSON or CSV to stdout."""
+    if fmt == _FORMAT_JSON:
+        json.dump(
+            [{field: row[field] for field in fields} for row in rows],
+            sys.stdout,
+            indent=2,
+            default=str,
+        )
+        sys.stdout.write("\n")
+    elif fmt == _FORMAT_CSV:
+        writer = csv.DictWriter(sys.stdout, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        texts = [
+            ["" if row[field] is None else str(row[field]) for field in fields] for row in rows
+        ]
+        widths = [
+            max([len(field), *(len(text[idx]) for text in texts)])
+            for idx, field in enumerate(fields)
+        ]
+        for line in (list(fields), ["-" * width for width in widths], *texts):
+            print(  # noqa: T201
+                " ".join(text.ljust(width) for text, width in zip(line, widths, strict=True))
+            )
+
+
+def _cmd_list(api: modbus_client.MTECModbusClient, args: argparse.Namespace) -> int:
+    """List the register configuration."""
+    if (definitions := _select_definitions(api.register_map, args.group, args.register)) is None:
+        return 1
+    _print_rows(
+        rows=[_get_config_row(item) for item in definitions],
+        fields=_CONFIG_FIELDS,
+        fmt=args.format,
+    )
+    return 0
+
+
+def _cmd_read(api: modbus_client.MTECModbusClient, args: argparse.Namespace) -> int:
+    """Read registers from the inverter."""
+    if (definitions := _select_definitions(api.register_map, args.group, args.register)) is None:
+        return 1
+    rows = _read_rows(api=api, definitions=definitions)
+    _print_rows(rows=rows, fields=_VALUE_FIELDS, fmt=args.format)
+    return 0 if all(row["value"] is not None for row in rows) else 1
+
+
+def _cmd_dump(api: modbus_client.MTECModbusClient, args: argparse.Namespace) -> int:
+    """Dump the configuration and the values of all (writable) registers."""
+    definitions = [
+        item for item in _sorted_by_address(api.register_map) if not args.writable or item.writable
+    ]
+    rows = _read_rows(api=api, definitions=definitions)
+    _print_rows(rows=rows, fields=_DUMP_FIELDS, fmt=args.format)
+    return 0 if all(row["value"] is not None for row in rows) else 1
+
+
+def _cmd_write(api: modbus_client.MTECModbusClient, args: argparse.Namespace) -> int:
+    """Write a value to a register of the inverter."""
+    register_map = api.register_map
+    if (item := register_map.get(args.register) or register_map.by_mqtt(args.register)) is None:
+        _LOGGER.error("Unknown register: %s", args.register)
+        return 1
+    if not args.yes:
+        _LOGGER.info("WARNING: Be careful when writing registers to your Inverter!")
+        yn = input(f"Do you really want to set register {item.register} to '{args.value}'? (y/N)")
+        if yn not in ("y", "Y"):
+            _LOGGER.info("Write aborted by user")
+            return 1
+    if item.mqtt:
+        # accepts the display values of value_items as well
+        success = api.write_register_by_name(name=item.mqtt, value=args.value)
+    else:
+        success = api.write_register(register=item.register, value=args.value)
+    if not success:
+        _LOGGER.error("Writing failed")
+        return 1
+    _LOGGER.info("New value successfully set")
+    return 0
+
+
+def _cmd_scan(api: modbus_client.MTECModbusClient, args: argparse.Namespace) -> int:
+    """Scan an address range for readable registers and print a draft of the unknown ones."""
+    if not 0 <= args.start < args.end <= 0x10000:
+        _LOGGER.error("Invalid address range: %s - %s", args.start, args.end)
+        return 1
+    previous: ScanResult | None = None
+    if args.previous:
+        with open(args.previous, encoding="utf-8") as file:
+            previous = ScanResult.from_dict(data=json.load(file))
+    scanner = RegisterScanner(
+        probe=lambda address, count: api.probe_registers(address=address, count=count),
+        max_count=args.max_count,
+        resolution=args.resolution,
+    )
+    result = scanner.scan(start=args.start, end=args.end)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(result.as_dict(), file, indent=2)
+    diff = ScanDiff(result=result, register_map=api.register_map, previous=previous)
+    _LOGGER.info("Unknown readable registers: %i", len(diff.unknown))
+    _LOGGER.info("Known registers which are not readable: %s", diff.missing or "none")
+    if previous is not None:
+        _LOGGER.info("New since previous scan: %s", diff.new or "none")
+        _LOGGER.info("Changed since previous scan: %s", diff.changed or "none")
+        _LOGGER.info("Not readable anymore: %s", diff.gone or "none")
+    sys.stdout.write(build_draft(result=result, diff=diff))
+    return 0
+
+
+def _cmd_bench(api: modbus_client.MTECModbusClient, args: argparse.Namespace) -> int:
+    """Benchmark the gateway and recommend the modbus config."""
+    _LOGGER.info("Benchmarking the gateway, this takes a while...")
+    bench = GatewayBench(api=api, config=args.config, samples=args.samples)
+    results = bench.run(address=args.address)
+    recommendation = results["recommendation"]
+    if args.format == _FORMAT_JSON:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        _print_rows(
+            rows=[{"size": size, **stats} for size, stats in results["sizes"].items()],
+            fields=("size", "requests", "errors", "p50", "p90", "p99", "max"),
+            fmt=args.format,
+        )
+        lines = [
+            "",
+            f"Back-to-back reads (ms) at register {results['address']}: {results['back_to_back']}",
+            f"Reads across gaps: {results['gaps'] or 'no gaps tested'}",
+            f"Time per request (ms) by pipeline depth: {results['pipelining'] or 'not tested'}",
+            "",
+            "Recommended config:",
+            *(f"  {key}: {value}" for key, value in recommendation.items()),
+        ]
+        print("\n".join(lines))  # noqa: T201
+    if args.write_config:
+        values = {
+            key: value
+            for key, value in recommendation.items()
+            if key in Config.__members__ and value is not None
+        }
+        if not update_config_file(values=values):
+            return 1
+    return 0
+
+
+def _create_parser() -> argparse.ArgumentParser:
+    """Create the parser of the command line arguments."""
+    parser = argparse.ArgumentParser(
+        prog="mtec_util",
+        description="Utility for the M-TEC Energybutler. Starts an interactive menu without command.",
+    )
+    formats = (_FORMAT_TABLE, _FORMAT_JSON, _FORMAT_CSV)
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument(
+        "--format", choices=formats, default=_FORMAT_TABLE, help="output format (default: table)"
+    )
+    selection = argparse.ArgumentParser(add_help=False)
+    selection.add_argument(
+        "--group", "-g", action="append", help="register group, can be repeated (default: all)"
+    )
+    selection.add_argument(
+        "--register",
+        "-r",
+        action="append",
+        help="register number or mqtt name, can be repeated (default: all)",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser(
+        "list", parents=[selection, output], help="list the register configuration"
+    ).set_defaults(func=_cmd_list, connect=False)
+    subparsers.add_parser(
+        "read", parents=[selection, output], help="read registers from the inverter"
+    ).set_defaults(func=_cmd_read, connect=True)
+    dump = subparsers.add_parser(
+        "dump", parents=[output], help="dump configuration and values of all registers"
+    )
+    dump.add_argument("--writable", action="store_true", help="only writable registers")
+    dump.set_defaults(func=_cmd_dump, connect=True)
+    write = subparsers.add_parser("write", help="write a value to a register of the inverter")
+    write.add_argument("register", help="register number or mqtt name")
+    write.add_argument("value", help="value, or display value of a value item")
+    write.add_argument("--yes", "-y", action="store_true", help="don't ask for confirmation")
+    write.set_defaults(func=_cmd_write, connect=True)
+    scan = subparsers.add_parser(
+        "scan", help="scan an address range and print a registers.yaml draft of unknown registers"
+    )
+    scan.add_argument("start", type=int, help="first address")
+    scan.add_argument("end", type=int, help="end address (exclusive)")
+    scan.add_argument(
+        "--max-count",
+        type=int,
+        default=MAX_READ_COUNT,
+        help=f"registers per read (default: {MAX_READ_COUNT})",
+    )
+    scan.add_argument(
+        "--resolution",
+        type=int,
+        default=1,
+        help="stop bisecting rejected ranges at this size, faster but may miss registers (default: 1)",
+    )
+    scan.add_argument("--output", "-o", help="store the scan result as JSON")
+    scan.add_argument("--previous", "-p", help="JSON of a previous scan to compare with")
+    scan.set_defaults(func=_cmd_scan, connect=True)
+    bench = subparsers.add_parser(
+        "bench",
+        parents=[output],
+        help="benchmark the gateway and recommend cluster size, gap, timeout and poll budget",
+    )
+    bench.add_argument(
+        "--address",
+        type=int,
+        help="register to read from (default: start of the longest run of known registers)",
+    )
+    bench.add_argument("--samples", type=int, default=20, help="requests per measurement")
+    bench.add_argument(
+        "--write-config", action="store_true", help="write the recommendation to config.yaml"
+    )
+    bench.set_defaults(func=_cmd_bench, connect=True)
+    return parser
+
+
+def main(argv: Sequence[str] | None = None) -> None:
     """Start the mtec utilities."""
-    register_map, register_groups = init_register_map()
+    args = _create_parser().parse_args(argv)
+    register_map = init_register_map()
     config = init_config()
-    api = modbus_client.MTECModbusClient(
-        config=config, register_map=register_map, register_groups=register_groups
-    )
+    api = modbus_client.MTECModbusClient(config=config, register_map=register_map)
+    args.config = config
+    if args.command:
+        if args.connect and not api.connect():
+            sys.exit(1)
+        try:
+            result = args.func(api=api, args=args)
+        finally:
+            api.disconnect()
+        sys.exit(result)
+
     api.connect()
+    _interactive_menu(api=api)
+    api.disconnect()
+    print("Bye!")  # noqa: T201
+
 
+def _interactive_menu(api: modbus_client.MTECModbusClient) -> None:
+    """Run the interactive menu."""
     while True:
         print("=====================================")  # noqa: T201
         print("Menu:")  # noqa: T201
@@ -173,9 +488,6 @@ def main() -> None:
         elif opt in ("x", "X"):
             break
 
-    api.disconnect()
-    print("Bye!")  # noqa: T201
-
 
 # -------------------------------
 if __name__ == "__main__":
@@ -0,0 +1,241 @@
+"""
+Scanner for the modbus register space.
+
+Address ranges are read with reads of the max size. If the device rejects a
+read, e.g. because it covers unmapped addresses, the range is bisected until
+the readable islands are found. Small rejected ranges are probed register by
+register. The result can be compared with the register
+map and with a previous scan, and unknown registers are written as a draft for
+registers.yaml.
+
+(c) 2024 by SukramJ
+"""
+
+from __future__ import annotations
+
+from collections.abc import Callable
+from datetime import datetime
+import logging
+import time
+from typing import Any, Final
+
+from mtec2mqtt.register_map import RegisterMap
+
+_LOGGER: Final = logging.getLogger(__name__)
+
+MAX_READ_COUNT: Final = 125
+# Rejected ranges up to this size are probed in steps of the resolution instead of bisected,
+# as bisecting an unreadable range needs twice as many requests
+_LINEAR_PROBE_SIZE: Final = 8
+
+PROBE_TYPE = Callable[[int, int], list[int] | int | None]
+
+
+class ScanResult:
+    """The readable words of a scan, and the rejected or failed address ranges."""
+
+    __slots__ = ("end", "failed", "rejected", "requests", "start", "timestamp", "words")
+
+    def __init__(
+        self,
+        start: int,
+        end: int,
+        *,
+        words: dict[int, int] | None = None,
+        rejected: list[tuple[int, int]] | None = None,
+        failed: list[tuple[int, int]] | None = None,
+        requests: int = 0,
+        timestamp: float | None = None,
+    ) -> None:
+        """Init the scan result of the address range [start, end)."""
+        self.start: Final = start
+        self.end: Final = end
+        self.words: Final[dict[int, int]] = words or {}
+        # address ranges as (start, end), which the device rejected or didn't answer
+        self.rejected: Final[list[tuple[int, int]]] = rejected or []
+        self.failed: Final[list[tuple[int, int]]] = failed or []
+        self.requests = requests
+        self.timestamp: Final = timestamp or time.time()
+
+    def as_dict(self) -> dict[str, Any]:
+        """Return the result as JSON serializable dict."""
+        return {
+            "start": self.start,
+            "end": self.end,
+            "timestamp": self.timestamp,
+            "requests": self.requests,
+            "words": {str(address): word for address, word in sorted(self.words.items())},
+            "rejected": _merge_ranges(ranges=self.rejected),
+            "failed": _merge_ranges(ranges=self.failed),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> ScanResult:
+        """Return a result, which has been stored with as_dict."""
+        return cls(
+            start=data["start"],
+            end=data["end"],
+            words={int(address): word for address, word in data["words"].items()},
+            rejected=[(start, end) for start, end in data["rejected"]],
+            failed=[(start, end) for start, end in data["failed"]],
+            requests=data.get("requests", 0),
+            timestamp=data.get("timestamp"),
+        )
+
+    def covers(self, address: int) -> bool:
+        """Return True if the address has been scanned."""
+        return self.start <= address < self.end
+
+
+class ScanDiff:
+    """Differences of a scan to the register map and to a previous scan."""
+
+    __slots__ = ("changed", "gone", "missing", "new", "unknown")
+
+    def __init__(
+        self, result: ScanResult, register_map: RegisterMap, previous: ScanResult | None = None
+    ) -> None:
+        """Compare the scan result."""
+        words = result.words
+        known: set[int] = set()
+        self.missing: Final[list[int]] = []
+        for item in register_map.definitions:
+            if item.address is None or not result.covers(item.address):
+                continue
+            addresses = range(item.address, item.address + item.length)
+            known.update(addresses)
+            if any(address not in words for address in addresses):
+                self.missing.append(item.address)
+        # readable addresses, which are not part of any register definition
+        self.unknown: Final = sorted(address for address in words if address not in known)
+        self.new: Final[list[int]] = []
+        self.gone: Final[list[int]] = []
+        self.changed: Final[list[int]] = []
+        if previous is None:
+            return
+        for address, word in sorted(words.items()):
+            if not previous.covers(address):
+                continue
+            if (old := previous.words.get(address)) is None:
+                self.new.append(address)
+            elif old != word:
+                self.changed.append(address)
+        self.gone.extend(
+            address
+            for address in sorted(previous.words)
+            if result.covers(address) and address not in words
+        )
+
+
+class RegisterScanner:
+    """Scans address ranges with max sized reads and bisects rejected ranges."""
+
+    def __init__(
+        self,
+        probe: PROBE_TYPE,
+        max_count: int = MAX_READ_COUNT,
+        resolution: int = 1,
+        retries: int = 1,
+    ) -> None:
+        """
+        Init the scanner.
+
+        probe reads count words at address and returns the words, the modbus exception code
+        or None if the device didn't respond. Rejected ranges are bisected down to resolution.
+        """
+        self._probe: Final = probe
+        self._max_count: Final = max(1, min(max_count, MAX_READ_COUNT))
+        self._resolution: Final = max(1, resolution)
+        self._retries: Final = retries
+
+    def scan(self, start: int, end: int) -> ScanResult:
+        """Scan the address range [start, end)."""
+        result = ScanResult(start=start, end=end)
+        started = time.monotonic()
+        # pending ranges as (address, count), processed in address order
+        pending = [
+            (address, min(self._max_count, end - address))
+            for address in range(start, end, self._max_count)
+        ]
+        pending.reverse()
+        while pending:
+            address, count = pending.pop()
+            response = self._probe_range(address=address, count=count, result=result)
+            if isinstance(response, list):
+                result.words.update(zip(range(address, address + count), response, strict=True))
+                continue
+            if count > self._resolution:
+                if count <= _LINEAR_PROBE_SIZE:
+                    step = self._resolution
+                    pending.extend(
+                        (a, min(step, address + count - a))
+                        for a in reversed(range(address, address + count, step))
+                    )
+                else:
+                    half = count // 2
+                    pending.append((address + half, count - half))
+                    pending.append((address, half))
+                continue
+            if response is None:
+                result.failed.append((address, address + count))
+            else:
+                result.rejected.append((address, address + count))
+        _LOGGER.info(
+            "Scanned %i registers with %i requests in %.1fs: %i readable",
+            end - start,
+            result.requests,
+            time.monotonic() - started,
+            len(result.words),
+        )
+        return result
+
+    def _probe_range(self, address: int, count: int, result: ScanResult) -> list[int] | int | None:
+        """Read a range, with retries if the device doesn't respond."""
+        response: list[int] | int | None = None
+        for _ in range(self._retries + 1):
+            result.requests += 1
+            if result.requests % 500 == 0:
+                _LOGGER.info("Scanning... at register %s, %i requests", address, result.requests)
+            if (response := self._probe(address, count)) is not None:
+                break
+        return response
+
+
+def build_draft(result: ScanResult, diff: ScanDiff) -> str:
+    """Return a draft registers.yaml fragment of the unknown registers."""
+    changed = set(diff.changed)
+    new = set(diff.new)
+    scanned_at = datetime.fromtimestamp(result.timestamp).isoformat(timespec="seconds")
+    lines = [
+        f"# Draft of registers found by mtec_util scan at {scanned_at}",
+        "# Check name, type, length, scale and unit before adding them to registers.yaml",
+    ]
+    for address in diff.unknown:
+        word = result.words[address]
+        notes = [f"value {word} (0x{word:04X})"]
+        if address in new:
+            notes.append("new since previous scan")
+        if address in changed:
+            notes.append("changed since previous scan")
+        lines.extend(
+            (
+                "",
+                f'"{address}":',
+                f"  name: Unknown register {address}",
+                "  length: 1",
+                "  type: U16",
+                f"  # {', '.join(notes)}",
+            )
+        )
+    return "\n".join(lines) + "\n"
+
+
+def _merge_ranges(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """Merge adjacent and overlapping address ranges."""
+    merged: list[tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged